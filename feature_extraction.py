@@ -10,6 +10,12 @@ from datetime import datetime, timedelta
 import re
 import time
 import subprocess
+import json
+import gzip
+import hashlib
+import shutil
+from collections import Counter
+import joblib
 from joblib import Parallel, delayed
 
 def time_convert(inp, mode, real_sd = '2010-01-02', sd_monday= "2009-12-28"):
@@ -66,70 +72,381 @@ def time_convert(inp, mode, real_sd = '2010-01-02', sd_monday= "2009-12-28"):
         startday = datetime.strptime(sd_monday,"%Y-%m-%d")
         return startday+timedelta(weeks = inp)
     
-def add_action_thisweek(act, columns, lines, act_handles, week_index, stop, firstdate, dname = 'r5.2'):
+##############################################################################
+# 时间上下文: 对整列datetime64做整数运算, 得到天数编号、周编号、星期、工作时间标记和时间类型
+# 默认工作时间为WORK_HOURS(含两端), 周末为WEEKEND_DAYS中的星期(%w编号: 0为周日, 6为周六), 每次运行可以通过命令行参数修改
+
+WORK_HOURS = ('7:30', '17:30')
+WEEKEND_DAYS = (0, 6)
+NS_PER_DAY = 24*3600*10**9
+
+def clock_to_ns(hm):
+    """把"H:M"格式的时刻转换为距离当天0点的纳秒数"""
+    h, m = hm.split(':')
+    return (int(h)*60 + int(m))*60*10**9
+
+def date_to_epoch_day(date):
+    """把"%Y-%m-%d"格式的日期转换为1970-01-01以来的天数"""
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+def time_context(dates, week_start = None, sd_monday = "2009-12-28", work_hours = WORK_HOURS, weekend_days = WEEKEND_DAYS):
+    """
+    按列计算活动的时间上下文
+    参数:
+    - dates: 活动时间(datetime64的Series或数组)
+    - week_start: 第0周开始的日期("%Y-%m-%d"), 给出时计算周编号
+    - sd_monday: 天数编号的起点(与time_convert的dt2dn一致)
+    - work_hours: 工作时间的开始和结束("H:M")
+    - weekend_days: 周末包含的星期(%w编号)
+    返回:
+    - 字典, 包含day(天数编号), week(周编号, 需要week_start), weekday(%w编号), workhour(是否工作时间),
+      weekend(是否周末), time(1: 工作日工作时间, 2: 工作日非工作时间, 3: 周末工作时间, 4: 周末非工作时间)
+    """
+    ns = np.asarray(dates, dtype='datetime64[ns]').astype(np.int64)
+    epoch_day = ns // NS_PER_DAY
+    tod = ns - epoch_day*NS_PER_DAY
+    workhour = (tod >= clock_to_ns(work_hours[0])) & (tod <= clock_to_ns(work_hours[1]))
+    weekday = (epoch_day + 4) % 7 # 1970-01-01是周四
+    weekend = np.isin(weekday, weekend_days)
+    ctx = {'day': epoch_day - date_to_epoch_day(sd_monday), 'weekday': weekday, 'workhour': workhour, 'weekend': weekend,
+           'time': 1 + (~workhour).astype(int) + 2*weekend.astype(int)}
+    if week_start is not None:
+        ctx['week'] = (epoch_day - date_to_epoch_day(week_start)) // 7
+    return ctx
+
+day_timestamps = {}
+
+def day_timestamp(day, sd_monday = "2009-12-28"):
+    """天数编号对应当天0点(本地时间)的时间戳, 按天缓存"""
+    if (day, sd_monday) not in day_timestamps:
+        day_timestamps[(day, sd_monday)] = (datetime.strptime(sd_monday,'%Y-%m-%d') + timedelta(days=int(day))).timestamp()
+    return day_timestamps[(day, sd_monday)]
+    
+##############################################################################
+# 中间结果(DataByWeek, NumDataByWeek, tmp)的存储格式:
+# pickle: 原有格式, 读取时总是加载全部列
+# parquet: 列式压缩存储(需要pyarrow), 读取时支持列投影和按user/day的谓词下推
+# feather: 列式存储(需要pyarrow), 读取时支持列投影, user/day过滤在读取后进行
+
+STORAGE_FORMATS = {'pickle': '.pickle', 'parquet': '.parquet', 'feather': '.feather'}
+
+# 最终CSV文件的压缩格式及扩展名(zstd需要zstandard)
+CSV_COMPRESSIONS = {'none': '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+
+def storage_path(path, storage = 'pickle'):
+    """返回不含扩展名的存储路径在指定格式下的文件名"""
+    return path + STORAGE_FORMATS[storage]
+
+def save_frame(df, path, storage = 'pickle'):
+    """
+    按指定格式保存DataFrame
+    参数:
+    - df: 要保存的数据
+    - path: 不含扩展名的路径, 如"NumDataByWeek/3_num_uall_w0-72_mweek_s0"
+    - storage: 存储格式(pickle/parquet/feather)
+    """
+    if storage == 'pickle':
+        df.to_pickle(storage_path(path, storage))
+        return
+    if df.index.name is not None: # 列式格式只保存普通列, 命名索引(如活动id)作为普通列保存
+        df = df.reset_index()
+    else:
+        df = df.reset_index(drop=True)
+    if storage == 'parquet':
+        df.to_parquet(storage_path(path, storage), compression='zstd', index=False)
+    elif storage == 'feather':
+        df.to_feather(storage_path(path, storage))
+
+def load_frame(path, storage = 'pickle', columns = None, filters = None, index_col = None):
+    """
+    按指定格式读取DataFrame
+    参数:
+    - path: 不含扩展名的路径
+    - storage: 存储格式(pickle/parquet/feather)
+    - columns: 只读取这些列, None表示全部列
+    - filters: 行过滤条件, 如{'user': [0, 5], 'day': [14]}, 只保留取值在列表中的行
+    - index_col: 保存时作为普通列写入的索引列名(如DataByWeek的'id')
+    """
+    read_cols = None
+    if columns is not None:
+        read_cols = list(columns) + [f for f in (filters or {}) if f not in columns]
+        if index_col is not None and index_col not in read_cols:
+            read_cols = [index_col] + read_cols
+    if storage == 'pickle':
+        df = pd.read_pickle(storage_path(path, storage))
+        if read_cols is not None:
+            df = df[[c for c in read_cols if c in df.columns]]
+    elif storage == 'parquet':
+        pq_filters = [(f, 'in', list(v)) for f, v in (filters or {}).items()] or None
+        df = pd.read_parquet(storage_path(path, storage), columns=read_cols, filters=pq_filters)
+    elif storage == 'feather':
+        df = pd.read_feather(storage_path(path, storage), columns=read_cols)
+    if index_col is not None and index_col in df.columns:
+        df = df.set_index(index_col)
+    for f in (filters or {}):
+        df = df[df[f].isin(filters[f])]
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+# 数值化数据的用户行索引文件后缀: 第u个用户的行为[offsets[u], offsets[u+1])
+USER_INDEX_SUFFIX = '_users.npy'
+
+def save_user_index(path, user_codes, n_users):
+    """保存数值化数据的用户行索引(只在各行按用户编号排列时保存)"""
+    if np.all(np.diff(user_codes) >= 0):
+        np.save(path + USER_INDEX_SUFFIX, np.searchsorted(user_codes, np.arange(n_users + 1)))
+
+def load_week_users(path, storage = 'pickle', columns = None, user_codes = None):
+    """
+    读取一周的数值化数据, 可以只取部分用户
+    参数:
+    - path, storage, columns: 见load_frame, columns需要包含user
+    - user_codes: 要读取的用户在全体用户中的编号(按子集中的新编号排列), None表示全部用户
+    返回:
+    - 数值化数据, 只取部分用户时user列改为用户在user_codes中的位置, 各行按新编号排列, 每个用户内保持原顺序
+    功能:
+    - 按用户行索引把各用户的连续行段按新编号的顺序拼接, 不扫描整周的user列, 也不另存子集的副本
+    - feather以内存映射方式打开, 只取索引给出的行再转换为DataFrame; 未压缩的文件只读入这些行所在的页,
+      压缩的文件(to_feather默认lz4)仍需解压所读的列, 但只转换所取的行
+    - pickle只能整体反序列化, 索引只省去扫描和过滤user列, 不减少读取量; 经常只处理少数用户时应使用feather/parquet
+    - 没有用户行索引或使用parquet时按user过滤读取(parquet可以下推过滤条件只读相关的行组)
     """
-    将一周内的特定类型活动添加到数据框中
+    if user_codes is None:
+        return load_frame(path, storage, columns)
+    user_codes = np.asarray(user_codes)
+    index_file = path + USER_INDEX_SUFFIX
+    indexed = storage != 'parquet' and os.path.exists(index_file)
+    if indexed:
+        offsets = np.load(index_file)
+        starts, lengths = offsets[user_codes], offsets[user_codes + 1] - offsets[user_codes]
+        rows = np.repeat(starts - np.append(0, np.cumsum(lengths)[:-1]), lengths) + np.arange(lengths.sum())
+        if storage == 'feather':
+            import pyarrow.feather
+            table = pyarrow.feather.read_table(storage_path(path, storage), columns = None if columns is None else list(columns), memory_map = True)
+            df = table.take(rows).to_pandas()
+        else:
+            df = load_frame(path, storage, columns).iloc[rows].reset_index(drop = True)
+    else:
+        df = load_frame(path, storage, columns, filters = {'user': list(user_codes)}).reset_index(drop = True)
+    new_code = np.full(user_codes.max() + 1 if len(user_codes) > 0 else 0, -1)
+    new_code[user_codes] = np.arange(len(user_codes))
+    df['user'] = new_code[df['user'].values.astype(int)].astype(df['user'].dtype)
+    if not indexed:
+        df = df.iloc[np.argsort(df['user'].values, kind = 'stable')].reset_index(drop = True)
+    return df
+
+def get_activity_columns(act, dname = 'r4.2'):
+    """返回不同数据集版本中各类活动CSV文件的列名"""
+    if 'email' == act:
+        if dname in ['r4.1','r4.2']:
+            columns = ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'size', '#att', 'content']
+        if dname in ['r6.1','r6.2','r5.2','r5.1']:
+            columns = ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'activity', 'size', 'att', 'content']     
+    elif 'logon' == act:
+        columns = ['id', 'date', 'user', 'pc', 'activity']
+    elif 'device' == act:
+        if dname in ['r4.1','r4.2']:
+            columns = ['id', 'date', 'user', 'pc', 'activity']
+        if dname in ['r5.1','r5.2','r6.2','r6.1']:
+            columns = ['id', 'date', 'user', 'pc', 'content', 'activity']
+    elif 'http' == act:
+        if dname in ['r6.1','r6.2']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'activity', 'content']
+        if dname in ['r5.1','r5.2','r4.2','r4.1']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'content']
+    elif 'file' == act:
+        if dname in ['r4.1','r4.2']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'content']
+        if dname in ['r5.2','r5.1','r6.2','r6.1']: columns = ['id', 'date', 'user', 'pc', 'url/fname','activity','to','from','content']
+    return columns
+
+def parse_activity_lines(lines, act, columns, firstdate, dname = 'r4.2'):
+    """
+    将一批原始CSV行解析为DataFrame
     参数:
-    - act: 活动类型(email,file,http等)
+    - lines: 原始行(bytes)列表
+    - act: 活动类型
     - columns: 列名
-    - lines: 当前读取的行
-    - act_handles: 文件句柄
-    - week_index: 周索引
-    - stop: 停止标志
-    - firstdate: 开始日期
+    - firstdate: 第0周开始日期(周日)
     - dname: 数据集名称
-    返回: 包含该周活动的DataFrame
+    返回: 以活动id为索引的DataFrame, 额外包含week列(周索引)
     """
-    thisweek_act = []
-    while True:
-        if not lines[act]: 
-            stop[act] = 1
-            break
-        if dname in ['r6.1','r6.2'] and act in ['email', 'file','http'] and '"' in lines[act]:
-            tmp = lines[act]
-            firstpart = tmp[:tmp.find('"')-1]
-            content = tmp[tmp.find('"')+1:-1]
-            tmp = firstpart.split(',') + [content]
-        else:
-            tmp = lines[act].split(',')
-        if time_convert(tmp[1], 't2wn', real_sd= firstdate) == week_index:
-            thisweek_act.append(tmp)
-        else:
-            break
-        lines[act] = act_handles[act].readline()
-    df = pd.DataFrame(thisweek_act, columns=columns)
-    df['type']= act
+    rows = pd.Series(lines).str.decode('utf-8')
+    # 最多切分为len(columns)列, 最后一列保留原始内容(包括换行符, 与逐行读取时一致,
+    # 后续的'Disconnect\n'匹配和内容长度特征都依赖这一点)
+    df = rows.str.split(',', n=len(columns)-1, expand=True)
+    df.columns = columns
+    if dname in ['r6.1','r6.2'] and act in ['email', 'file','http']:
+        # r6的内容字段可能带引号(内含逗号), 与原逐行解析一样去掉开头的引号和行尾字符
+        quoted = df[columns[-1]].str.startswith('"')
+        if quoted.any():
+            df.loc[quoted, columns[-1]] = df.loc[quoted, columns[-1]].str[1:-1]
+    df['date'] = pd.to_datetime(df['date'], format='%m/%d/%Y %H:%M:%S')
+    df['week'] = time_context(df['date'], week_start = firstdate)['week']
+    df['type'] = act
     df.index = df['id']
     df.drop('id', axis = 1, inplace = True)
     return df
 
-def combine_by_timerange_pandas(dname = 'r4.2', start_week=None, end_week=None):
+def read_activity_weeks(act, columns, firstdate, dname = 'r4.2', chunk_bytes = 64*1024*1024, byte_range = None):
+    """
+    分块读取一个活动CSV文件, 按周依次产出该周的全部活动
+    参数:
+    - act: 活动类型(device,email,file,http,logon)
+    - columns: 列名
+    - firstdate: 第0周开始日期(周日)
+    - dname: 数据集名称
+    - chunk_bytes: 每次读取的字节数(近似值), 决定内存占用上限
+    - byte_range: (start, end), 只读取起始位置在该字节范围内的行, None表示整个文件
+    产出: (周索引, 该周活动DataFrame, 该周第一行的字节偏移), 周索引递增
+    """
+    start, end = byte_range if byte_range is not None else (0, None)
+    n_rows = 0
+    t_read = 0.
+    pending_week, pending, pending_offset = None, [], None
+    with open(act+'.csv','rb') as handle:
+        if start == 0:
+            handle.readline() #skip header row
+        else: # 从start所在行的下一行开始, 该行属于前一个范围
+            handle.seek(start-1)
+            handle.readline()
+        pos = handle.tell()
+        while end is None or pos < end:
+            t0 = time.time()
+            lines = handle.readlines(chunk_bytes)
+            if not lines:
+                break
+            line_starts = pos + np.cumsum([0] + [len(l) for l in lines[:-1]])
+            if end is not None:
+                lines = lines[:np.searchsorted(line_starts, end)]
+            pos = handle.tell()
+            if not lines:
+                break
+            df = parse_activity_lines(lines, act, columns, firstdate, dname)
+            t_read += time.time() - t0
+            n_rows += len(df)
+            weeks = df['week'].values
+            bounds = np.concatenate([[0], np.flatnonzero(weeks[1:] != weeks[:-1]) + 1, [len(weeks)]])
+            for b in range(len(bounds)-1):
+                week_index = weeks[bounds[b]]
+                if pending_week is not None and week_index != pending_week:
+                    yield (pending_week, pd.concat(pending).drop('week', axis = 1), pending_offset)
+                    pending = []
+                if not pending:
+                    pending_offset = int(line_starts[bounds[b]])
+                pending_week = week_index
+                pending.append(df.iloc[bounds[b]:bounds[b+1]])
+    if pending_week is not None:
+        yield (pending_week, pd.concat(pending).drop('week', axis = 1), pending_offset)
+    part = f" [{start}, {end})" if byte_range is not None else ""
+    print(f"{act}.csv{part}: 共 {n_rows} 行, 读取解析耗时 {t_read:.1f} 秒 ({n_rows/max(t_read, 1e-6):.0f} 行/秒)")
+
+def load_week_offsets(act, firstdate):
+    """
+    读取活动文件的周字节偏移索引(<act>.weekidx.json)
+    返回: {周索引: 该周第一行的字节偏移}; 索引不存在或CSV文件已变化时返回None
+    """
+    path = act+'.weekidx.json'
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        idx = json.load(f)
+    stat = os.stat(act+'.csv')
+    if idx['size'] != stat.st_size or idx['mtime'] != stat.st_mtime or idx['firstdate'] != firstdate:
+        return None
+    return {int(w): o for w, o in idx['offsets'].items()}
+
+def save_week_offsets(act, firstdate, offsets):
+    """保存活动文件的周字节偏移索引, 与CSV文件放在同一目录"""
+    stat = os.stat(act+'.csv')
+    idx = {'size': stat.st_size, 'mtime': stat.st_mtime, 'firstdate': firstdate,
+           'offsets': {str(w): int(offsets[w]) for w in sorted(offsets)}}
+    with open(act+'.weekidx.json', 'w') as f:
+        json.dump(idx, f)
+
+def week_byte_range(offsets, act, start_week, end_week):
+    """由周偏移索引得到[start_week, end_week)各周所在的字节范围"""
+    size = os.path.getsize(act+'.csv')
+    start = min([o for w, o in offsets.items() if w >= start_week], default=size)
+    end = min([o for w, o in offsets.items() if w >= end_week], default=size)
+    return (start, max(start, end))
+
+def split_activity_files(allacts, n_parts, act_ranges = None):
+    """
+    按数据量把各活动文件切分为字节范围, 供并行读取
+    参数:
+    - allacts: 活动类型列表
+    - n_parts: 期望的范围总数
+    - act_ranges: {活动类型: (start, end)}, 每个文件需要读取的字节范围, None表示整个文件
+    返回: {活动类型: [(start, end), ...]}, 大文件(如http.csv)会被切分为多个范围
+    """
+    if act_ranges is None:
+        act_ranges = {act: (0, os.path.getsize(act+'.csv')) for act in allacts}
+    sizes = {act: act_ranges[act][1] - act_ranges[act][0] for act in allacts}
+    total = sum(sizes.values())
+    ranges = {}
+    for act in allacts:
+        n = max(1, int(round(n_parts * sizes[act] / max(total, 1))))
+        edges = np.linspace(act_ranges[act][0], act_ranges[act][1], n+1).astype(np.int64)
+        ranges[act] = [(int(edges[i]), int(edges[i+1])) for i in range(n)]
+    return ranges
+
+def spill_activity_weeks(act, part, byte_range, firstdate, dname = 'r4.2', target_weeks = None, chunk_bytes = 64*1024*1024):
+    """
+    并行读取的工作函数: 解析活动文件的一个字节范围, 把每周的数据写入分周临时文件
+    DataByWeek/spill/<act>_<part>_<week>.pickle
+    返回: {周索引: 该周在此范围内第一行的字节偏移}
+    """
+    columns = get_activity_columns(act, dname)
+    offsets = {}
+    for (week_index, df, offset) in read_activity_weeks(act, columns, firstdate, dname, chunk_bytes, byte_range):
+        offsets[int(week_index)] = offset
+        if target_weeks is None or week_index in target_weeks:
+            df.to_pickle(f"DataByWeek/spill/{act}_{part}_{week_index}.pickle")
+    return offsets
+
+def merge_week_spills(week_index, parts, dname = 'r4.2', storage = 'pickle'):
+    """把某一周各活动文件各字节范围的临时文件按顺序合并, 保存到DataByWeek/<week>"""
+    thisweek = []
+    for act in parts:
+        for part in range(len(parts[act])):
+            spill = f"DataByWeek/spill/{act}_{part}_{week_index}.pickle"
+            if os.path.exists(spill):
+                thisweek.append(pd.read_pickle(spill))
+                os.remove(spill)
+    save_week_activities(week_index, thisweek, dname, storage)
+
+def save_week_activities(week_index, thisweek, dname = 'r4.2', storage = 'pickle'):
+    """合并一周内各类活动的DataFrame并保存, 缺失的活动类型用空表补齐列"""
+    allacts =  ['device','email','file', 'http','logon']
+    empty = [pd.DataFrame(columns=get_activity_columns(act, dname)[1:] + ['type']).rename_axis('id') for act in allacts]
+    thisweekdf = pd.concat(empty + thisweek, sort=False)
+    thisweekdf['date'] = pd.to_datetime(thisweekdf['date'])
+    save_frame(thisweekdf, "DataByWeek/"+str(week_index), storage)
+    print(f"已处理并保存周 {week_index}")
+
+def combine_by_timerange_pandas(dname = 'r4.2', start_week=None, end_week=None, chunk_bytes = 64*1024*1024, n_jobs = 1, storage = 'pickle'):
     """
     按周合并所有类型的活动数据
     参数:
     - dname: 数据集名称
     - start_week: 开始周数（可选）
     - end_week: 结束周数（可选）
+    - chunk_bytes: 每个活动文件每次读取的字节数
+    - n_jobs: 并行进程数, 大于1时各活动文件(大文件按字节范围切分)由独立进程解析
+    - storage: DataByWeek的存储格式(pickle/parquet/feather)
     功能:
-    - 读取device,email,file,http,logon等活动数据
-    - 按周组织数据并保存到pickle文件
-    - 支持只处理指定周数范围的数据
+    - 分块读取device,email,file,http,logon等活动数据, 向量化解析时间并计算周索引
+    - 单进程: 五个文件均按时间排序, 按周做多路归并, 内存中只保留当前周的数据
+    - 多进程: 每个进程把解析结果写入分周临时文件, 最后按周合并
+    - 按周组织数据并保存到DataByWeek文件夹
+    - 支持只处理指定周数范围的数据: 第一次完整读取时为每个文件建立周字节偏移索引
+      (<act>.weekidx.json), 之后直接seek到所需的周并在end_week处停止读取
     """
 
     allacts =  ['device','email','file', 'http','logon']
     firstline = str(subprocess.check_output(['head', '-2', 'http.csv'])).split('\\n')[1]
     firstdate = time_convert(firstline.split(',')[1],'t2dt')
-    firstdate = firstdate - timedelta(int(firstdate.strftime("%w")))
+    firstdate = firstdate - timedelta(int(time_context([firstdate])['weekday'][0]))
     firstdate = time_convert(firstdate, 'dt2date')
-    week_index = 0
-    act_handles = {}
-    lines = {}
-    stop = {}
-    for act in allacts:
-        act_handles[act] = open(act+'.csv','r')
-        next(act_handles[act],None) #skip header row
-        lines[act] = act_handles[act].readline()
-        stop[act] = 0 # store stop value indicating if all of the file has been read
     
     # 如果指定了周数范围，只处理该范围内的数据
     target_weeks = None
@@ -137,48 +454,65 @@ def combine_by_timerange_pandas(dname = 'r4.2', start_week=None, end_week=None):
         target_weeks = set(range(start_week, end_week))
         print(f"只处理周数范围: {start_week} 到 {end_week-1}")
     
-    while sum(stop.values()) < 5:
-        # 如果指定了周数范围且当前周不在范围内，跳过数据但继续读取
+    # 已有周偏移索引的文件只读取所需周的字节范围, 没有索引的文件完整读取并建立索引
+    offsets = {act: load_week_offsets(act, firstdate) for act in allacts}
+    act_ranges = {}
+    for act in allacts:
+        if offsets[act] is not None and target_weeks is not None:
+            act_ranges[act] = week_byte_range(offsets[act], act, start_week, end_week)
+            print(f"{act}.csv: 使用周偏移索引, 读取字节范围 {act_ranges[act]}")
+        else:
+            act_ranges[act] = (0, os.path.getsize(act+'.csv'))
+    
+    if n_jobs > 1:
+        os.makedirs("DataByWeek/spill", exist_ok=True)
+        parts = split_activity_files(allacts, n_jobs, act_ranges)
+        tasks = [(act, part) for act in allacts for part in range(len(parts[act]))]
+        part_offsets = Parallel(n_jobs=n_jobs)(delayed(spill_activity_weeks)(act, part, parts[act][part], firstdate, dname, target_weeks, chunk_bytes) 
+                                               for (act, part) in tasks)
+        seen = {}
+        for ((act, part), o) in zip(tasks, part_offsets):
+            for w in o:
+                seen.setdefault(act, {})
+                seen[act][w] = min(seen[act].get(w, o[w]), o[w])
+        for act in allacts:
+            if offsets[act] is None:
+                save_week_offsets(act, firstdate, seen.get(act, {}))
+        last_week = max([max(o) for o in seen.values() if o], default=-1)
+        weeks = [w for w in range(last_week+1) if target_weeks is None or w in target_weeks]
+        Parallel(n_jobs=n_jobs)(delayed(merge_week_spills)(w, parts, dname, storage) for w in weeks)
+        os.rmdir("DataByWeek/spill")
+        return
+    
+    readers = {}
+    heads = {}
+    seen = {}
+    for act in allacts:
+        columns = get_activity_columns(act, dname)
+        readers[act] = read_activity_weeks(act, columns, firstdate, dname, chunk_bytes, act_ranges[act])
+        heads[act] = next(readers[act], None)
+        seen[act] = {}
+    
+    week_index = 0
+    while any(heads[act] is not None for act in allacts):
         should_process = target_weeks is None or week_index in target_weeks
         
-        thisweekdf = pd.DataFrame()
+        thisweek = []
         for act in allacts:
-            if 'email' == act:
-                if dname in ['r4.1','r4.2']:
-                    columns = ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'size', '#att', 'content']
-                if dname in ['r6.1','r6.2','r5.2','r5.1']:
-                    columns = ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'activity', 'size', 'att', 'content']     
-            elif 'logon' == act:
-                columns = ['id', 'date', 'user', 'pc', 'activity']
-            elif 'device' == act:
-                if dname in ['r4.1','r4.2']:
-                    columns = ['id', 'date', 'user', 'pc', 'activity']
-                if dname in ['r5.1','r5.2','r6.2','r6.1']:
-                    columns = ['id', 'date', 'user', 'pc', 'content', 'activity']
-            elif 'http' == act:
-                if dname in ['r6.1','r6.2']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'activity', 'content']
-                if dname in ['r5.1','r5.2','r4.2','r4.1']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'content']
-            elif 'file' == act:
-                if dname in ['r4.1','r4.2']: columns = ['id', 'date', 'user', 'pc', 'url/fname', 'content']
-                if dname in ['r5.2','r5.1','r6.2','r6.1']: columns = ['id', 'date', 'user', 'pc', 'url/fname','activity','to','from','content']
-            
-            df = add_action_thisweek(act, columns, lines, act_handles, week_index, stop, firstdate, dname=dname)
-            # thisweekdf = thisweekdf.append(df, sort=False)
-            if should_process:
-                thisweekdf = pd.concat([thisweekdf, df], sort=False, ignore_index=True) # 使用 pd.concat 替代 append
+            if heads[act] is not None and heads[act][0] == week_index:
+                thisweek.append(heads[act][1])
+                seen[act][week_index] = heads[act][2]
+                heads[act] = next(readers[act], None)
         
         # 只有在需要处理该周时才保存文件
         if should_process:
-            thisweekdf['date'] = thisweekdf['date'].apply(lambda x: datetime.strptime(x, "%m/%d/%Y %H:%M:%S"))
-            thisweekdf.to_pickle("DataByWeek/"+str(week_index)+".pickle")
-            print(f"已处理并保存周 {week_index}")
+            save_week_activities(week_index, thisweek, dname, storage)
         
         week_index += 1
-        
-        # 如果指定了结束周且已经超过，可以提前退出
-        if target_weeks is not None and week_index > max(target_weeks):
-            # 但是仍需要读取完所有文件，确保文件指针正确
-            pass
+    
+    for act in allacts:
+        if offsets[act] is None:
+            save_week_offsets(act, firstdate, seen[act])
 
 ##############################################################################
 
@@ -192,52 +526,60 @@ def process_user_pc(upd, roles): #figure out  which PC belongs to which user
     - 确定每个用户的主要PC
     - 识别共享PC
     - 处理IT管理员特殊情况
+    - 按(用户, PC)对整列计算: 使用多台PC的用户中, 每台PC被多少个这样的用户使用;
+      每个用户使用者最少的PC(相同时取列表中靠前的)为主要PC, 其余为共享PC
+    - IT管理员只确定主要PC, 不记录共享PC
     """
 
     upd['sharedpc'] = None
     upd['npc'] = upd['pcs'].apply(lambda x: len(x))
-    upd.at[upd['npc']==1,'pc'] = upd[upd['npc']==1]['pcs'].apply(lambda x: x[0])
-    multiuser_pcs = np.concatenate(upd[upd['npc']>1]['pcs'].values).tolist()
-    set_multiuser_pc = list(set(multiuser_pcs))
-    count = {}
-    for pc in set_multiuser_pc:
-        count[pc] = multiuser_pcs.count(pc)
-    for u in upd[upd['npc']>1].index:
-        sharedpc = upd.loc[u]['pcs']
-        count_u_pc = [count[pc] for pc in upd.loc[u]['pcs']]
-        the_pc = count_u_pc.index(min(count_u_pc))
-        upd.at[u,'pc'] = sharedpc[the_pc]
-        if roles.loc[u] != 'ITAdmin':
-            sharedpc.remove(sharedpc[the_pc])
-            upd.at[u,'sharedpc']= sharedpc
+    pc = pd.Series(np.nan, index = upd.index, dtype = object)
+    single = upd['npc'] == 1
+    pc[single] = upd.loc[single, 'pcs'].str[0]
+    
+    # 使用多台PC的用户的(用户, PC)对, 保持每个用户的PC列表顺序
+    multi = upd.loc[upd['npc'] > 1, 'pcs'].explode()
+    pairs = pd.DataFrame({'user': multi.index, 'pc': multi.values})
+    pairs['pos'] = pairs.groupby('user', sort = False).cumcount()
+    pairs['n_users'] = pairs['pc'].map(pairs['pc'].value_counts())
+    the_pc = pairs.sort_values(['n_users', 'pos'], kind = 'stable').drop_duplicates('user').set_index('user')
+    pc[the_pc.index] = the_pc['pc']
+    upd['pc'] = pc
+    
+    rest = pairs[pairs['pos'].values != the_pc.loc[pairs['user'], 'pos'].values]
+    rest = rest[(roles.loc[rest['user']] != 'ITAdmin').values]
+    sharedpc = rest.groupby('user', sort = False)['pc'].agg(list)
+    upd['sharedpc'] = sharedpc.reindex(upd.index).where(lambda x: x.notna(), None)
     return upd
 
-def getuserlist(dname = 'r4.2', psycho = True):
+def getuserlist(dname = 'r4.2', psycho = True, storage = 'pickle'):
     """
     获取用户列表及其属性
     参数:
     - dname: 数据集名称
     - psycho: 是否包含心理测量数据
+    - storage: DataByWeek的存储格式
     功能:
     - 读取LDAP用户信息
     - 处理用户离职信息
     - 合并心理测量数据(如果有)
     - 确定用户PC信息
+    - 主管和PC的推断按整列进行: 主管由用户名到用户ID的映射得到, 每个用户前两周使用过的PC由分组得到
     """
     allfiles =  ['LDAP/'+f1 for f1 in os.listdir('LDAP') if os.path.isfile('LDAP/'+f1)]
     alluser = {}
-    alreadyFired = []
+    alreadyFired = set()
     
     for file in allfiles:
-        af = (pd.read_csv(file,delimiter=',')).values
-        employeesThisMonth = []    
-        for i in range(len(af)):
-            employeesThisMonth.append(af[i][1])
-            if af[i][1] not in alluser:
-                alluser[af[i][1]] = af[i][0:1].tolist() + af[i][2:].tolist() + [file.split('.')[0] , np.nan]
-
-        firedEmployees = list(set(alluser.keys()) - set(alreadyFired) - set(employeesThisMonth))
-        alreadyFired = alreadyFired + firedEmployees
+        ldap = pd.read_csv(file,delimiter=',')
+        af = ldap.values
+        ids = ldap.iloc[:, 1]
+        # 每个用户只取第一次出现时的信息
+        for i in np.flatnonzero((~ids.isin(list(alluser.keys())) & ~ids.duplicated()).values):
+            alluser[af[i][1]] = af[i][0:1].tolist() + af[i][2:].tolist() + [file.split('.')[0] , np.nan]
+
+        firedEmployees = set(alluser.keys()) - alreadyFired - set(ids)
+        alreadyFired |= firedEmployees
         for e in firedEmployees:
             alluser[e][-1] = file.split('.')[0]
     
@@ -259,34 +601,34 @@ def getuserlist(dname = 'r4.2', psycho = True):
             df.columns = ['uname', 'email', 'role', 'project', 'b_unit', 'f_unit', 'dept', 'team', 'sup', 'wstart', 'wend']
 
     df['pc'] = None
-    for i in df.index:
-        if type(df.loc[i]['sup']) == str:
-            sup = df[df['uname'] == df.loc[i]['sup']].index[0]
-        else:
-            sup = None
-        df.at[i,'sup'] = sup
+    # 主管的用户名映射为用户ID(同名时取第一个用户)
+    uname_to_id = pd.Series(df.index, index = df['uname'].values)
+    uname_to_id = uname_to_id[~uname_to_id.index.duplicated()]
+    is_sup = df['sup'].apply(lambda x: type(x) == str)
+    df['sup'] = pd.Series([None]*len(df), index = df.index, dtype = object).mask(is_sup, df['sup'].map(uname_to_id))
         
     #read first 2 weeks to determine each user's PC
-    w1 = pd.read_pickle("DataByWeek/1.pickle")
-    w2 = pd.read_pickle("DataByWeek/2.pickle")
+    w1 = load_frame("DataByWeek/1", storage, columns=['user','pc'], index_col='id')
+    w2 = load_frame("DataByWeek/2", storage, columns=['user','pc'], index_col='id')
+    # 每个用户在两周中都使用过的PC, 按PC名排序: process_user_pc在使用者数量相同时取列表中靠前的PC,
+    # 排序后主要PC的选择不依赖集合的哈希顺序(PYTHONHASHSEED)
+    pcs1 = {u: set(pcs) for u, pcs in w1.groupby('user')['pc']}
+    pcs2 = {u: set(pcs) for u, pcs in w2.groupby('user')['pc']}
     user_pc_dict = pd.DataFrame(index=df.index)
-    user_pc_dict['pcs'] = None  
-  
-    for u in df.index:
-        pc = list(set(w1[w1['user']==u]['pc']) & set(w2[w2['user']==u]['pc']))
-        user_pc_dict.at[u,'pcs'] = pc
+    user_pc_dict['pcs'] = [sorted(pcs1.get(u, set()) & pcs2.get(u, set())) for u in df.index]
     upd = process_user_pc(user_pc_dict, df['role'])
     df['pc'] = upd['pc']
     df['sharedpc'] = upd['sharedpc']
     return df
 
         
-def get_mal_userdata(data = 'r4.2', usersdf = None):
+def get_mal_userdata(data = 'r4.2', usersdf = None, storage = 'pickle'):
     """
     获取恶意用户数据
     参数:
     - data: 数据集名称
     - usersdf: 用户数据框
+    - storage: DataByWeek的存储格式
     功能:
     - 读取内部威胁者信息
     - 标记恶意活动时间段
@@ -301,11 +643,11 @@ def get_mal_userdata(data = 'r4.2', usersdf = None):
     listmaluser['dataset'] = listmaluser['dataset'].apply(lambda x: str(x))
     listmaluser = listmaluser[listmaluser['dataset']==data.replace("r","")]
     #for r6.2, new time in scenario 4 answer is incomplete.
-    if data == 'r6.2': listmaluser.at[listmaluser['scenario']==4,'start'] = '02'+listmaluser[listmaluser['scenario']==4]['start']
+    if data == 'r6.2': listmaluser.loc[listmaluser['scenario']==4,'start'] = '02'+listmaluser[listmaluser['scenario']==4]['start']
     listmaluser[['start','end']] = listmaluser[['start','end']].applymap(lambda x: datetime.strptime(x, "%m/%d/%Y %H:%M:%S"))
     
     if type(usersdf) != pd.core.frame.DataFrame:
-        usersdf = getuserlist(data)
+        usersdf = getuserlist(data, storage = storage)
     usersdf['malscene']=0
     usersdf['mstart'] = None
     usersdf['mend'] = None
@@ -331,1046 +673,476 @@ def get_mal_userdata(data = 'r4.2', usersdf = None):
                     
     return usersdf
 
-##############################################################################
+# 用户表缓存的代码版本: 修改getuserlist/get_mal_userdata/process_user_pc后提高, 旧的缓存自动失效
+USERS_TABLE_VERSION = 2
 
-def is_after_whour(dt): #Workhours assumed 7:30-17:30
-    """判断是否在工作时间之后"""
-    wday_start = datetime.strptime("7:30", "%H:%M").time()
-    wday_end = datetime.strptime("17:30", "%H:%M").time()
-    dt = dt.time()
-    if dt < wday_start or dt > wday_end:
-        return True
-    return False
-      
-def is_weekend(dt):
-    """判断是否是周末"""
-    if dt.strftime("%w") in ['0', '6']:
-        return True
-    return False   
-    
-def email_process(act, data = 'r4.2', separate_send_receive = True):
-    """处理邮件活动特征"""
-    receivers = act['to'].split(';')
-    if type(act['cc']) == str:
-        receivers = receivers + act['cc'].split(";")
-    if type(act['bcc']) == str:
-        bccreceivers = act['bcc'].split(";")   
-    else:
-        bccreceivers = []
-    exemail = False
-    n_exdes = 0
-    for i in receivers + bccreceivers:
-        if 'dtaa.com' not in i:
-            exemail = True
-            n_exdes += 1
-
-    n_des = len(receivers) + len(bccreceivers)
-    Xemail = 1 if exemail else 0
-    n_bccdes = len(bccreceivers)
-    exbccmail = 0
-    email_text_len = len(act['content'])
-    email_text_nwords = act['content'].count(' ') + 1
-    for i in bccreceivers:
-        if 'dtaa.com' not in i:
-            exbccmail = 1
-            break
+def users_table_key(data = 'r4.2', storage = 'pickle'):
+    """
+    由用户表的全部输入文件计算缓存键
+    功能:
+    - 输入为LDAP/*、psychometric.csv、answers/下的所有文件以及用于推断PC的DataByWeek/1和2,
+      每个文件取路径、大小和修改时间(纳秒), 不读取文件内容
+    """
+    inputs = ['psychometric.csv'] + [storage_path(f"DataByWeek/{week}", storage) for week in [1, 2]]
+    for folder in ['LDAP', 'answers']:
+        for root, _, files in os.walk(folder):
+            inputs += [os.path.join(root, f) for f in files]
+    stats = [(f, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in sorted(inputs) if os.path.isfile(f)]
+    payload = json.dumps({'data': data, 'version': USERS_TABLE_VERSION, 'inputs': stats})
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
 
-    if data in ['r5.1','r5.2','r6.1','r6.2']:
-        send_mail = 1 if act['activity'] == 'Send' else 0
-        receive_mail = 1 if act['activity'] in ['Receive','View'] else 0
-        
-        atts = act['att'].split(';')
-        n_atts = len(atts)
-        size_atts = 0
-        att_types = [0,0,0,0,0,0]
-        att_sizes = [0,0,0,0,0,0]
-        for att in atts:
-            if '.' in att:
-                tmp = file_process(att, filetype='att')
-                att_types = [sum(x) for x in zip(att_types,tmp[0])]
-                att_sizes = [sum(x) for x in zip(att_sizes,tmp[1])]
-                size_atts +=sum(tmp[1])
-        return [send_mail, receive_mail, n_des, n_atts, Xemail, n_exdes, 
-                n_bccdes, exbccmail, int(act['size']), email_text_len, 
-                email_text_nwords] + att_types + att_sizes
-    elif data in ['r4.1','r4.2']:
-        return [n_des, int(act['#att']), Xemail, n_exdes, n_bccdes, exbccmail, 
-                int(act['size']), email_text_len, email_text_nwords]
-        
-def http_process(act, data = 'r4.2'): 
-    """处理HTTP活动特征"""
-    # basic features:
-    url_len = len(act['url/fname'])
-    url_depth = act['url/fname'].count('/')-2
-    content_len = len(act['content'])
-    content_nwords = act['content'].count(' ')+1
-    
-    domainname = re.findall("//(.*?)/", act['url/fname'])[0]
-    domainname.replace("www.","")
-    dn = domainname.split(".")
-    if len(dn) > 2 and not any([x in domainname for x in ["google.com", '.co.uk', '.co.nz', 'live.com']]):
-        domainname = ".".join(dn[-2:])
-
-    # other 1, socnet 2, cloud 3, job 4, leak 5, hack 6
-    if domainname in ['dropbox.com', 'drive.google.com', 'mega.co.nz', 'account.live.com']:
-        r = 3
-    elif domainname in ['wikileaks.org','freedom.press','theintercept.com']:
-        r = 5
-    elif domainname in ['facebook.com','twitter.com','plus.google.com','instagr.am','instagram.com',
-                        'flickr.com','linkedin.com','reddit.com','about.com','youtube.com','pinterest.com',
-                        'tumblr.com','quora.com','vine.co','match.com','t.co']:
-        r = 2
-    elif domainname in ['indeed.com','monster.com', 'careerbuilder.com','simplyhired.com']:
-        r = 4
-    
-    elif ('job' in domainname and ('hunt' in domainname or 'search' in domainname)) \
-    or ('aol.com' in domainname and ("recruit" in act['url/fname'] or "job" in act['url/fname'])):
-        r = 4
-    elif (domainname in ['webwatchernow.com','actionalert.com', 'relytec.com','refog.com','wellresearchedreviews.com',
-                         'softactivity.com', 'spectorsoft.com','best-spy-soft.com']):
-        r = 6
-    elif ('keylog' in domainname):
-        r = 6
-    else:
-        r = 1
-    if data in ['r6.1','r6.2']:
-        http_act_dict = {'www visit': 1, 'www download': 2, 'www upload': 3}
-        http_act = http_act_dict.get(act['activity'].lower(), 0)
-        return [r, url_len, url_depth, content_len, content_nwords, http_act]
-    else:
-        return [r, url_len, url_depth, content_len, content_nwords]
-        
-def file_process(act, complete_ul = None, data = 'r4.2', filetype = 'act'):
-    """处理文件活动特征"""
-    if filetype == 'act':
-        ftype = act['url/fname'].split(".")[1]
-        disk = 1 if act['url/fname'][0] == 'C' else 0
-        if act['url/fname'][0] == 'R': disk = 2
-        file_depth = act['url/fname'].count('\\')
-    elif filetype == 'att': #attachments
-        tmp = act.split('.')[1]
-        ftype = tmp[:tmp.find('(')]
-        attsize = int(tmp[tmp.find("(")+1:tmp.find(")")])
-        r = [[0,0,0,0,0,0], [0,0,0,0,0,0]]
-        if ftype in ['zip','rar','7z']:
-            ind = 1
-        elif ftype in ['jpg', 'png', 'bmp']:
-            ind = 2
-        elif ftype in ['doc','docx', 'pdf']:
-            ind = 3
-        elif ftype in ['txt','cfg', 'rtf']:
-            ind = 4
-        elif ftype in ['exe', 'sh']:
-            ind = 5
-        else:
-            ind = 0
-        r[0][ind] = 1
-        r[1][ind] = attsize
-        return r
-
-    fsize = len(act['content'])
-    f_nwords = act['content'].count(' ')+1
-    if ftype in ['zip','rar','7z']:
-        r = 2
-    elif ftype in ['jpg', 'png', 'bmp']:
-        r = 3
-    elif ftype in ['doc','docx', 'pdf']:
-        r = 4
-    elif ftype in ['txt','cfg','rtf']:
-        r = 5
-    elif ftype in ['exe', 'sh']:
-        r = 6
+def load_users_table(data = 'r4.2', storage = 'pickle'):
+    """
+    获取带恶意用户标记的用户表(get_mal_userdata的结果), 使用缓存
+    功能:
+    - 用户表以pickle保存为tmp/userstable_{data}_{键}.pickle, 键见users_table_key
+    - 输入文件都没有变化时直接读取, 不再重新读取LDAP、DataByWeek和answers
+    - 写入新的用户表后删除该数据集旧键的用户表文件, tmp中每个数据集只保留一份
+    """
+    cache_file = f"tmp/userstable_{data}_{users_table_key(data, storage)}.pickle"
+    if os.path.exists(cache_file):
+        print(f"使用缓存的用户表: {cache_file}")
+        return pd.read_pickle(cache_file)
+    users = get_mal_userdata(data, storage = storage)
+    users.to_pickle(cache_file)
+    prefix = f"userstable_{data}_"
+    for f in os.listdir("tmp"):
+        if f.startswith(prefix) and f.endswith(".pickle") and os.path.join("tmp", f) != cache_file:
+            os.remove(os.path.join("tmp", f))
+    return users
+
+def select_users(users, max_users = None, seed = 42):
+    """
+    按最大用户数选择用户子集
+    参数:
+    - users: 用户信息数据框(get_mal_userdata的结果)
+    - max_users: 最大用户数, None或不少于用户总数时返回全部用户
+    - seed: 选择正常用户的随机种子
+    返回:
+    - 选中的用户: 所有恶意用户在前, 之后是随机选择的正常用户
+    功能:
+    - 总是保留所有恶意用户, 剩余名额用固定的随机种子从正常用户中选择, 不同运行选中相同的用户
+    """
+    if not max_users or len(users) <= max_users:
+        return users
+    malicious_users = users[users['malscene'] > 0].index.tolist()
+    normal_users = users[users['malscene'] == 0].index.tolist()
+    
+    # 计算需要的正常用户数量
+    remaining_slots = max_users - len(malicious_users)
+    if remaining_slots > 0:
+        # 随机选择正常用户
+        np.random.seed(seed)  # 设置随机种子以保证可重复性
+        selected_normal_users = np.random.choice(normal_users, 
+                                               size=min(remaining_slots, len(normal_users)), 
+                                               replace=False).tolist()
     else:
-        r = 1
-    if data in ['r5.2','r5.1', 'r6.2','r6.1']:
-        to_usb = 1 if act['to'] == 'True' else 0
-        from_usb = 1 if act['from'] == 'True' else 0
-        file_depth = act['url/fname'].count('\\')
-        file_act_dict = {'file open': 1, 'file copy': 2, 'file write': 3, 'file delete': 4}
-        if act['activity'].lower() not in file_act_dict: print(act['activity'].lower())
-        file_act = file_act_dict.get(act['activity'].lower(), 0)
-        return [r, fsize, f_nwords, disk, file_depth, file_act, to_usb, from_usb]
-    elif data in ['r4.1','r4.2']:
-        return [r, fsize, f_nwords, disk, file_depth]
+        selected_normal_users = []
+    return users.loc[malicious_users + selected_normal_users]
 
-def from_pc(act, ul):
+##############################################################################
+
+# 各类活动在NumDataByWeek中的编码: 1:登录, 2:登出, 3:设备连接, 4:设备断开, 5:HTTP访问, 6:邮件, 7:文件操作
+ACT_CODES = {'logon':1, 'logoff':2, 'connect':3, 'disconnect':4, 'http':5, 'email':6, 'file':7}
+
+# 文件扩展名到文件类型的编码(文件活动中未列出的类型为1, 邮件附件中为0)
+FILE_TYPE_CODES = {'zip':2, 'rar':2, '7z':2, 'jpg':3, 'png':3, 'bmp':3, 'doc':4, 'docx':4, 'pdf':4,
+                   'txt':5, 'cfg':5, 'rtf':5, 'exe':6, 'sh':6}
+
+def build_user_lookup(users):
     """
-    判断用户活动发生在什么类型的电脑上
+    把用户信息表转换为整数编码的查找表
     参数:
-    - act: 用户活动数据
-    - ul: 用户列表数据
+    - users: 用户信息数据框(get_mal_userdata的结果)
     返回:
-    - 电脑类型代码(0-3)和电脑ID
+    - 字典, 包含:
+      users: 用户ID(按users.index的顺序, 位置即用户编码), pcs: PC ID(位置即PC编码)
+      own_pc, sup_pc: 每个用户自己的PC和主管的PC的编码(没有则为-1)
+      shared: 共享PC的(用户编码*PC数+PC编码), 已排序
+      malscene, mstart, mend: 恶意场景编号和恶意活动时间窗口
+      malacts: 恶意用户编码到恶意活动ID集合的字典
+    """
+    shared_lists = [pcs if isinstance(pcs, list) else [] for pcs in users['sharedpc']]
+    pcs = pd.Index(pd.unique(np.array([pc for pc in users['pc'] if isinstance(pc, str)] + 
+                                      [pc for l in shared_lists for pc in l], dtype=object)))
+    own_pc = pcs.get_indexer(users['pc'])
+    sup = users.index.get_indexer(users['sup'])
+    sup_pc = np.where(sup >= 0, own_pc[sup], -1)
+    shared = np.unique(np.array([i*len(pcs) + pc for i, l in enumerate(shared_lists) for pc in pcs.get_indexer(l)], dtype=np.int64))
+    
+    malscene = users['malscene'].fillna(0).astype(int).values if 'malscene' in users else np.zeros(len(users), dtype=int)
+    mal = np.flatnonzero(malscene > 0)
+    return {'users': users.index.values.astype(object), 'pcs': pcs.values, 'own_pc': own_pc, 'sup_pc': sup_pc, 'shared': shared,
+            'malscene': malscene,
+            'mstart': pd.to_datetime(users['mstart']).values if 'mstart' in users else np.full(len(users), np.datetime64('NaT')),
+            'mend': pd.to_datetime(users['mend']).values if 'mend' in users else np.full(len(users), np.datetime64('NaT')),
+            'malacts': {i: set(users['malacts'].iloc[i]) if users['malacts'].iloc[i] is not None else set() for i in mal}}
+
+def load_user_lookup(users):
+    """
+    返回用户查找表
+    参数:
+    - users: 用户信息数据框, 或者用joblib.dump保存的查找表文件路径(以只读内存映射方式加载, 可在多个进程间共享)
+    """
+    if isinstance(users, str):
+        return joblib.load(users, mmap_mode='r')
+    return build_user_lookup(users)
+
+def pc_category(user_codes, pc_codes, lookup):
+    """
+    按列判断用户活动发生在什么类型的电脑上
+    参数:
+    - user_codes: 活动用户的编码
+    - pc_codes: 活动PC的编码(不在查找表中的PC为-1)
+    - lookup: 用户查找表
+    返回:
+    - 电脑类型代码(0-3)
     - 0: 用户自己的电脑
     - 1: 共享电脑
     - 2: 他人的电脑
     - 3: 主管的电脑
     """
-    user_pc = ul.loc[act['user']]['pc']
-    act_pc = act['pc']
-    if act_pc == user_pc:
-        return (0, act_pc) #using normal PC
-    elif ul.loc[act['user']]['sharedpc'] is not None and act_pc in ul.loc[act['user']]['sharedpc']:
-        return (1, act_pc)
-    elif ul.loc[act['user']]['sup'] is not None and act_pc == ul.loc[ul.loc[act['user']]['sup']]['pc']:
-        return (3, act_pc)
-    else:
-        return (2, act_pc)
-    
-def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = None):
+    known = pc_codes >= 0
+    own = known & (lookup['own_pc'][user_codes] == pc_codes)
+    shared = known & np.isin(user_codes.astype(np.int64)*len(lookup['pcs']) + pc_codes, lookup['shared'])
+    sup = known & (lookup['sup_pc'][user_codes] == pc_codes)
+    return np.select([own, shared, sup], [0, 1, 3], 2)
+
+def n_pieces(col):
+    """按';'分隔的字段中的项数, 非字符串(缺失)记为0"""
+    return (col.str.count(';') + 1).fillna(0).values
+
+def n_external(col):
+    """按';'分隔的字段中不包含dtaa.com的项数"""
+    return n_pieces(col) - col.str.count(r'(?:^|;)[^;]*?dtaa\.com').fillna(0).values
+
+def attachment_features(att):
     """
-    处理一周内的用户活动数据,转换为数值特征
-    
-    这个函数是特征提取的核心部分，它将原始的用户活动数据（登录、文件操作、邮件、HTTP访问等）
-    转换为机器学习可以使用的数值特征向量。
-    
+    处理邮件附件特征
     参数:
-    - week: 周数索引，用于读取对应周的数据文件
-    - users: 用户信息数据框，包含用户属性和恶意用户标记
-    - userlist: 要处理的用户列表，默认'all'表示处理所有用户
-    - data: 数据集名称(r4.2, r5.2等)，不同数据集的特征维度不同
-    - config_id: 配置标识符，用于区分不同参数的运行
-    
+    - att: 邮件的附件字段, 附件之间以';'分隔, 每个附件形如"路径.扩展名(大小)"
+    返回:
+    - (n, 6)的附件类型计数和(n, 6)的附件类型大小, 类型顺序为other, comp, pho, doc, txt, exe
+    """
+    att_types = np.zeros((len(att), 6))
+    att_sizes = np.zeros((len(att), 6))
+    atts = att.reset_index(drop=True).str.split(';').explode()
+    atts = atts[atts.str.contains('.', regex=False, na=False)]
+    parts = atts.str.split('.').str[1].str.extract(r'^([^(]*)\(([^)]*)\)')
+    ind = parts[0].map(FILE_TYPE_CODES).fillna(1).astype(int).values - 1
+    np.add.at(att_types, (atts.index.values, ind), 1)
+    np.add.at(att_sizes, (atts.index.values, ind), parts[1].astype(int).values)
+    return att_types, att_sizes
+
+def email_features(acts, data = 'r4.2'):
+    """
+    按列计算邮件活动特征
+    参数:
+    - acts: 一周内的邮件活动
+    - data: 数据集名称
+    返回:
+    - 邮件特征矩阵, 列顺序与get_num_columns中的邮件特征一致
     功能:
-    - 读取一周的活动数据（从DataByWeek文件夹）
-    - 将每种活动类型转换为对应的数值特征
-    - 标记恶意活动和内部威胁用户
-    - 保存处理后的数值数据到NumDataByWeek文件夹
-    
-    输出:
-    - 生成包含数值特征的pickle文件，用于后续的统计特征计算
+    - 收件人数量按';'分隔计数(空的cc/bcc字段也算一项), 不含dtaa.com的收件人记为外部收件人
+    - r5/r6版本增加收发标记和12个附件类型/大小计数
     """
+    n_to, n_cc, n_bcc = n_pieces(acts['to']), n_pieces(acts['cc']), n_pieces(acts['bcc'])
+    n_bccex = n_external(acts['bcc'])
+    n_exdes = n_external(acts['to']) + n_external(acts['cc']) + n_bccex
+    n_des = n_to + n_cc + n_bcc
+    Xemail = (n_exdes > 0).astype(int)
+    exbccmail = (n_bccex > 0).astype(int)
+    email_size = acts['size'].astype(int).values
+    email_text_len = acts['content'].str.len().values
+    email_text_nwords = acts['content'].str.count(' ').values + 1
     
-    # ========== 1. 初始化和数据准备 ==========
-    # 创建用户ID到索引的映射字典，用于后续快速查找
-    user_dict = {idx: i for (i, idx) in enumerate(users.index)}
-    
-    # 读取指定周的活动数据（之前由combine_by_timerange_pandas生成）
-    acts_week = pd.read_pickle("DataByWeek/"+str(week)+".pickle")
-    
-    # 获取该周的时间范围，用于判断恶意活动时间窗口
-    start_week, end_week = min(acts_week.date), max(acts_week.date)
-    
-    # 按时间排序，确保活动按时间顺序处理（对于connect/disconnect配对很重要）
-    acts_week.sort_values('date', ascending = True, inplace = True)
-    
-    # ========== 2. 确定特征维度 ==========
-    # 根据不同数据集版本设置特征向量的维度
-    # r5.x版本有45列，r6.x版本有46列（多了HTTP活动类型），r4.x版本只有27列
-    n_cols = 45 if data in ['r5.2','r5.1'] else 46
-    if data in ['r4.2','r4.1']: n_cols = 27
-    
-    # 初始化存储所有用户该周活动特征的矩阵
-    u_week = np.zeros((len(acts_week), n_cols))
-    
-    # 存储每个活动的元信息：[活动ID, PC ID, 时间戳]
-    pc_time = []
-    
-    # 如果没有指定用户列表，则处理该周所有活跃用户
-    if userlist == 'all':
-        userlist = set(acts_week.user)
-    
-    # 确保只处理在用户信息表中存在的用户，避免KeyError
-    userlist = [u for u in userlist if u in users.index]
-    
-    if not userlist:
-        print(f"警告: 周 {week} 没有有效的用户数据")
-        # 创建空的DataFrame保存
-        empty_df = pd.DataFrame(columns=['actid','pcid','time_stamp'] + ['user','day','act','pc','time'] + 
-                               ['usb_dur'] + (['file_tree_len'] if data not in ['r4.2','r4.1'] else []) +
-                               ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth'] + 
-                               (['file_act', 'to_usb', 'from_usb'] if data not in ['r4.2','r4.1'] else []) +
-                               ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords'] + 
-                               (['http_act'] if data in ['r6.2','r6.1'] else []) +
-                               (['send_mail', 'receive_mail'] if data not in ['r4.2','r4.1'] else []) +
-                               ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords'] +
-                               (['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe',
-                                 'e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe'] if data not in ['r4.2','r4.1'] else []) +
-                               ['mal_act','insider'])
-        empty_df.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
-        return
-    
-    # ========== 3. 按用户循环处理活动数据 ==========
-    current_ind = 0  # 当前在总矩阵中的行索引
-    
-    for u in userlist:
-        # 提取当前用户在该周的所有活动
-        df_acts_u = acts_week[acts_week.user == u]
-        
-        # ========== 3.1 判断用户是否为恶意用户 ==========
-        mal_u = 0  # 初始化为正常用户
-        # 如果用户在恶意用户列表中（malscene > 0表示参与了某个恶意场景）
-        if users.loc[u].malscene > 0:
-            # 检查当前周是否在该用户的恶意活动时间窗口内
-            if start_week <= users.loc[u].mend and users.loc[u].mstart <= end_week:
-                mal_u = users.loc[u].malscene  # 记录恶意场景编号
-        
-        # ========== 3.2 活动类型标准化和映射 ==========
-        # 获取所有活动类型（来自type列）
-        list_uacts = df_acts_u.type.tolist()
-        
-        # 获取活动的具体操作（来自activity列，主要用于设备连接操作）
-        list_activity = df_acts_u.activity.tolist()
-        
-        # 对于设备相关活动，将activity列的值转换为小写并标准化
-        # 这里处理Logon/Logoff/Connect/Disconnect等设备操作
-        list_uacts = [list_activity[i].strip().lower() if (type(list_activity[i])==str and list_activity[i].strip() in ['Logon', 'Logoff', 'Connect', 'Disconnect']) \
-                        else list_uacts[i] for i in range(len(list_uacts))]
-        
-        # 将活动类型映射为数值编码
-        # 1:登录, 2:登出, 3:设备连接, 4:设备断开, 5:HTTP访问, 6:邮件, 7:文件操作
-        uacts_mapping = {'logon':1, 'logoff':2, 'connect':3, 'disconnect':4, 'http':5,'email':6,'file':7}
-        list_uacts_num = [uacts_mapping[x] for x in list_uacts]
-
-        # 初始化当前用户的特征矩阵
-        oneu_week = np.zeros((len(df_acts_u), n_cols))
-        oneu_pc_time = []  # 存储当前用户的活动元信息
-        
-        # ========== 3.3 逐个活动处理 ==========
-        for i in range(len(df_acts_u)):
-            # ========== 3.3.1 确定活动发生的PC类型 ==========
-            # 调用from_pc函数判断活动发生在什么类型的电脑上
-            # 返回值：0=自己的PC, 1=共享PC, 2=他人的PC, 3=主管的PC
-            pc, _ = from_pc(df_acts_u.iloc[i], users)
-            
-            # ========== 3.3.2 确定活动发生的时间类型 ==========
-            # 根据是否为周末和是否为工作时间，将时间分为4类
-            if is_weekend(df_acts_u.iloc[i]['date']):
-                if is_after_whour(df_acts_u.iloc[i]['date']):
-                    act_time = 4  # 周末非工作时间
-                else:
-                    act_time = 3  # 周末工作时间
-            elif is_after_whour(df_acts_u.iloc[i]['date']):
-                act_time = 2  # 工作日非工作时间
-            else:
-                act_time = 1  # 工作日工作时间
-            
-            # ========== 3.3.3 初始化各类活动的特征向量 ==========
-            # 根据数据集版本初始化不同维度的特征向量
-            if data in ['r4.2','r4.1']:
-                device_f = [0]              # 设备特征：USB连接时长
-                file_f = [0, 0, 0, 0, 0]    # 文件特征：类型、大小、词数、磁盘、深度
-                http_f = [0,0,0,0,0]        # HTTP特征：类型、URL长度、深度、内容长度、词数
-                email_f = [0]*9             # 邮件特征：9维
-            elif data in ['r5.2','r5.1','r6.2','r6.1']:
-                device_f = [0,0]            # 设备特征：USB连接时长、文件树长度
-                file_f = [0]*8              # 文件特征：8维（增加了USB传输标记）
-                http_f = [0,0,0,0,0]        # HTTP特征：5维基础特征
-                if data in ['r6.2','r6.1']:
-                    http_f = [0,0,0,0,0,0]  # r6版本增加了HTTP活动类型
-                email_f = [0]*23            # 邮件特征：23维（增加了附件相关特征）
-            
-            # ========== 3.3.4 根据活动类型提取具体特征 ==========
-            if list_uacts[i] == 'file':
-                # 文件操作：提取文件类型、大小、深度等特征
-                file_f = file_process(df_acts_u.iloc[i], data = data)
-                
-            elif list_uacts[i] == 'email':
-                # 邮件活动：提取收件人数量、附件、外部邮件等特征
-                email_f = email_process(df_acts_u.iloc[i], data = data)
-                
-            elif list_uacts[i] == 'http':
-                # HTTP访问：提取URL类型、长度、内容等特征
-                http_f = http_process(df_acts_u.iloc[i], data=data)
-                
-            elif list_uacts[i] == 'connect':
-                # ========== 设备连接：需要特殊处理，计算连接持续时间 ==========
-                # 从当前活动开始，向后查找对应的断开连接活动
-                tmp = df_acts_u.iloc[i:]
-                
-                # 查找同一用户在同一PC上的断开连接活动
-                disconnect_acts = tmp[(tmp['activity'] == 'Disconnect\n') & \
-                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
-                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
-                
-                # 查找同一用户在同一PC上的后续连接活动（用于处理异常情况）
-                connect_acts = tmp[(tmp['activity'] == 'Connect\n') & \
-                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
-                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
-                
-                # 计算连接持续时间
-                if len(disconnect_acts) > 0:
-                    distime = disconnect_acts.iloc[0]['date']
-                    # 如果在断开之前又有连接，说明数据异常
-                    if len(connect_acts) > 0 and connect_acts.iloc[0]['date'] < distime:
-                        connect_dur = -1  # 标记为异常
-                    else:
-                        # 计算正常的连接持续时间（以秒为单位）
-                        tmp_td = distime - df_acts_u.iloc[i]['date']
-                        connect_dur = tmp_td.days*24*3600 + tmp_td.seconds
-                else:
-                    connect_dur = -1  # 没有找到断开连接活动，标记为异常
-                    
-                # 根据数据集版本设置设备特征
-                if data in ['r5.2','r5.1','r6.2','r6.1']:
-                    # 新版本增加了文件树长度特征
-                    file_tree_len = len(df_acts_u.iloc[i]['content'].split(';'))
-                    device_f = [connect_dur, file_tree_len]
-                else:
-                    device_f = [connect_dur]
-                
-            # ========== 3.3.5 检查是否为恶意活动 ==========
-            is_mal_act = 0
-            # 如果用户是恶意用户，且当前活动ID在恶意活动列表中
-            if mal_u > 0 and df_acts_u.index[i] in users.loc[u]['malacts']:
-                is_mal_act = 1
-
-            # ========== 3.3.6 组装完整的特征向量 ==========
-            # 特征向量组成：[用户ID, 天数, 活动类型, PC类型, 时间类型] + 各类活动特征 + [恶意活动标记, 内部威胁场景]
-            oneu_week[i,:] = [ user_dict[u], time_convert(df_acts_u.iloc[i]['date'], 'dt2dn'), list_uacts_num[i], pc, act_time] \
-            + device_f + file_f + http_f + email_f + [is_mal_act, mal_u]
-
-            # 保存活动的元信息：[活动索引, PC ID, 时间戳]
-            oneu_pc_time.append([df_acts_u.index[i], df_acts_u.iloc[i]['pc'], df_acts_u.iloc[i]['date']])
-            
-        # ========== 3.4 将当前用户的数据添加到总矩阵中 ==========
-        u_week[current_ind:current_ind+len(oneu_week),:] = oneu_week
-        pc_time += oneu_pc_time
-        current_ind += len(oneu_week)
-    
-    # ========== 4. 数据后处理和保存 ==========
-    # 截取实际使用的行数（去除初始化时的多余行）
-    u_week = u_week[0:current_ind, :]
-    
-    # ========== 4.1 定义列名 ==========
-    # 基础列：用户、天数、活动类型、PC类型、时间类型
-    col_names = ['user','day','act','pc','time']
-    
-    # 根据数据集版本定义各类特征的列名
-    if data in ['r4.1','r4.2']:
-        device_feature_names = ['usb_dur']  # 设备特征：USB持续时间
-        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth']
-        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
-        email_feature_names = ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
-    elif data in ['r5.2','r5.1', 'r6.2','r6.1']:
-        device_feature_names = ['usb_dur', 'file_tree_len']  # 增加文件树长度
-        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth', 'file_act', 'to_usb', 'from_usb']  # 增加USB传输特征
-        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
-        if data in ['r6.2','r6.1']:
-            http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords', 'http_act']  # r6版本增加HTTP活动类型
-        # 邮件特征大幅增加，包含发送/接收标记和各种附件特征
-        email_feature_names = ['send_mail', 'receive_mail','n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
-        # 附件类型特征：压缩包、图片、文档、文本、可执行文件
-        email_feature_names += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
-        # 附件大小特征：对应各种类型附件的总大小
-        email_feature_names += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe']     
-        
-    # 组合所有列名
-    col_names = col_names + device_feature_names + file_feature_names+ http_feature_names + email_feature_names + ['mal_act','insider']
-    
-    # ========== 4.2 创建最终的DataFrame ==========
-    # 包含元信息列和特征列
-    df_u_week = pd.DataFrame(columns=['actid','pcid','time_stamp'] + col_names, index = np.arange(0,len(pc_time)))
-    
-    # 填充元信息
-    df_u_week[['actid','pcid','time_stamp']] = np.array(pc_time)
-    
-    # 填充特征数据并转换为整数类型（除了时间戳）
-    df_u_week[col_names] = u_week
-    df_u_week[col_names] = df_u_week[col_names].astype(int)
-    
-    # ========== 4.3 保存处理结果 ==========
-    # 将处理后的数值特征保存到NumDataByWeek文件夹
-    # 这些文件将被后续的统计特征计算函数使用
-    df_u_week.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
+    if data in ['r5.1','r5.2','r6.1','r6.2']:
+        send_mail = (acts['activity'] == 'Send').astype(int).values
+        receive_mail = acts['activity'].isin(['Receive','View']).astype(int).values
+        n_atts = n_pieces(acts['att'])
+        att_types, att_sizes = attachment_features(acts['att'])
+        return np.column_stack([send_mail, receive_mail, n_des, n_atts, Xemail, n_exdes, 
+                                n_bcc, exbccmail, email_size, email_text_len, 
+                                email_text_nwords, att_types, att_sizes])
+    elif data in ['r4.1','r4.2']:
+        return np.column_stack([n_des, acts['#att'].astype(int).values, Xemail, n_exdes, n_bcc, exbccmail, 
+                                email_size, email_text_len, email_text_nwords])
 
-##############################################################################
+# 网站类型: other 1, socnet 2, cloud 3, job 4, leak 5, hack 6
+# 按顺序匹配: 每一类先查domains(完整域名), 再查patterns(域名正则); url_rules表示域名包含某个字符串
+# 且URL匹配正则时也归为该类. 可在数据目录下放置domain_categories.json(格式相同)来增加域名或类别
+DOMAIN_CATEGORIES = {
+    'cloud': {'code': 3, 'domains': ['dropbox.com', 'drive.google.com', 'mega.co.nz', 'account.live.com']},
+    'leak': {'code': 5, 'domains': ['wikileaks.org','freedom.press','theintercept.com']},
+    'socnet': {'code': 2, 'domains': ['facebook.com','twitter.com','plus.google.com','instagr.am','instagram.com',
+                                      'flickr.com','linkedin.com','reddit.com','about.com','youtube.com','pinterest.com',
+                                      'tumblr.com','quora.com','vine.co','match.com','t.co']},
+    'job': {'code': 4, 'domains': ['indeed.com','monster.com', 'careerbuilder.com','simplyhired.com'],
+            'patterns': ['^(?=.*job)(?=.*(hunt|search))'], 'url_rules': {'aol.com': 'recruit|job'}},
+    'hack': {'code': 6, 'domains': ['webwatchernow.com','actionalert.com', 'relytec.com','refog.com','wellresearchedreviews.com',
+                                    'softactivity.com', 'spectorsoft.com','best-spy-soft.com'],
+             'patterns': ['keylog']},
+}
+# 包含这些字符串的域名保留全部层级, 其他多级域名只保留最后两级
+KEEP_SUBDOMAINS = ["google.com", '.co.uk', '.co.nz', 'live.com']
 
-# return sessions for each user in a week:
-# sessions[sid] = [sessionid, pc, start_with, end_with, start time, end time,number_of_concurent_login, [action_indices]]
-# start_with: in the beginning of a week, action start with log in or not (1, 2)
-# end_with: log off, next log on same computer (1, 2)
-def get_sessions(uw, first_sid = 0):
+domain_classifiers = {}
+
+def load_domain_categories(path = 'domain_categories.json'):
     """
-    从用户活动数据中提取会话信息
+    读取网站类别配置
     参数:
-    - uw: 用户活动数据
-    - first_sid: 起始会话ID
+    - path: JSON配置文件路径, 不存在时只使用DOMAIN_CATEGORIES
     返回:
-    - sessions: 会话字典,包含:
-      - 会话ID
-      - 电脑ID
-      - 开始方式(1=登录开始,2=其他方式开始)
-      - 结束方式(1=登出结束,2=下一次登录结束)
-      - 开始时间
-      - 结束时间
-      - 并发登录数
-      - 活动索引列表
-    """
-    sessions = {}
-    open_sessions = {}
-    sid = 0
-    current_pc = uw.iloc[0]['pcid']
-    start_time = uw.iloc[0]['time_stamp']
-    if uw.iloc[0]['act'] == 1:
-        open_sessions[current_pc] = [current_pc, 1, 0, start_time, start_time, 1, [uw.index[0]]]
-    else:
-        open_sessions[current_pc] = [current_pc, 2, 0, start_time, start_time, 1, [uw.index[0]]]
-
-    for i in uw.index[1:]:
-        current_pc = uw.loc[i]['pcid']
-        if current_pc in open_sessions: # must be already a session with that pcid
-            if uw.loc[i]['act'] == 2:
-                open_sessions[current_pc][2] = 1
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-                sessions[sid] = [first_sid+sid] + open_sessions.pop(current_pc)
-                sid +=1
-            elif uw.loc[i]['act'] == 1:
-                open_sessions[current_pc][2] = 2
-                sessions[sid] = [first_sid+sid] + open_sessions.pop(current_pc)
-                sid +=1
-                #create a new open session
-                open_sessions[current_pc] = [current_pc, 1, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-                if len(open_sessions) > 1: #increase the concurent count for all sessions
-                    for k in open_sessions:
-                        open_sessions[k][5] +=1
-            else:
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-        else:
-            start_status = 1 if uw.loc[i]['act'] == 1 else 2
-            open_sessions[current_pc] = [current_pc, start_status, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-            if len(open_sessions) > 1: #increase the concurent count for all sessions
-                for k in open_sessions:
-                    open_sessions[k][5] +=1
-    return sessions
-                
-def get_u_features_dicts(ul, data = 'r5.2'):
-    """获取用户特征字典"""
-    ufdict = {}
-    list_uf=[] if data in ['r4.1','r4.2'] else ['project']
-    list_uf += ['role','b_unit','f_unit', 'dept','team']
-    for f in list_uf:
-        ul[f] = ul[f].astype(str)
-        tmp = list(set(ul[f]))
-        tmp.sort()
-        ufdict[f] = {idx:i for i, idx in enumerate(tmp)}
-    return (ul,ufdict, list_uf)
-
-def proc_u_features(uf, ufdict, list_f = None, data = 'r4.2'): #to remove mode
-    """处理用户特征"""
-    if type(list_f) != list:
-        list_f=[] if data in ['r4.1','r4.2'] else ['project']
-        list_f = ['role','b_unit','f_unit', 'dept','team'] + list_f
+    - 类别字典; 配置文件中已有类别的domains/patterns/url_rules会追加到默认列表中, 新类别需要给出code
+    """
+    categories = {name: dict(cat) for name, cat in DOMAIN_CATEGORIES.items()}
+    if os.path.isfile(path):
+        with open(path) as f:
+            extra = json.load(f)
+        for name, cat in extra.items():
+            base = categories.setdefault(name, {})
+            base['code'] = cat.get('code', base.get('code'))
+            base['domains'] = base.get('domains', []) + cat.get('domains', [])
+            base['patterns'] = base.get('patterns', []) + cat.get('patterns', [])
+            base['url_rules'] = {**base.get('url_rules', {}), **cat.get('url_rules', {})}
+    return categories
 
-    out = []
-    for f in list_f:
-        out.append(ufdict[f][uf[f]])
-    return out
+def get_domain_classifier(path = 'domain_categories.json'):
+    """
+    返回编译好的域名分类器(按配置文件路径和修改时间缓存)
+    分类器包含: 域名到(类型, 优先级)的字典, 每类编译好的域名正则, 带优先级的URL规则, 以及已分类域名的缓存
+    """
+    key = (path, os.path.getmtime(path) if os.path.isfile(path) else None)
+    if key not in domain_classifiers:
+        categories = load_domain_categories(path)
+        exact, patterns, url_rules = {}, [], []
+        for rank, cat in enumerate(categories.values()):
+            for d in cat.get('domains', []):
+                exact.setdefault(d, (cat['code'], rank))
+            if cat.get('patterns'):
+                patterns.append((rank, re.compile('|'.join(f'(?:{p})' for p in cat['patterns'])), cat['code']))
+            for s, p in cat.get('url_rules', {}).items():
+                url_rules.append((rank, s, re.compile(p), cat['code']))
+        url_rules.sort(key=lambda x: x[0])
+        domain_classifiers[key] = {'exact': exact, 'patterns': patterns, 'url_rules': url_rules,
+                                   'other': (1, len(categories)), 'cache': {}}
+    return domain_classifiers[key]
 
-def f_stats_calc(ud, fn, stats_f, countonly_f = {}, get_stats = False):
-    """计算特征统计信息"""
-    f_count = len(ud)
-    r = []
-    f_names = []
-    
-    for f in stats_f:
-        inp = ud[f].values
-        if get_stats:
-            if f_count > 0:
-                r += [np.min(inp), np.max(inp), np.median(inp), np.mean(inp), np.std(inp)]
-            else: r += [0, 0, 0, 0, 0]
-            f_names += [fn+'_min_'+f, fn+'_max_'+f, fn+'_med_'+f, fn+'_mean_'+f, fn+'_std_'+f]
-        else:
-            if f_count > 0: r += [np.mean(inp)]
-            else: r += [0]
-            f_names += [fn+'_mean_'+f]
-        
-    for f in countonly_f:
-        for v in countonly_f[f]:
-            r += [sum(ud[f].values == v)]
-            f_names += [fn+'_n-'+f+str(v)]
-    return (f_count, r, f_names)
-
-def f_calc_subfeatures(ud, fname, filter_col, filter_vals, filter_names, sub_features, countonly_subfeatures):
-    """计算子特征"""
-    [n, stats, fnames] = f_stats_calc(ud, fname,sub_features, countonly_subfeatures)
-    allf = [n] + stats
-    allf_names = ['n_'+fname] + fnames
-    for i in range(len(filter_vals)):
-        [n_sf, sf_stats, sf_fnames] = f_stats_calc(ud[ud[filter_col]==filter_vals[i]], filter_names[i], sub_features, countonly_subfeatures)
-        allf += [n_sf] + sf_stats
-        allf_names += [fname+'_n_'+filter_names[i]] + [fname + '_' + x for x in sf_fnames]
-    return (allf, allf_names)
+def classify_domain(domainname, classifier):
+    """按域名返回(网站类型, 还需要检查的URL规则), 结果缓存在分类器中"""
+    cache = classifier['cache']
+    if domainname not in cache:
+        short = domainname
+        dn = domainname.split(".")
+        if len(dn) > 2 and not any([x in domainname for x in KEEP_SUBDOMAINS]):
+            short = ".".join(dn[-2:])
+        r = classifier['exact'].get(short, classifier['other'])
+        for rank, pattern, code in classifier['patterns']:
+            if rank < r[1] and pattern.search(short):
+                r = (code, rank)
+                break
+        # 只有优先级更高、且域名包含规则字符串的URL规则才可能改变分类结果(例如aol.com上的招聘页面算作求职网站)
+        rules = [(pattern, code) for rank, s, pattern, code in classifier['url_rules'] if rank < r[1] and s in short]
+        cache[domainname] = (r[0], rules)
+    return cache[domainname]
 
-def f_calc(ud, mode = 'week', data = 'r4.2'):
+def classify_urls(url, classifier):
     """
-    计算用户活动特征
+    对一列URL计算网站类型
     参数:
-    - ud: 用户数据
-    - mode: 计算模式(week/day/session)
-    - data: 数据集名称
-    功能:
-    - 计算各类活动的统计特征
-    - 区分工作时间/非工作时间特征
-    - 生成特征向量
-    """
-    n_weekendact = (ud['time']==3).sum()
-    if n_weekendact > 0: 
-        is_weekend = 1
-    else: 
-        is_weekend = 0
-    
-    all_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    [all_f, all_f_names] = f_calc_subfeatures(ud, 'allact', None, [], [], [], all_countonlyf)
-    if mode == 'day':
-        [workhourf, workhourf_names] = f_calc_subfeatures(ud[(ud['time'] == 1) | (ud['time'] == 3)], 'workhourallact', None, [], [], [], all_countonlyf)
-        [afterhourf, afterhourf_names] = f_calc_subfeatures(ud[(ud['time'] == 2) | (ud['time'] == 4) ], 'afterhourallact', None, [], [], [], all_countonlyf)
-    elif mode == 'week':
-        [workhourf, workhourf_names] = f_calc_subfeatures(ud[ud['time'] == 1], 'workhourallact', None, [], [], [], all_countonlyf)
-        [afterhourf, afterhourf_names] = f_calc_subfeatures(ud[ud['time'] == 2 ], 'afterhourallact', None, [], [], [], all_countonlyf)
-        [weekendf, weekendf_names] = f_calc_subfeatures(ud[ud['time'] >= 3 ], 'weekendallact', None, [], [], [], all_countonlyf)
-
-    logon_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    logon_statf = []
-        
-    [all_logonf, all_logonf_names] = f_calc_subfeatures(ud[ud['act']==1], 'logon', None, [], [], logon_statf, logon_countonlyf)
-    if mode == 'day':
-        [workhourlogonf, workhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & ((ud['time'] == 1) | (ud['time'] == 3) )], 'workhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [afterhourlogonf, afterhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & ((ud['time'] == 2) | (ud['time'] == 4) )], 'afterhourlogon', None, [], [], logon_statf, logon_countonlyf)
-    elif mode == 'week':
-        [workhourlogonf, workhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] == 1)], 'workhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [afterhourlogonf, afterhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] == 2) ], 'afterhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [weekendlogonf, weekendlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] >= 3) ], 'weekendlogon', None, [], [], logon_statf, logon_countonlyf)
-    
-    device_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    device_statf = ['usb_dur','file_tree_len'] if data not in ['r4.1','r4.2'] else ['usb_dur']
-        
-    [all_devicef, all_devicef_names] = f_calc_subfeatures(ud[ud['act']==3], 'usb', None, [], [], device_statf, device_countonlyf)
-    if mode == 'day':
-        [workhourdevicef, workhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & ((ud['time'] == 1) | (ud['time'] == 3) )], 'workhourusb', None, [], [], device_statf, device_countonlyf)
-        [afterhourdevicef, afterhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & ((ud['time'] == 2) | (ud['time'] == 4) )], 'afterhourusb', None, [], [], device_statf, device_countonlyf)
-    elif mode == 'week':
-        [workhourdevicef, workhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] == 1)], 'workhourusb', None, [], [], device_statf, device_countonlyf)
-        [afterhourdevicef, afterhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] == 2) ], 'afterhourusb', None, [], [], device_statf, device_countonlyf)
-        [weekenddevicef, weekenddevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] >= 3) ], 'weekendusb', None, [], [], device_statf, device_countonlyf)
-          
-    if mode != 'session': file_countonlyf = {'to_usb':[1],'from_usb':[1], 'file_act':[1,2,3,4], 'disk':[0,1], 'pc':[0,1,2,3]}
-    else: file_countonlyf = {'to_usb':[1],'from_usb':[1], 'file_act':[1,2,3,4], 'disk':[0,1,2]}
-    if data in ['r4.1','r4.2']: 
-        [file_countonlyf.pop(k) for k in ['to_usb','from_usb', 'file_act']]
-    
-    (all_filef, all_filef_names) = f_calc_subfeatures(ud[ud['act']==7], 'file', 'file_type', [1,2,3,4,5,6], \
-            ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-    
-    if mode == 'day':
-        (workhourfilef, workhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (afterhourfilef, afterhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-    elif mode == 'week':
-        (workhourfilef, workhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] ==1)], 'workhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (afterhourfilef, afterhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] ==2)], 'afterhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (weekendfilef, weekendfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] >= 3)], 'weekendfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        
-    email_stats_f = ['n_des', 'n_atts', 'n_exdes', 'n_bccdes', 'email_size', 'email_text_slen', 'email_text_nwords']
-    if data not in ['r4.1','r4.2']:
-        email_stats_f += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
-        email_stats_f += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe'] 
-        mail_filter = 'send_mail'
-        mail_filter_vals = [0,1]
-        mail_filter_names = ['recvmail','send_mail']
+    - url: URL的Series
+    - classifier: get_domain_classifier返回的分类器
+    返回:
+    - 网站类型数组
+    """
+    domains = url.str.extract('//(.*?)/', expand=False)
+    classified = domains.map({d: classify_domain(d, classifier) for d in domains.unique()}).values
+    http_type = np.array([c[0] for c in classified], dtype=int)
+    urls = url.values
+    for i in np.flatnonzero([len(c[1]) > 0 for c in classified]):
+        for pattern, code in classified[i][1]:
+            if pattern.search(urls[i]):
+                http_type[i] = code
+                break
+    return http_type
+
+def http_features(acts, data = 'r4.2'):
+    """按列计算HTTP活动特征"""
+    url = acts['url/fname']
+    http_type = classify_urls(url, get_domain_classifier())
+    
+    url_len = url.str.len().values
+    url_depth = url.str.count('/').values - 2
+    content_len = acts['content'].str.len().values
+    content_nwords = acts['content'].str.count(' ').values + 1
+    if data in ['r6.1','r6.2']:
+        http_act_dict = {'www visit': 1, 'www download': 2, 'www upload': 3}
+        http_act = acts['activity'].str.lower().map(http_act_dict).fillna(0).values
+        return np.column_stack([http_type, url_len, url_depth, content_len, content_nwords, http_act])
     else:
-        mail_filter, mail_filter_vals, mail_filter_names = None, [], []    
-    
-    if mode != 'session': mail_countonlyf = {'Xemail':[1],'exbccmail':[1], 'pc':[0,1,2,3]}
-    else: mail_countonlyf = {'Xemail':[1],'exbccmail':[1]}
-    
-    (all_emailf, all_emailf_names) = f_calc_subfeatures(ud[ud['act']==6], 'email', mail_filter, mail_filter_vals, mail_filter_names , email_stats_f, mail_countonlyf)
-    if mode == 'week':
-        (workhouremailf, workhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] == 1)], 'workhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (afterhouremailf, afterhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] == 2)], 'afterhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (weekendemailf, weekendemailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] >= 3)], 'weekendemail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-    elif mode == 'day':
-        (workhouremailf, workhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (afterhouremailf, afterhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)    
-    
-    if data in ['r5.2','r5.1'] or data in ['r4.1','r4.2']:
-        http_count_subf =  {'pc':[0,1,2,3]}
-    elif data in ['r6.2','r6.1']:
-        http_count_subf = {'pc':[0,1,2,3], 'http_act':[1,2,3]}
-    
-    if mode == 'session': http_count_subf.pop('pc',None)
-
-    (all_httpf, all_httpf_names) = f_calc_subfeatures(ud[ud['act']==5], 'http', 'http_type', [1,2,3,4,5,6], \
-            ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-    
-    if mode == 'week':
-        (workhourhttpf, workhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] ==1)], 'workhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (afterhourhttpf, afterhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] ==2)], 'afterhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (weekendhttpf, weekendhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] >=3)], 'weekendhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-    elif mode == 'day':
-        (workhourhttpf, workhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (afterhourhttpf, afterhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        
-    numActs = all_f[0]
-    mal_u = 0
-    if (ud['mal_act']).sum() > 0:
-        tmp = list(set(ud['insider']))
-        if len(tmp) > 1:
-            tmp.remove(0.0)
-        mal_u = tmp[0]
-        
-    if mode == 'week':        
-        features_tmp =  all_f + workhourf + afterhourf + weekendf +\
-                        all_logonf + workhourlogonf + afterhourlogonf + weekendlogonf +\
-                        all_devicef + workhourdevicef + afterhourdevicef + weekenddevicef +\
-                        all_filef + workhourfilef + afterhourfilef + weekendfilef + \
-                        all_emailf + workhouremailf + afterhouremailf + weekendemailf + all_httpf + workhourhttpf + afterhourhttpf + weekendhttpf
-        fnames_tmp = all_f_names + workhourf_names + afterhourf_names + weekendf_names +\
-                      all_logonf_names + workhourlogonf_names + afterhourlogonf_names + weekendlogonf_names +\
-                      all_devicef_names + workhourdevicef_names + afterhourdevicef_names + weekenddevicef_names +\
-                      all_filef_names + workhourfilef_names + afterhourfilef_names + weekendfilef_names + \
-                      all_emailf_names + workhouremailf_names + afterhouremailf_names + weekendemailf_names + all_httpf_names + workhourhttpf_names + afterhourhttpf_names + weekendhttpf_names
-    elif mode == 'day':
-        features_tmp = all_f + workhourf + afterhourf +\
-                        all_logonf + workhourlogonf + afterhourlogonf +\
-                        all_devicef + workhourdevicef + afterhourdevicef + \
-                        all_filef + workhourfilef + afterhourfilef + \
-                        all_emailf + workhouremailf + afterhouremailf + all_httpf + workhourhttpf + afterhourhttpf
-        fnames_tmp = all_f_names + workhourf_names + afterhourf_names +\
-                      all_logonf_names + workhourlogonf_names + afterhourlogonf_names +\
-                      all_devicef_names + workhourdevicef_names + afterhourdevicef_names +\
-                      all_filef_names + workhourfilef_names + afterhourfilef_names + \
-                      all_emailf_names + workhouremailf_names + afterhouremailf_names + all_httpf_names + workhourhttpf_names + afterhourhttpf_names
-    elif mode == 'session':
-        features_tmp = all_f + all_logonf + all_devicef + all_filef + all_emailf + all_httpf
-        fnames_tmp = all_f_names + all_logonf_names + all_devicef_names + all_filef_names + all_emailf_names + all_httpf_names
-    
-    return [numActs, is_weekend, features_tmp, fnames_tmp, mal_u]
+        return np.column_stack([http_type, url_len, url_depth, content_len, content_nwords])
 
-def session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf):
+def category_lookup(col, table, default = 0, transform = None):
     """
-    计算会话实例的特征
+    通过类别编码把字符串列映射为数值, 每个不同的取值只查一次表
     参数:
-    - ud: 用户数据
-    - sinfo: 会话信息
-    - week: 周数
-    - mode: 模式(week/day/session)
-    - data: 数据集名称
-    - uw: 用户周数据
-    - v: 用户ID
-    - list_uf: 用户特征列表
+    - col: 字符串Series
+    - table: 取值到数值的字典
+    - default: 表中没有的取值(以及缺失值)对应的数值
+    - transform: 查表前对取值做的变换(如str.lower)
     返回:
-    - 会话特征向量和特征名称
-    功能:
-    - 计算会话的时间特征(工作时间比例,持续时间等)
-    - 计算会话的活动特征
-    - 合并用户特征和会话特征
-    """
-    d = ud.iloc[0]['day']
-    perworkhour = sum(ud['time']==1)/len(ud)
-    perafterhour = sum(ud['time']==2)/len(ud)
-    perweekend = sum(ud['time']==3)/len(ud)
-    perweekendafterhour = sum(ud['time']==4)/len(ud)
-    st_timestamp = min(ud['time_stamp'])
-    end_timestamp = max(ud['time_stamp'])
-    s_dur = (end_timestamp - st_timestamp).total_seconds() / 60 # in minute
-    s_start = st_timestamp.hour + st_timestamp.minute/60
-    s_end = end_timestamp.hour + end_timestamp.minute/60
-    starttime = st_timestamp.timestamp()
-    endtime = end_timestamp.timestamp()
-    n_days = len(set(ud['day']))        
-    
-    tmp = f_calc(ud, mode, data)
-    session_instance = [starttime, endtime, v, sinfo[0], d, week, ud.iloc[0]['pc'], perworkhour, perafterhour, perweekend,
-                        perweekendafterhour, n_days, s_dur, sinfo[6], sinfo[2], sinfo[3], s_start, s_end] + \
-        (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [tmp[4]]
-    return (session_instance, tmp[3])
-
-def to_csv(week, mode, data, ul, uf_dict, list_uf, subsession_mode = {}, config_id = None):
+    - 数值数组, 以及表中没有的取值及其出现次数(Counter)
     """
-    将处理后的数据导出为CSV格式
+    cat = col.astype('category')
+    keys = cat.cat.categories
+    if transform is not None:
+        keys = keys.map(transform)
+    codes = cat.cat.codes.values
+    lookup = np.array([table.get(k, default) for k in keys] + [default])
+    unknown = Counter()
+    for k, n in zip(keys, np.bincount(codes[codes >= 0], minlength=len(keys))):
+        if k not in table and n > 0:
+            unknown[k] += n
+    return lookup[codes], unknown
+
+# 文件所在磁盘: C盘1, 可移动磁盘(R)2, 其他0
+DISK_CODES = {'C': 1, 'R': 2}
+# r5/r6版本中的文件操作类型
+FILE_ACT_CODES = {'file open': 1, 'file copy': 2, 'file write': 3, 'file delete': 4}
+
+def file_features(acts, data = 'r4.2', unknown_acts = None):
+    """
+    按列计算文件活动特征
     参数:
-    - week: 周数
-    - mode: 模式(week/day/session)
+    - acts: 一周内的文件活动
     - data: 数据集名称
-    - ul: 用户列表
-    - uf_dict: 用户特征字典
-    - list_uf: 用户特征列表
-    - subsession_mode: 子会话模式配置
-    - config_id: 配置标识符，用于区分不同参数的运行
+    - unknown_acts: 用于累计未知文件操作类型的Counter, None表示不统计
+    返回:
+    - 文件特征矩阵, 列顺序与get_num_columns中的文件特征一致
+    """
+    fname = acts['url/fname']
+    file_type, _ = category_lookup(fname.str.split('.').str[1], FILE_TYPE_CODES, default = 1)
+    disk, _ = category_lookup(fname.str[0], DISK_CODES)
+    file_depth = fname.str.count(r'\\').values
+    fsize = acts['content'].str.len().values
+    f_nwords = acts['content'].str.count(' ').values + 1
+    if data in ['r5.2','r5.1', 'r6.2','r6.1']:
+        to_usb = (acts['to'] == 'True').astype(int).values
+        from_usb = (acts['from'] == 'True').astype(int).values
+        file_act, unknown = category_lookup(acts['activity'], FILE_ACT_CODES, transform = str.lower)
+        if unknown_acts is not None:
+            unknown_acts.update(unknown)
+        return np.column_stack([file_type, fsize, f_nwords, disk, file_depth, file_act, to_usb, from_usb])
+    elif data in ['r4.1','r4.2']:
+        return np.column_stack([file_type, fsize, f_nwords, disk, file_depth])
+
+def next_event(group, mask):
+    """
+    对按组排好序的事件, 返回每个事件之后(不含自身)同组内第一个满足mask的事件位置
+    参数:
+    - group: 每个事件的组编号, 同组事件连续排列
+    - mask: 候选事件的布尔数组
+    返回:
+    - 事件位置数组, 找不到时为len(group)
+    """
+    n = len(group)
+    idx = np.where(mask, np.arange(n), n)
+    nxt = np.append(np.minimum.accumulate(idx[::-1])[::-1], n)[1:]
+    found = nxt < n
+    found[found] = group[nxt[found]] == group[found]
+    return np.where(found, nxt, n)
+
+def device_features(acts, act_codes, data = 'r4.2', next_acts = None):
+    """
+    计算设备连接活动的特征
+    参数:
+    - acts: 按用户、时间排好序的一周活动数据
+    - act_codes: 活动类型编码
+    - next_acts: 下一周的设备活动(user, pc, date, activity), 用于跨周配对; None表示只在本周内配对
+    返回:
+    - 连接活动(编码3)的行位置, 以及对应的[USB连接时长(, 文件树长度)]
     功能:
-    - 根据不同模式(周/日/会话)提取特征
-    - 处理子会话(如果需要)
-    - 将特征数据保存为pickle文件,最终合并为CSV
-    - 支持按时间(time)或活动数量(nact)划分子会话
+    - 把同一用户在同一PC上的连接/断开活动按时间排成一列, 一次扫描为所有连接找到其后的
+      第一个断开活动; 如果在断开之前又有连接(或找不到断开), 时长记为-1
     """
-    user_dict = {i : idx for (i, idx) in enumerate(ul.index)} 
-    if mode == 'session': 
-        first_sid = week*100000 # to get an unique index for each session, also, first 1 or 2 number in index would be week number
-        cols2a = ['starttime', 'endtime','user', 'sessionid', 'day', 'week', 'pc', 'isworkhour', 'isafterhour','isweekend', 
-                  'isweekendafterhour', 'n_days', 'duration', 'n_concurrent_sessions', 'start_with', 'end_with', 'ses_start', 
-                  'ses_end'] + list_uf + ['ITAdmin','O','C','E','A','N']
-    elif mode == 'day': 
-        cols2a = ['starttime', 'endtime','user', 'day', 'week', 'isweekday','isweekend'] + list_uf +\
-            ['ITAdmin','O','C','E','A','N']
-    else: cols2a = ['starttime', 'endtime','user','week'] + list_uf + ['ITAdmin','O','C','E','A','N']
-    cols2b = ['insider']        
-
-    w = pd.read_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
-
-    usnlist = list(set(w['user'].astype('int').values))
-    if True:
-        cols = ['week']+ list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N', 'insider'] 
-        uw = pd.DataFrame(columns = cols, index = user_dict.keys())
-        uwdict = {}
-        for v in user_dict:
-            if v in usnlist:
-                is_ITAdmin = 1 if ul.loc[user_dict[v], 'role'] == 'ITAdmin' else 0
-                row = [week] + proc_u_features(ul.loc[user_dict[v]], uf_dict, list_uf, data = data) + [is_ITAdmin] + \
-                    (ul.loc[user_dict[v],['O','C','E','A','N']]).tolist() + [0]
-                row[-1] = int(list(set(w[w['user']==v]['insider']))[0])
-                uwdict[v] = row
-        uw = pd.DataFrame.from_dict(uwdict, orient = 'index',columns = cols)    
-    
-    towrite = pd.DataFrame()
-    towrite_list = []
-    
-    if mode == 'session' and len(subsession_mode) > 0:
-        towrite_list_subsession = {} 
-        for k1 in subsession_mode:
-            towrite_list_subsession[k1] = {}
-            for k2 in subsession_mode[k1]:
-                towrite_list_subsession[k1][k2] = []
-    
-    days = list(set(w['day']))
-    for v in user_dict:
-        if v in usnlist:
-            uactw = w[w['user']==v]
-            
-            if mode == 'week':
-                a = uactw.iloc[0]['time_stamp']
-                a = a - timedelta(int(a.strftime("%w"))) # get the nearest Sunday
-                starttime = datetime(a.year, a.month, a.day).timestamp()
-                endtime = (datetime(a.year, a.month, a.day) + timedelta(days=7)).timestamp()
-                
-                if len(uactw) > 0:
-                    tmp = f_calc(uactw, mode, data)
-                    i_fnames = tmp[3]
-                    towrite_list.append([starttime, endtime, v, week] + (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [ tmp[4]])
-
-            if mode == 'session':
-                sessions = get_sessions(uactw, first_sid)
-                first_sid += len(sessions)
-                for s in sessions:
-                    sinfo = sessions[s]
-                    
-                    ud = uactw.loc[sessions[s][7]]
-                    if len(ud) > 0:                     
-                        session_instance, i_fnames = session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf)
-                        towrite_list.append(session_instance)
-                        
-                        ## do subsessions:
-                        if 'time' in subsession_mode: # divide a session into subsessions by consecutive time chunks
-                            for subsession_dur in subsession_mode['time']:
-                                n_subsession = int(np.ceil(session_instance[12] / subsession_dur))
-                                if n_subsession == 1:
-                                    towrite_list_subsession['time'][subsession_dur].append([0] + session_instance)
-                                else:
-                                    sinfo1 = sinfo.copy()
-                                    for subsession_ind in range(n_subsession):
-                                        sinfo1[3] = 0 if subsession_ind < n_subsession-1 else sinfo[3] 
-                                        
-                                        subsession_ud = ud[(ud['time_stamp'] >= sessions[s][4] + timedelta(minutes = subsession_ind*subsession_dur)) & \
-                                                            (ud['time_stamp'] < sessions[s][4] + timedelta(minutes = (subsession_ind+1)*subsession_dur))]
-                                        if len(subsession_ud) > 0:
-                                            ss_instance, _ = session_instance_calc(subsession_ud, sinfo1, week, mode, data, uw, v, list_uf)
-                                            towrite_list_subsession['time'][subsession_dur].append([subsession_ind] + ss_instance)
-                            
-                        if 'nact' in subsession_mode:
-                            for ss_nact in subsession_mode['nact']:
-                                n_subsession = int(np.ceil(len(ud) / ss_nact))
-                                if n_subsession == 1:
-                                    towrite_list_subsession['nact'][ss_nact].append([0] + session_instance)
-                                else:
-                                    sinfo1 = sinfo.copy()
-                                    for ss_ind in range(n_subsession):
-                                        sinfo1[3] = 0 if ss_ind < n_subsession-1 else sinfo[3] 
-                                        
-                                        ss_ud = ud.iloc[ss_ind*ss_nact : min(len(ud), (ss_ind+1)*ss_nact)] 
-                                        if len(ss_ud) > 0:
-                                            ss_instance,_ = session_instance_calc(ss_ud, sinfo1, week, mode, data, uw, v, list_uf)
-                                            towrite_list_subsession['nact'][ss_nact].append([ss_ind] + ss_instance)
-                        
-            if mode == 'day':
-                days = sorted(list(set(uactw['day']))) 
-                for d in days:
-                    ud = uactw[uactw['day'] == d]
-                    isweekday = 1 if sum(ud['time']>=3) == 0 else 0
-                    isweekend = 1-isweekday
-                    a = ud.iloc[0]['time_stamp']
-                    starttime = datetime(a.year, a.month, a.day).timestamp()
-                    endtime = (datetime(a.year, a.month, a.day) + timedelta(days=1)).timestamp()
-                    
-                    if len(ud) > 0:
-                        tmp = f_calc(ud, mode, data)
-                        i_fnames = tmp[3]
-                        towrite_list.append([starttime, endtime, v, d, week, isweekday, isweekend] + (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [ tmp[4]])
+    rows = np.flatnonzero((act_codes == 3) | (act_codes == 4))
+    events = pd.DataFrame({'user': acts['user'].values[rows], 'pc': acts['pc'].values[rows],
+                           'date': acts['date'].values[rows], 'code': act_codes[rows], 'row': rows})
+    if next_acts is not None and len(next_acts) > 0:
+        next_activity = next_acts['activity'].str.strip()
+        next_acts = next_acts[next_activity.isin(['Connect', 'Disconnect'])].sort_values('date', kind='stable')
+        events = pd.concat([events, pd.DataFrame({'user': next_acts['user'].values, 'pc': next_acts['pc'].values,
+                            'date': next_acts['date'].values, 'row': -1,
+                            'code': np.where(next_acts['activity'].str.strip() == 'Connect', 3, 4)})], ignore_index=True)
+    
+    # 按(用户, PC)分组排列, 组内保持时间顺序(本周活动在前, 下一周活动在后)
+    group = events.groupby(['user', 'pc'], sort=False).ngroup().values
+    order = np.argsort(group, kind='stable')
+    group, code, dates, ev_rows = group[order], events['code'].values[order], events['date'].values[order], events['row'].values[order]
+    
+    n = len(group)
+    next_dis = next_event(group, code == 4)
+    next_con = next_event(group, code == 3)
+    dis_time, con_time = dates[np.minimum(next_dis, n-1)], dates[np.minimum(next_con, n-1)]
+    connect_dur = np.where(next_dis < n, (dis_time - dates) // np.timedelta64(1, 's'), -1)
+    # 如果在断开之前又有连接，说明数据异常
+    connect_dur[(next_con < n) & (con_time < dis_time)] = -1
+    
+    is_connect = (code == 3) & (ev_rows >= 0)
+    connect_rows, connect_dur = ev_rows[is_connect], connect_dur[is_connect]
+    if data in ['r5.2','r5.1','r6.2','r6.1']:
+        # 新版本增加了文件树长度特征
+        file_tree_len = acts['content'].iloc[connect_rows].str.count(';').values + 1
+        return connect_rows, np.column_stack([connect_dur, file_tree_len])
+    return connect_rows, connect_dur.reshape(-1, 1)
 
-    towrite = pd.DataFrame(columns = cols2a + i_fnames + cols2b, data = towrite_list)
-    towrite.to_pickle("tmp/"+str(week) + mode+"_"+config_id+".pickle")
-    
-    if mode == 'session' and len(subsession_mode) > 0:
-        for k1 in subsession_mode:
-            for k2 in subsession_mode[k1]:
-                df_tmp = pd.DataFrame(columns = ['subs_ind']+cols2a + i_fnames + cols2b, data = towrite_list_subsession[k1][k2])
-                df_tmp.to_pickle("tmp/"+str(week) + mode + k1 + str(k2) + "_"+config_id+".pickle")
-    
-def parse_config_id(config_id):
-    """解析配置标识符，返回各个参数"""
-    parts = config_id.split('_')
-    config = {}
-    for part in parts:
-        if part.startswith('u'):
-            config['max_users'] = 'all' if part[1:] == 'all' else int(part[1:])
-        elif part.startswith('w'):
-            week_range = part[1:].split('-')
-            config['start_week'] = int(week_range[0])
-            config['end_week'] = int(week_range[1])
-        elif part.startswith('m'):
-            config['modes'] = part[1:]
-        elif part.startswith('s'):
-            config['enable_subsession'] = bool(int(part[1:]))
-    return config
-
-def find_compatible_config(target_config_id, data_dir="NumDataByWeek"):
-    """查找可以重用的兼容配置"""
-    target_config = parse_config_id(target_config_id)
-    existing_files = []
-    if os.path.exists(data_dir):
-        for filename in os.listdir(data_dir):
-            if filename.endswith('.pickle') and '_num_' in filename:
-                parts = filename.split('_num_')
-                if len(parts) == 2:
-                    config_id = parts[1].replace('.pickle', '')
-                    existing_files.append(config_id)
-    
-    unique_configs = list(set(existing_files))
-    compatible_configs = []
-    
-    for config_id in unique_configs:
-        try:
-            config = parse_config_id(config_id)
-            is_compatible = True
-            
-            # 检查用户数量兼容性
-            if target_config['max_users'] != 'all':
-                if config['max_users'] == 'all' or (isinstance(config['max_users'], int) and config['max_users'] >= target_config['max_users']):
-                    pass
-                else:
-                    is_compatible = False
-            
-            # 检查周数范围兼容性
-            if (config['start_week'] <= target_config['start_week'] and config['end_week'] >= target_config['end_week']):
-                pass
-            else:
-                is_compatible = False
-            
-            # 检查模式兼容性
-            if target_config['modes'] in config['modes']:
-                pass
-            else:
-                is_compatible = False
-            
-            # 检查子会话设置兼容性
-            if config['enable_subsession'] == target_config['enable_subsession']:
-                pass
-            else:
-                is_compatible = False
-            
-            if is_compatible:
-                compatible_configs.append((config_id, config))
-        except:
-            continue
+def get_num_columns(data = 'r4.2'):
+    """返回NumDataByWeek中数值列的列名(不含actid, pcid, time_stamp)"""
+    # 基础列：用户、天数、活动类型、PC类型、时间类型
+    col_names = ['user','day','act','pc','time']
     
-    if compatible_configs:
-        def config_score(item):
-            config_id, config = item
-            user_diff = 0
-            if target_config['max_users'] != 'all' and config['max_users'] != 'all':
-                user_diff = config['max_users'] - target_config['max_users']
-            elif config['max_users'] == 'all' and target_config['max_users'] != 'all':
-                user_diff = 1000
-            week_diff = (config['end_week'] - config['start_week']) - (target_config['end_week'] - target_config['start_week'])
-            return user_diff + week_diff * 0.1
-        
-        best_config = min(compatible_configs, key=config_score)
-        print(f"找到兼容配置: {best_config[0]} (目标: {target_config_id})")
-        return best_config[0]
-    return None
-
-def copy_compatible_data(source_config_id, target_config_id, week_range, data_dir="NumDataByWeek"):
-    """从兼容配置复制数据并进行必要的用户筛选"""
-    target_config = parse_config_id(target_config_id)
-    copied_weeks = []
-    
-    for week in week_range:
-        source_file = f"{data_dir}/{week}_num_{source_config_id}.pickle"
-        target_file = f"{data_dir}/{week}_num_{target_config_id}.pickle"
+    # 根据数据集版本定义各类特征的列名
+    if data in ['r4.1','r4.2']:
+        device_feature_names = ['usb_dur']  # 设备特征：USB持续时间
+        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth']
+        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
+        email_feature_names = ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
+    elif data in ['r5.2','r5.1', 'r6.2','r6.1']:
+        device_feature_names = ['usb_dur', 'file_tree_len']  # 增加文件树长度
+        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth', 'file_act', 'to_usb', 'from_usb']  # 增加USB传输特征
+        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
+        if data in ['r6.2','r6.1']:
+            http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords', 'http_act']  # r6版本增加HTTP活动类型
+        # 邮件特征大幅增加，包含发送/接收标记和各种附件特征
+        email_feature_names = ['send_mail', 'receive_mail','n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
+        # 附件类型特征：压缩包、图片、文档、文本、可执行文件
+        email_feature_names += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
+        # 附件大小特征：对应各种类型附件的总大小
+        email_feature_names += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe']     
         
-        if os.path.exists(source_file) and not os.path.exists(target_file):
-            try:
-                df = pd.read_pickle(source_file)
-                
-                # 如果需要用户数量限制，进行筛选
-                if (target_config['max_users'] != 'all' and isinstance(target_config['max_users'], int)):
-                    unique_users = sorted(df['user'].unique())
-                    if len(unique_users) > target_config['max_users']:
-                        # 保持与主程序相同的用户选择逻辑
-                        # 首先分离恶意用户和正常用户
-                        if 'insider' in df.columns:
-                            malicious_users = df[df['insider'] > 0]['user'].unique()
-                            normal_users = df[df['insider'] == 0]['user'].unique()
-                            
-                            # 确保包含所有恶意用户
-                            remaining_slots = target_config['max_users'] - len(malicious_users)
-                            
-                            if remaining_slots > 0:
-                                np.random.seed(42)
-                                available_normal = [u for u in normal_users if u not in malicious_users]
-                                if len(available_normal) > remaining_slots:
-                                    selected_normal = np.random.choice(available_normal, 
-                                                                     size=remaining_slots, 
-                                                                     replace=False)
-                                    selected_users = list(malicious_users) + list(selected_normal)
-                                else:
-                                    selected_users = list(malicious_users) + list(available_normal)
-                            else:
-                                selected_users = list(malicious_users[:target_config['max_users']])
-                        else:
-                            # 如果没有insider列，使用简单的随机选择
-                            np.random.seed(42)
-                            selected_users = np.random.choice(unique_users, 
-                                                             size=target_config['max_users'], 
-                                                             replace=False)
-                        
-                        df = df[df['user'].isin(selected_users)]
-                
-                df.to_pickle(target_file)
-                copied_weeks.append(week)
-            except Exception as e:
-                print(f"复制周 {week} 数据时出错: {e}")
-                continue
-    return copied_weeks
+    # 组合所有列名
+    return col_names + device_feature_names + file_feature_names+ http_feature_names + email_feature_names + ['mal_act','insider']
 
-def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = None):
+def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = None, storage = 'pickle', usb_cross_week = False, 
+                     work_hours = WORK_HOURS, weekend_days = WEEKEND_DAYS):
     """
     处理一周内的用户活动数据,转换为数值特征
     
     这个函数是特征提取的核心部分，它将原始的用户活动数据（登录、文件操作、邮件、HTTP访问等）
-    转换为机器学习可以使用的数值特征向量。
+    转换为机器学习可以使用的数值特征向量。所有特征都按列对整周数据一次性计算。
     
     参数:
     - week: 周数索引，用于读取对应周的数据文件
-    - users: 用户信息数据框，包含用户属性和恶意用户标记
-    - userlist: 要处理的用户列表，默认'all'表示处理所有用户
+    - users: 用户信息数据框，包含用户属性和恶意用户标记；也可以是build_user_lookup生成后
+      用joblib.dump保存的查找表路径，多个并行进程以只读内存映射的方式共享同一个文件
+    - userlist: 要处理的用户列表，默认'all'表示按用户表的顺序处理该周所有活跃用户
     - data: 数据集名称(r4.2, r5.2等)，不同数据集的特征维度不同
     - config_id: 配置标识符，用于区分不同参数的运行
+    - storage: DataByWeek和NumDataByWeek的存储格式(pickle/parquet/feather)
+    - usb_cross_week: 是否允许USB连接与下一周的断开活动配对(需要下一周的DataByWeek文件)
+    - work_hours: 工作时间的开始和结束("H:M"), 决定time列的工作/非工作时间
+    - weekend_days: 周末包含的星期(%w编号), 决定time列的工作日/周末
     
     功能:
     - 读取一周的活动数据（从DataByWeek文件夹）
@@ -1379,15 +1151,17 @@ def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = N
     - 保存处理后的数值数据到NumDataByWeek文件夹
     
     输出:
-    - 生成包含数值特征的pickle文件，用于后续的统计特征计算
+    - 生成包含数值特征的周文件，用于后续的统计特征计算
+    - 返回该周未知文件操作类型的计数(Counter)
     """
     
     # ========== 1. 初始化和数据准备 ==========
-    # 创建用户ID到索引的映射字典，用于后续快速查找
-    user_dict = {idx: i for (i, idx) in enumerate(users.index)}
+    # 整数编码的用户查找表：用户/PC编码、自己的PC、共享PC、主管的PC和恶意标记
+    lookup = load_user_lookup(users)
+    user_index = pd.Index(lookup['users'])
     
     # 读取指定周的活动数据（之前由combine_by_timerange_pandas生成）
-    acts_week = pd.read_pickle("DataByWeek/"+str(week)+".pickle")
+    acts_week = load_frame("DataByWeek/"+str(week), storage, index_col='id')
     
     # 获取该周的时间范围，用于判断恶意活动时间窗口
     start_week, end_week = min(acts_week.date), max(acts_week.date)
@@ -1395,225 +1169,92 @@ def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = N
     # 按时间排序，确保活动按时间顺序处理（对于connect/disconnect配对很重要）
     acts_week.sort_values('date', ascending = True, inplace = True)
     
-    # ========== 2. 确定特征维度 ==========
-    # 根据不同数据集版本设置特征向量的维度
-    # r5.x版本有45列，r6.x版本有46列（多了HTTP活动类型），r4.x版本只有27列
-    n_cols = 45 if data in ['r5.2','r5.1'] else 46
-    if data in ['r4.2','r4.1']: n_cols = 27
-    
-    # 初始化存储所有用户该周活动特征的矩阵
-    u_week = np.zeros((len(acts_week), n_cols))
-    
-    # 存储每个活动的元信息：[活动ID, PC ID, 时间戳]
-    pc_time = []
-    
-    # 如果没有指定用户列表，则处理该周所有活跃用户
+    # 如果没有指定用户列表，则按用户表的顺序处理该周所有活跃用户
     if userlist == 'all':
-        userlist = set(acts_week.user)
+        active_users = set(acts_week.user)
+        userlist = [u for u in lookup['users'] if u in active_users]
     
     # 确保只处理在用户信息表中存在的用户，避免KeyError
-    userlist = [u for u in userlist if u in users.index]
+    userlist = [u for u in userlist if u in user_index]
     
     if not userlist:
         print(f"警告: 周 {week} 没有有效的用户数据")
         # 创建空的DataFrame保存
-        empty_df = pd.DataFrame(columns=['actid','pcid','time_stamp'] + ['user','day','act','pc','time'] + 
-                               ['usb_dur'] + (['file_tree_len'] if data not in ['r4.2','r4.1'] else []) +
-                               ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth'] + 
-                               (['file_act', 'to_usb', 'from_usb'] if data not in ['r4.2','r4.1'] else []) +
-                               ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords'] + 
-                               (['http_act'] if data in ['r6.2','r6.1'] else []) +
-                               (['send_mail', 'receive_mail'] if data not in ['r4.2','r4.1'] else []) +
-                               ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords'] +
-                               (['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe',
-                                 'e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe'] if data not in ['r4.2','r4.1'] else []) +
-                               ['mal_act','insider'])
-        empty_df.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
-        return
-    
-    # ========== 3. 按用户循环处理活动数据 ==========
-    current_ind = 0  # 当前在总矩阵中的行索引
-    
-    for u in userlist:
-        # 提取当前用户在该周的所有活动
-        df_acts_u = acts_week[acts_week.user == u]
-        
-        # ========== 3.1 判断用户是否为恶意用户 ==========
-        mal_u = 0  # 初始化为正常用户
-        # 如果用户在恶意用户列表中（malscene > 0表示参与了某个恶意场景）
-        if users.loc[u].malscene > 0:
-            # 检查当前周是否在该用户的恶意活动时间窗口内
-            if start_week <= users.loc[u].mend and users.loc[u].mstart <= end_week:
-                mal_u = users.loc[u].malscene  # 记录恶意场景编号
-        
-        # ========== 3.2 活动类型标准化和映射 ==========
-        # 获取所有活动类型（来自type列）
-        list_uacts = df_acts_u.type.tolist()
-        
-        # 获取活动的具体操作（来自activity列，主要用于设备连接操作）
-        list_activity = df_acts_u.activity.tolist()
-        
-        # 对于设备相关活动，将activity列的值转换为小写并标准化
-        # 这里处理Logon/Logoff/Connect/Disconnect等设备操作
-        list_uacts = [list_activity[i].strip().lower() if (type(list_activity[i])==str and list_activity[i].strip() in ['Logon', 'Logoff', 'Connect', 'Disconnect']) \
-                        else list_uacts[i] for i in range(len(list_uacts))]
-        
-        # 将活动类型映射为数值编码
-        # 1:登录, 2:登出, 3:设备连接, 4:设备断开, 5:HTTP访问, 6:邮件, 7:文件操作
-        uacts_mapping = {'logon':1, 'logoff':2, 'connect':3, 'disconnect':4, 'http':5,'email':6,'file':7}
-        list_uacts_num = [uacts_mapping[x] for x in list_uacts]
-
-        # 初始化当前用户的特征矩阵
-        oneu_week = np.zeros((len(df_acts_u), n_cols))
-        oneu_pc_time = []  # 存储当前用户的活动元信息
-        
-        # ========== 3.3 逐个活动处理 ==========
-        for i in range(len(df_acts_u)):
-            # ========== 3.3.1 确定活动发生的PC类型 ==========
-            # 调用from_pc函数判断活动发生在什么类型的电脑上
-            # 返回值：0=自己的PC, 1=共享PC, 2=他人的PC, 3=主管的PC
-            pc, _ = from_pc(df_acts_u.iloc[i], users)
-            
-            # ========== 3.3.2 确定活动发生的时间类型 ==========
-            # 根据是否为周末和是否为工作时间，将时间分为4类
-            if is_weekend(df_acts_u.iloc[i]['date']):
-                if is_after_whour(df_acts_u.iloc[i]['date']):
-                    act_time = 4  # 周末非工作时间
-                else:
-                    act_time = 3  # 周末工作时间
-            elif is_after_whour(df_acts_u.iloc[i]['date']):
-                act_time = 2  # 工作日非工作时间
-            else:
-                act_time = 1  # 工作日工作时间
-            
-            # ========== 3.3.3 初始化各类活动的特征向量 ==========
-            # 根据数据集版本初始化不同维度的特征向量
-            if data in ['r4.2','r4.1']:
-                device_f = [0]              # 设备特征：USB连接时长
-                file_f = [0, 0, 0, 0, 0]    # 文件特征：类型、大小、词数、磁盘、深度
-                http_f = [0,0,0,0,0]        # HTTP特征：类型、URL长度、深度、内容长度、词数
-                email_f = [0]*9             # 邮件特征：9维
-            elif data in ['r5.2','r5.1','r6.2','r6.1']:
-                device_f = [0,0]            # 设备特征：USB连接时长、文件树长度
-                file_f = [0]*8              # 文件特征：8维（增加了USB传输标记）
-                http_f = [0,0,0,0,0]        # HTTP特征：5维基础特征
-                if data in ['r6.2','r6.1']:
-                    http_f = [0,0,0,0,0,0]  # r6版本增加了HTTP活动类型
-                email_f = [0]*23            # 邮件特征：23维（增加了附件相关特征）
-            
-            # ========== 3.3.4 根据活动类型提取具体特征 ==========
-            if list_uacts[i] == 'file':
-                # 文件操作：提取文件类型、大小、深度等特征
-                file_f = file_process(df_acts_u.iloc[i], data = data)
-                
-            elif list_uacts[i] == 'email':
-                # 邮件活动：提取收件人数量、附件、外部邮件等特征
-                email_f = email_process(df_acts_u.iloc[i], data = data)
-                
-            elif list_uacts[i] == 'http':
-                # HTTP访问：提取URL类型、长度、内容等特征
-                http_f = http_process(df_acts_u.iloc[i], data=data)
-                
-            elif list_uacts[i] == 'connect':
-                # ========== 设备连接：需要特殊处理，计算连接持续时间 ==========
-                # 从当前活动开始，向后查找对应的断开连接活动
-                tmp = df_acts_u.iloc[i:]
-                
-                # 查找同一用户在同一PC上的断开连接活动
-                disconnect_acts = tmp[(tmp['activity'] == 'Disconnect\n') & \
-                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
-                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
-                
-                # 查找同一用户在同一PC上的后续连接活动（用于处理异常情况）
-                connect_acts = tmp[(tmp['activity'] == 'Connect\n') & \
-                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
-                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
-                
-                # 计算连接持续时间
-                if len(disconnect_acts) > 0:
-                    distime = disconnect_acts.iloc[0]['date']
-                    # 如果在断开之前又有连接，说明数据异常
-                    if len(connect_acts) > 0 and connect_acts.iloc[0]['date'] < distime:
-                        connect_dur = -1  # 标记为异常
-                    else:
-                        # 计算正常的连接持续时间（以秒为单位）
-                        tmp_td = distime - df_acts_u.iloc[i]['date']
-                        connect_dur = tmp_td.days*24*3600 + tmp_td.seconds
-                else:
-                    connect_dur = -1  # 没有找到断开连接活动，标记为异常
-                    
-                # 根据数据集版本设置设备特征
-                if data in ['r5.2','r5.1','r6.2','r6.1']:
-                    # 新版本增加了文件树长度特征
-                    file_tree_len = len(df_acts_u.iloc[i]['content'].split(';'))
-                    device_f = [connect_dur, file_tree_len]
-                else:
-                    device_f = [connect_dur]
-                
-            # ========== 3.3.5 检查是否为恶意活动 ==========
-            is_mal_act = 0
-            # 如果用户是恶意用户，且当前活动ID在恶意活动列表中
-            if mal_u > 0 and df_acts_u.index[i] in users.loc[u]['malacts']:
-                is_mal_act = 1
-
-            # ========== 3.3.6 组装完整的特征向量 ==========
-            # 特征向量组成：[用户ID, 天数, 活动类型, PC类型, 时间类型] + 各类活动特征 + [恶意活动标记, 内部威胁场景]
-            oneu_week[i,:] = [ user_dict[u], time_convert(df_acts_u.iloc[i]['date'], 'dt2dn'), list_uacts_num[i], pc, act_time] \
-            + device_f + file_f + http_f + email_f + [is_mal_act, mal_u]
-
-            # 保存活动的元信息：[活动索引, PC ID, 时间戳]
-            oneu_pc_time.append([df_acts_u.index[i], df_acts_u.iloc[i]['pc'], df_acts_u.iloc[i]['date']])
-            
-        # ========== 3.4 将当前用户的数据添加到总矩阵中 ==========
-        u_week[current_ind:current_ind+len(oneu_week),:] = oneu_week
-        pc_time += oneu_pc_time
-        current_ind += len(oneu_week)
-    
-    # ========== 4. 数据后处理和保存 ==========
-    # 截取实际使用的行数（去除初始化时的多余行）
-    u_week = u_week[0:current_ind, :]
-    
-    # ========== 4.1 定义列名 ==========
-    # 基础列：用户、天数、活动类型、PC类型、时间类型
-    col_names = ['user','day','act','pc','time']
-    
-    # 根据数据集版本定义各类特征的列名
-    if data in ['r4.1','r4.2']:
-        device_feature_names = ['usb_dur']  # 设备特征：USB持续时间
-        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth']
-        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
-        email_feature_names = ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
-    elif data in ['r5.2','r5.1', 'r6.2','r6.1']:
-        device_feature_names = ['usb_dur', 'file_tree_len']  # 增加文件树长度
-        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth', 'file_act', 'to_usb', 'from_usb']  # 增加USB传输特征
-        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
-        if data in ['r6.2','r6.1']:
-            http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords', 'http_act']  # r6版本增加HTTP活动类型
-        # 邮件特征大幅增加，包含发送/接收标记和各种附件特征
-        email_feature_names = ['send_mail', 'receive_mail','n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
-        # 附件类型特征：压缩包、图片、文档、文本、可执行文件
-        email_feature_names += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
-        # 附件大小特征：对应各种类型附件的总大小
-        email_feature_names += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe']     
-        
-    # 组合所有列名
-    col_names = col_names + device_feature_names + file_feature_names+ http_feature_names + email_feature_names + ['mal_act','insider']
+        empty_df = pd.DataFrame({'actid': pd.Series(dtype=object), 'pcid': pd.Series(dtype=object), 'time_stamp': pd.Series(dtype='datetime64[ns]')})
+        empty_df[get_num_columns(data)] = np.zeros((0, len(get_num_columns(data))), dtype=int)
+        save_frame(empty_df, "NumDataByWeek/"+str(week)+"_num_"+config_id, storage)
+        save_user_index("NumDataByWeek/"+str(week)+"_num_"+config_id, np.zeros(0, dtype=int), len(user_index))
+        return Counter()
+    
+    # 按userlist的顺序排列用户，每个用户内部保持时间顺序
+    user_rank = acts_week['user'].map({u: i for i, u in enumerate(userlist)})
+    acts_week = acts_week[user_rank.notna()]
+    acts_week = acts_week.iloc[np.argsort(user_rank.dropna().values, kind='stable')]
+    
+    # ========== 2. 特征矩阵和列位置 ==========
+    col_names = get_num_columns(data)
+    col_pos = {c: i for i, c in enumerate(col_names)}
+    u_week = np.zeros((len(acts_week), len(col_names)))
+    
+    # ========== 3. 基础列：用户、天数、活动类型、PC类型、时间类型 ==========
+    user_codes = user_index.get_indexer(acts_week['user'])
+    pc_codes = pd.Index(lookup['pcs']).get_indexer(acts_week['pc'])
+    time_ctx = time_context(acts_week['date'], work_hours = work_hours, weekend_days = weekend_days)
+    u_week[:, col_pos['user']] = user_codes
+    u_week[:, col_pos['day']] = time_ctx['day']
+    
+    # 对于登录和设备活动，使用activity列标准化后的值(logon/logoff/connect/disconnect)作为活动类型
+    activity = acts_week['activity'].str.strip()
+    is_device_act = activity.isin(['Logon', 'Logoff', 'Connect', 'Disconnect']).values
+    act_codes = np.where(is_device_act, activity.str.lower().map(ACT_CODES), acts_week['type'].map(ACT_CODES)).astype(int)
+    u_week[:, col_pos['act']] = act_codes
+    
+    # PC类型：0=自己的PC, 1=共享PC, 2=他人的PC, 3=主管的PC
+    u_week[:, col_pos['pc']] = pc_category(user_codes, pc_codes, lookup)
+    
+    # 时间类型：1=工作日工作时间, 2=工作日非工作时间, 3=周末工作时间, 4=周末非工作时间
+    u_week[:, col_pos['time']] = time_ctx['time']
+    
+    # ========== 4. 各类活动的特征块 ==========
+    # 跨周配对时读取下一周的设备活动，使周末晚上的连接可以和下周的断开配对
+    next_acts = None
+    next_week_file = "DataByWeek/"+str(week+1)
+    if usb_cross_week and os.path.exists(storage_path(next_week_file, storage)):
+        next_acts = load_frame(next_week_file, storage, columns=['user','pc','date','activity'], filters={'type': ['device']})
+    device_rows, device_f = device_features(acts_week, act_codes, data, next_acts)
+    if len(device_rows) > 0:
+        u_week[device_rows, col_pos['usb_dur']:col_pos['usb_dur']+device_f.shape[1]] = device_f
+    
+    email_col = 'n_des' if data in ['r4.1','r4.2'] else 'send_mail'
+    # 未知的文件操作类型只做统计，由主进程汇总后统一输出
+    unknown_file_acts = Counter()
+    for code, first_col, featurizer, kwargs in [(7, 'file_type', file_features, {'unknown_acts': unknown_file_acts}),
+                                                (5, 'http_type', http_features, {}), (6, email_col, email_features, {})]:
+        rows = np.flatnonzero(act_codes == code)
+        if len(rows) > 0:
+            block = featurizer(acts_week.iloc[rows], data = data, **kwargs)
+            u_week[rows, col_pos[first_col]:col_pos[first_col]+block.shape[1]] = block
+    
+    # ========== 5. 恶意用户和恶意活动标记 ==========
+    for i in user_index.get_indexer(userlist):
+        # 如果用户在恶意用户列表中（malscene > 0表示参与了某个恶意场景），
+        # 且当前周在该用户的恶意活动时间窗口内
+        if lookup['malscene'][i] > 0 and start_week <= lookup['mend'][i] and lookup['mstart'][i] <= end_week:
+            u_rows = user_codes == i
+            u_week[u_rows, col_pos['insider']] = lookup['malscene'][i]
+            u_week[u_rows & acts_week.index.isin(list(lookup['malacts'][i])), col_pos['mal_act']] = 1
+    
+    # ========== 6. 创建最终的DataFrame并保存 ==========
+    # 包含元信息列（活动ID, PC ID, 时间戳）和整数特征列
+    df_u_week = pd.DataFrame({'actid': acts_week.index.values, 'pcid': acts_week['pc'].values, 'time_stamp': acts_week['date'].values})
+    df_u_week[col_names] = u_week.astype(int)
     
-    # ========== 4.2 创建最终的DataFrame ==========
-    # 包含元信息列和特征列
-    df_u_week = pd.DataFrame(columns=['actid','pcid','time_stamp'] + col_names, index = np.arange(0,len(pc_time)))
-    
-    # 填充元信息
-    df_u_week[['actid','pcid','time_stamp']] = np.array(pc_time)
-    
-    # 填充特征数据并转换为整数类型（除了时间戳）
-    df_u_week[col_names] = u_week
-    df_u_week[col_names] = df_u_week[col_names].astype(int)
-    
-    # ========== 4.3 保存处理结果 ==========
     # 将处理后的数值特征保存到NumDataByWeek文件夹
     # 这些文件将被后续的统计特征计算函数使用
-    df_u_week.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
+    save_frame(df_u_week, "NumDataByWeek/"+str(week)+"_num_"+config_id, storage)
+    # 用户行索引: 只读取部分用户的配置按索引直接取出这些用户的行
+    save_user_index("NumDataByWeek/"+str(week)+"_num_"+config_id, user_codes, len(user_index))
+    return unknown_file_acts
 
 ##############################################################################
 
@@ -1621,64 +1262,152 @@ def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = N
 # sessions[sid] = [sessionid, pc, start_with, end_with, start time, end time,number_of_concurent_login, [action_indices]]
 # start_with: in the beginning of a week, action start with log in or not (1, 2)
 # end_with: log off, next log on same computer (1, 2)
-def get_sessions(uw, first_sid = 0):
+def get_sessions(w, first_sid = 0, carried = None, include_open = False):
     """
-    从用户活动数据中提取会话信息
+    从一周的活动数据中提取所有用户的会话信息
     参数:
-    - uw: 用户活动数据
+    - w: 一周的活动数据(每个用户的活动按时间排序)
     - first_sid: 起始会话ID
+    - carried: 前len(carried)行为上一周结束时仍未结束的会话的活动(见carry_open_sessions),
+      carried给出这些行所属会话在上一周已经累计的并发登录数
+    - include_open: 是否在sessions最后输出周末仍未结束的会话(会话ID为-1, 结束方式为0)
     返回:
-    - sessions: 会话字典,包含:
-      - 会话ID
-      - 电脑ID
-      - 开始方式(1=登录开始,2=其他方式开始)
-      - 结束方式(1=登出结束,2=下一次登录结束)
-      - 开始时间
-      - 结束时间
-      - 并发登录数
-      - 活动索引列表
-    """
-    sessions = {}
-    open_sessions = {}
-    sid = 0
-    current_pc = uw.iloc[0]['pcid']
-    start_time = uw.iloc[0]['time_stamp']
-    if uw.iloc[0]['act'] == 1:
-        open_sessions[current_pc] = [current_pc, 1, 0, start_time, start_time, 1, [uw.index[0]]]
-    else:
-        open_sessions[current_pc] = [current_pc, 2, 0, start_time, start_time, 1, [uw.index[0]]]
-
-    for i in uw.index[1:]:
-        current_pc = uw.loc[i]['pcid']
-        if current_pc in open_sessions: # must be already a session with that pcid
-            if uw.loc[i]['act'] == 2:
-                open_sessions[current_pc][2] = 1
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-                sessions[sid] = [first_sid+sid] + open_sessions.pop(current_pc)
-                sid +=1
-            elif uw.loc[i]['act'] == 1:
-                open_sessions[current_pc][2] = 2
-                sessions[sid] = [first_sid+sid] + open_sessions.pop(current_pc)
-                sid +=1
-                #create a new open session
-                open_sessions[current_pc] = [current_pc, 1, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-                if len(open_sessions) > 1: #increase the concurent count for all sessions
-                    for k in open_sessions:
-                        open_sessions[k][5] +=1
-            else:
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-        else:
-            start_status = 1 if uw.loc[i]['act'] == 1 else 2
-            open_sessions[current_pc] = [current_pc, start_status, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-            if len(open_sessions) > 1: #increase the concurent count for all sessions
-                for k in open_sessions:
-                    open_sessions[k][5] +=1
-    return sessions
+    - row_session: 每行所属会话的编号(sessions中的位置), 周末仍未结束的会话中的行为-1(include_open时除外)
+    - sessions: 按会话ID排序的数组字典:
+      - sid: 会话ID
+      - user: 用户编号
+      - pcid: 电脑ID
+      - start_with: 开始方式(1=登录开始,2=其他方式开始)
+      - end_with: 结束方式(1=登出结束,2=下一次登录结束,0=未结束)
+      - start_time: 开始时间
+      - end_time: 结束时间(会话最后一个活动的时间)
+      - n_concurrent: 并发登录数
+    功能:
+    - 每个(用户, 电脑)的活动流中, 流的第一个活动、登录或者登出之后的活动开始一个新会话
+    - 没有打开会话时的登出本身开始会话, 因此连续的登出交替地开始和结束会话
+    - 会话开始时如果该用户有多个打开的会话, 所有打开的会话并发数加1
+    - 会话ID按结束顺序编号, 周末仍未结束的会话不输出
+    - 从上一周延续的会话继续累计并发数, 这些会话在上一周的开始不再作为本周的开始事件计数
+    """
+    n = len(w)
+    n_carried = 0 if carried is None else len(carried)
+    user_order = np.argsort(w['user'].values.astype(int), kind = 'stable') # 位置: 按用户排列, 用户内保持时间顺序
+    user = w['user'].values.astype(int)[user_order]
+    act = w['act'].values[user_order]
+    _, pc_codes = np.unique(w['pcid'].values[user_order].astype(str), return_inverse = True)
+    
+    # 按(用户, 电脑)的活动流排列
+    pos = np.argsort(user * (pc_codes.max() + 1 if n > 0 else 1) + pc_codes, kind = 'stable')
+    s_act = act[pos]
+    first = np.ones(n, dtype = bool)
+    first[1:] = (user[pos][1:] != user[pos][:-1]) | (pc_codes[pos][1:] != pc_codes[pos][:-1])
+    
+    # 连续登出: 从流的第一个活动开始的登出序列在偶数位置开始会话, 其他登出序列在奇数位置开始会话
+    logoff = s_act == 2
+    prev_logoff = np.zeros(n, dtype = bool)
+    prev_logoff[1:] = logoff[:-1]
+    run_start = logoff & (first | ~prev_logoff)
+    run_first = np.maximum.accumulate(np.where(run_start, np.arange(n), 0)) if n > 0 else np.zeros(0, dtype = int)
+    k = np.arange(n) - run_first
+    opener = logoff & ((k % 2 == 0) == first[run_first])
+    closer = logoff & ~opener
+    prev_closer = np.zeros(n, dtype = bool)
+    prev_closer[1:] = closer[:-1]
+    opener |= ~logoff & (first | (s_act == 1) | prev_closer)
+    
+    # 会话的开始/结束位置(按用户排列的位置): 登出结束于登出行, 登录结束于同一电脑的下一次登录,
+    # 未结束的会话到用户最后一个活动之后才关闭(只用于计算并发数)
+    starts = np.flatnonzero(opener)
+    lasts = np.append(starts[1:], n)[:len(starts)] - 1
+    next_in_stream = np.append(~first[starts[1:]], False)
+    end_with = np.where(closer[lasts], 1, np.where(next_in_stream, 2, 0))
+    p_open = pos[starts]
+    user_end = np.searchsorted(user, user[p_open], side = 'right')
+    p_close = np.where(end_with == 1, pos[lasts], np.where(end_with == 2, pos[np.minimum(lasts + 1, n - 1)], user_end))
+    
+    # 会话开始后打开的会话数大于1时, 对所有打开的会话计数(上一周延续的会话的开始已经在上一周计数)
+    open_starts, close_sorted = np.sort(p_open), np.sort(p_close)
+    n_open = np.arange(1, len(open_starts) + 1) - np.searchsorted(close_sorted, open_starts, side = 'right')
+    bumps = open_starts[(n_open > 1) & (user_order[open_starts] >= n_carried)]
+    base_concurrent = np.ones(len(starts), dtype = int)
+    if n_carried > 0:
+        from_carried = user_order[p_open] < n_carried
+        base_concurrent[from_carried] = np.asarray(carried)[user_order[p_open[from_carried]]]
+    n_concurrent = base_concurrent + np.searchsorted(bumps, p_close) - np.searchsorted(bumps, p_open)
+    
+    closed = np.flatnonzero(end_with > 0)
+    closed = closed[np.argsort(p_close[closed], kind = 'stable')]
+    if include_open:
+        closed = np.append(closed, np.flatnonzero(end_with == 0))
+    session_of_start = np.full(len(starts), -1)
+    session_of_start[closed] = np.arange(len(closed))
+    row_session = np.empty(n, dtype = int)
+    row_session[user_order[pos]] = session_of_start[np.cumsum(opener) - 1]
+    
+    time_stamp = w['time_stamp'].values[user_order]
+    sessions = {'sid': np.where(end_with[closed] > 0, first_sid + np.arange(len(closed)), -1),
+                'user': user[p_open[closed]],
+                'pcid': w['pcid'].values[user_order][p_open[closed]],
+                'start_with': np.where(act[p_open[closed]] == 1, 1, 2),
+                'end_with': end_with[closed],
+                'start_time': time_stamp[p_open[closed]],
+                'end_time': time_stamp[pos[lasts[closed]]],
+                'n_concurrent': n_concurrent[closed]}
+    return row_session, sessions
+
+def carry_open_sessions(weeks, config_id = None, storage = 'pickle', user_codes = None):
+    """
+    按周顺序找出每周结束时仍未结束的会话, 供下一周的to_csv拼接跨周会话
+    参数:
+    - weeks: 需要处理的周(按顺序)
+    - config_id: 配置标识符
+    - storage: NumDataByWeek和tmp的存储格式
+    - user_codes: 只处理部分用户时这些用户在全体用户中的编号(见load_week_users)
+    功能:
+    - 只读取划分会话需要的列, 不计算特征, 因此可以在并行的to_csv之前串行执行
+    - 上一周仍未结束的会话的活动接在本周活动之前重新划分会话, 可以跨越多周
+    - 本周结束时仍未结束的会话的活动(来源周src_week和在该周中的行号src_row)及已累计的并发数
+      保存为tmp/{week}open_sessions_{config_id}
+    """
+    carried = pd.DataFrame()
+    for week in weeks:
+        w = load_week_users("NumDataByWeek/"+str(week)+"_num_"+config_id, storage, ['user', 'pcid', 'act', 'time_stamp'], user_codes)
+        w['src_week'] = week
+        w['src_row'] = np.arange(len(w))
+        if len(carried) > 0:
+            w = pd.concat([carried.drop(columns = ['n_concurrent']), w], ignore_index = True)
+        row_session, sessions = get_sessions(w, carried = carried['n_concurrent'].values if len(carried) > 0 else None, include_open = True)
+        in_open = row_session >= 0
+        in_open[in_open] = sessions['end_with'][row_session[in_open]] == 0
+        carried = w[in_open].reset_index(drop = True)
+        carried['n_concurrent'] = sessions['n_concurrent'][row_session[in_open]]
+        save_frame(carried, "tmp/"+str(week)+"open_sessions_"+config_id, storage)
+        print(f"第 {week} 周结束时未结束的会话: {len(set(zip(carried['user'], carried['pcid'])))} 个")
+
+def load_carried_sessions(week, data, config_id = None, storage = 'pickle', user_codes = None):
+    """
+    读取上一周结束时仍未结束的会话的全部活动(见carry_open_sessions)
+    返回:
+    - (活动数据, 各行所属会话已累计的并发数), 没有时返回(None, None)
+    """
+    open_file = "tmp/"+str(week-1)+"open_sessions_"+config_id
+    if not os.path.exists(storage_path(open_file, storage)):
+        return None, None
+    open_sessions = load_frame(open_file, storage)
+    if len(open_sessions) == 0:
+        return None, None
+    carried = pd.concat([load_week_users("NumDataByWeek/"+str(src)+"_num_"+config_id, storage, ['pcid','time_stamp'] + get_num_columns(data), user_codes).iloc[rows['src_row'].values]
+                         for src, rows in open_sessions.groupby('src_week', sort = True)], ignore_index = True)
+    return carried, open_sessions['n_concurrent'].values
                 
 def get_u_features_dicts(ul, data = 'r5.2'):
-    """获取用户特征字典"""
+    """
+    获取用户特征字典
+    返回:
+    - (ul, 特征值到数值的映射字典, 用户特征列表, 用户属性矩阵)
+    - 用户属性矩阵以用户编号(ul中的位置)为索引, 列为编码后的用户特征、ITAdmin和OCEAN心理特征,
+      各周各模式直接按用户编号取行, 不再逐个用户调用proc_u_features
+    """
     ufdict = {}
     list_uf=[] if data in ['r4.1','r4.2'] else ['project']
     list_uf += ['role','b_unit','f_unit', 'dept','team']
@@ -1687,7 +1416,11 @@ def get_u_features_dicts(ul, data = 'r5.2'):
         tmp = list(set(ul[f]))
         tmp.sort()
         ufdict[f] = {idx:i for i, idx in enumerate(tmp)}
-    return (ul,ufdict, list_uf)
+    u_attrs = pd.DataFrame({f: ul[f].map(ufdict[f]).values for f in list_uf})
+    u_attrs['ITAdmin'] = (ul['role'] == 'ITAdmin').astype(int).values
+    for f in ['O','C','E','A','N']:
+        u_attrs[f] = ul[f].values
+    return (ul,ufdict, list_uf, u_attrs)
 
 def proc_u_features(uf, ufdict, list_f = None, data = 'r4.2'): #to remove mode
     """处理用户特征"""
@@ -1700,40 +1433,282 @@ def proc_u_features(uf, ufdict, list_f = None, data = 'r4.2'): #to remove mode
         out.append(ufdict[f][uf[f]])
     return out
 
-def f_stats_calc(ud, fn, stats_f, countonly_f = {}, get_stats = False):
-    """计算特征统计信息"""
-    f_count = len(ud)
-    r = []
-    f_names = []
-    
-    for f in stats_f:
-        inp = ud[f].values
-        if get_stats:
-            if f_count > 0:
-                r += [np.min(inp), np.max(inp), np.median(inp), np.mean(inp), np.std(inp)]
-            else: r += [0, 0, 0, 0, 0]
-            f_names += [fn+'_min_'+f, fn+'_max_'+f, fn+'_med_'+f, fn+'_mean_'+f, fn+'_std_'+f]
-        else:
-            if f_count > 0: r += [np.mean(inp)]
-            else: r += [0]
-            f_names += [fn+'_mean_'+f]
-        
-    for f in countonly_f:
-        for v in countonly_f[f]:
-            r += [sum(ud[f].values == v)]
-            f_names += [fn+'_n-'+f+str(v)]
-    return (f_count, r, f_names)
-
-def f_calc_subfeatures(ud, fname, filter_col, filter_vals, filter_names, sub_features, countonly_subfeatures):
-    """计算子特征"""
-    [n, stats, fnames] = f_stats_calc(ud, fname,sub_features, countonly_subfeatures)
-    allf = [n] + stats
-    allf_names = ['n_'+fname] + fnames
-    for i in range(len(filter_vals)):
-        [n_sf, sf_stats, sf_fnames] = f_stats_calc(ud[ud[filter_col]==filter_vals[i]], filter_names[i], sub_features, countonly_subfeatures)
-        allf += [n_sf] + sf_stats
-        allf_names += [fname+'_n_'+filter_names[i]] + [fname + '_' + x for x in sf_fnames]
-    return (allf, allf_names)
+# f_calc中按时间段划分的特征前缀及其包含的时间类型
+# (1: 工作日工作时间, 2: 工作日非工作时间, 3: 周末工作时间, 4: 周末非工作时间)
+F_CALC_PERIODS = {'week': [('', [1,2,3,4]), ('workhour', [1]), ('afterhour', [2]), ('weekend', [3,4])],
+                  'day': [('', [1,2,3,4]), ('workhour', [1,3]), ('afterhour', [2,4])],
+                  'session': [('', [1,2,3,4])]}
+
+R4_DATA = ['r4.1','r4.2']
+R5_R6_DATA = ['r5.1','r5.2','r6.1','r6.2']
+PC_COUNT = {'col': 'pc', 'vals': [0,1,2,3], 'modes': ['week','day']}
+
+# f_calc的特征规格, 按输出顺序列出每个特征族:
+# - act: 活动类型(None表示全部活动)
+# - filter: 子类列, 子类取值和子类名称, 每个子类再单独计算一次计数和统计特征
+# - stats: 求均值(get_stats时求min/max/med/mean/std)的列
+# - count: 只计数的列及取值
+# stats/count/filter中的条目可用modes和data限定适用的模式和数据集, stats中的字符串表示无限定的列
+FEATURE_SPEC = [
+    {'name': 'allact', 'act': None, 'count': [PC_COUNT]},
+    {'name': 'logon', 'act': 1, 'count': [PC_COUNT]},
+    {'name': 'usb', 'act': 3, 'stats': ['usb_dur', {'col': 'file_tree_len', 'data': R5_R6_DATA}], 'count': [PC_COUNT]},
+    {'name': 'file', 'act': 7, 
+     'filter': {'col': 'file_type', 'vals': [1,2,3,4,5,6], 'names': ['otherf','compf','phof','docf','txtf','exef']},
+     'stats': ['file_len', 'file_depth', 'file_nwords'],
+     'count': [{'col': 'to_usb', 'vals': [1], 'data': R5_R6_DATA}, {'col': 'from_usb', 'vals': [1], 'data': R5_R6_DATA},
+               {'col': 'file_act', 'vals': [1,2,3,4], 'data': R5_R6_DATA},
+               {'col': 'disk', 'vals': [0,1], 'modes': ['week','day']}, {'col': 'disk', 'vals': [0,1,2], 'modes': ['session']}, PC_COUNT]},
+    {'name': 'email', 'act': 6, 
+     'filter': {'col': 'send_mail', 'vals': [0,1], 'names': ['recvmail','send_mail'], 'data': R5_R6_DATA},
+     'stats': ['n_des', 'n_atts', 'n_exdes', 'n_bccdes', 'email_size', 'email_text_slen', 'email_text_nwords'] + 
+              [{'col': c, 'data': R5_R6_DATA} for c in ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe',
+                                                       'e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe']],
+     'count': [{'col': 'Xemail', 'vals': [1]}, {'col': 'exbccmail', 'vals': [1]}, PC_COUNT]},
+    {'name': 'http', 'act': 5, 
+     'filter': {'col': 'http_type', 'vals': [1,2,3,4,5,6], 'names': ['otherf','socnetf','cloudf','jobf','leakf','hackf']},
+     'stats': ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'],
+     'count': [PC_COUNT, {'col': 'http_act', 'vals': [1,2,3], 'data': ['r6.1','r6.2']}]},
+]
+
+# 编译好的特征计算计划, 键为(模式, 数据集, 计算完整统计量的特征族)
+feature_plans = {}
+
+def spec_items(items, mode, data):
+    """按模式和数据集筛选特征规格中的条目"""
+    items = [{'col': x} if isinstance(x, str) else x for x in items]
+    return [x for x in items if mode in x.get('modes', [mode]) and data in x.get('data', [data])]
+
+def compile_feature_plan(mode = 'week', data = 'r4.2', get_stats = False):
+    """
+    把FEATURE_SPEC编译为计算计划(按模式、数据集和get_stats缓存)
+    参数:
+    - mode: 计算模式(week/day/session)
+    - data: 数据集名称
+    - get_stats: True表示所有特征族都计算min/max/med/mean/std, 也可以给出特征族名称的列表, 其余特征族只计算均值
+    返回:
+    - 计划字典: blocks为各特征族的计算步骤(每个时间段和子类一个cell, 带有输出的特征名),
+      columns为按输出顺序的全部特征名, acts和eq_masks为各特征族共用的行选择和取值掩码
+    """
+    stats_families = frozenset(f['name'] for f in FEATURE_SPEC) if get_stats is True else frozenset(get_stats or [])
+    key = (mode, data, stats_families)
+    if key not in feature_plans:
+        periods = [(prefix, np.array(times) - 1) for prefix, times in F_CALC_PERIODS[mode]]
+        stat_names = [('min','_min_'), ('max','_max_'), ('median','_med_'), ('mean','_mean_'), ('std','_std_')]
+        blocks, columns, eq_masks = [], [], []
+        for family in FEATURE_SPEC:
+            filt = family.get('filter')
+            if filt is not None and data not in filt.get('data', [data]): 
+                filt = None
+            block = {'act': family.get('act'), 
+                     'filter_col': filt['col'] if filt else None,
+                     'filter_vals': filt['vals'] if filt else [],
+                     'stats': [x['col'] for x in spec_items(family.get('stats', []), mode, data)],
+                     'counts': [(x['col'], v) for x in spec_items(family.get('count', []), mode, data) for v in x['vals']],
+                     'get_stats': family['name'] in stats_families,
+                     'cells': []}
+            block['stat_names'] = stat_names if block['get_stats'] else [('mean','_mean_')]
+            eq_masks += [c for c in block['counts'] if c not in eq_masks]
+            
+            for prefix, tsel in periods:
+                pname = prefix + family['name']
+                subsets = [('n_'+pname, pname)] + [(pname+'_n_'+fn, pname+'_'+fn) for fn in (filt['names'] if filt else [])]
+                for i, (count_name, fprefix) in enumerate(subsets):
+                    cell = {'tsel': tsel, 'sub': i - 1 if i > 0 else None, 'count': count_name,
+                            'stats': [[fprefix+sname+f for _, sname in block['stat_names']] for f in block['stats']],
+                            'counts': [fprefix+'_n-'+f+str(v) for f, v in block['counts']]}
+                    block['cells'].append(cell)
+                    columns += [count_name] + sum(cell['stats'], []) + cell['counts']
+            blocks.append(block)
+        acts = list(dict.fromkeys(block['act'] for block in blocks))
+        feature_plans[key] = {'blocks': blocks, 'columns': columns, 'acts': acts, 'eq_masks': eq_masks}
+    return feature_plans[key]
+
+def f_calc_partials(w, group, n_groups, modes = 'week', data = 'r4.2', get_stats = False):
+    """
+    按组计算f_calc特征的可合并中间状态
+    参数:
+    - w: NumDataByWeek数据
+    - group: 每行所属的组编号(0..n_groups-1), 不属于任何组的行为-1
+    - n_groups: 组数
+    - modes: 之后要计算的模式(week/day/session), 可以是列表; 只计数的列取各模式的并集,
+      因此同一个中间状态可以合并并计算多种模式的特征
+    - data, get_stats: 见f_calc_grouped
+    返回:
+    - 中间状态字典: data, get_stats, n_groups, 以及blocks中每个特征族的:
+      - cnt: 每组每个(时间类型, 子类)的活动数, 形状为(组数, 4, 子类数)
+      - sums: 求均值的列在每个(组, 时间类型, 子类)中的和
+      - eqs: 只计数的列取各个值的活动数
+      - sumsq, min, max: 计算完整统计量的特征族的平方和、最小值和最大值
+      - values: 计算完整统计量的特征族保留的原始取值(组, 时间类型, 子类, 各列取值), 用于计算中位数
+    功能:
+    - 每个特征族只扫描一次: 以(组, 时间类型, 子类)为键做bincount
+    - 活动类型的行选择和只计数列的取值掩码在各特征族之间共用
+    - 中间状态都是可合并的, 可以用merge_partials合并为更粗的组(如由天合并为周, 由会话片段合并为会话)
+    """
+    plans = [compile_feature_plan(m, data, get_stats) for m in ([modes] if isinstance(modes, str) else modes)]
+    keep = group >= 0
+    g_all, act_all, time_all = group[keep], w['act'].values[keep], w['time'].values[keep] - 1
+    columns = {}
+    def col(f):
+        if f not in columns:
+            columns[f] = w[f].values[keep]
+        return columns[f]
+    act_rows = {}
+    eq_masks = {}
+    
+    blocks = []
+    for mode_blocks in zip(*[plan['blocks'] for plan in plans]):
+        block = mode_blocks[0]
+        counts = list(dict.fromkeys(c for b in mode_blocks for c in b['counts']))
+        if block['act'] not in act_rows:
+            act_rows[block['act']] = np.flatnonzero(act_all == block['act']) if block['act'] is not None else np.arange(len(g_all))
+        for c in counts:
+            if c not in eq_masks:
+                eq_masks[c] = col(c[0]) == c[1]
+        rows = act_rows[block['act']]
+        g, t = g_all[rows], time_all[rows]
+        n_sub = len(block['filter_vals']) + 1 # 最后一个子类为不在filter_vals中的活动
+        fidx = np.full(len(rows), len(block['filter_vals']))
+        if block['filter_col'] is not None:
+            fv = col(block['filter_col'])[rows]
+            for i, v in enumerate(block['filter_vals']):
+                fidx[fv == v] = i
+        key = (g*4 + t)*n_sub + fidx
+        shape = (n_groups, 4, n_sub)
+        def agg(weights = None, mask = slice(None)):
+            return np.bincount(key[mask], weights = None if weights is None else weights[mask], minlength = n_groups*4*n_sub).reshape(shape)
+        part = {'cnt': agg(), 
+                'sums': {f: agg(weights = col(f)[rows].astype(float)) for f in block['stats']},
+                'eqs': {c: agg(mask = eq_masks[c][rows]) for c in counts},
+                'sumsq': None, 'min': None, 'max': None, 'values': None}
+        if block['get_stats']:
+            part['sumsq'] = {f: agg(weights = col(f)[rows].astype(float)**2) for f in block['stats']}
+            part['min'], part['max'] = {}, {}
+            for f in block['stats']:
+                part['min'][f] = np.full(n_groups*4*n_sub, np.inf)
+                np.minimum.at(part['min'][f], key, col(f)[rows])
+                part['min'][f] = part['min'][f].reshape(shape)
+                part['max'][f] = np.full(n_groups*4*n_sub, -np.inf)
+                np.maximum.at(part['max'][f], key, col(f)[rows])
+                part['max'][f] = part['max'][f].reshape(shape)
+            part['values'] = {'group': g, 'time': t, 'sub': fidx, 'values': {f: col(f)[rows] for f in block['stats']}}
+        blocks.append(part)
+    return {'data': data, 'get_stats': get_stats, 'n_groups': n_groups, 'blocks': blocks}
+
+def merge_partials(partials, mapping, n_groups):
+    """
+    把f_calc_partials的中间状态合并为更粗的组
+    参数:
+    - partials: 中间状态
+    - mapping: 每个原组对应的新组编号, -1表示丢弃
+    - n_groups: 新组数
+    """
+    keep = mapping >= 0
+    def merge(a, dtype):
+        k = a.shape[1]*a.shape[2]
+        idx = (mapping[keep][:, None]*k + np.arange(k)).ravel()
+        return np.bincount(idx, weights = a[keep].reshape(-1), minlength = n_groups*k).reshape((n_groups,) + a.shape[1:]).astype(dtype)
+    def merge_extreme(a, ufunc, fill):
+        out = np.full((n_groups,) + a.shape[1:], fill)
+        ufunc.at(out, mapping[keep], a[keep])
+        return out
+    blocks = []
+    for part in partials['blocks']:
+        merged = {'cnt': merge(part['cnt'], int), 
+                  'sums': {f: merge(a, float) for f, a in part['sums'].items()},
+                  'eqs': {c: merge(a, int) for c, a in part['eqs'].items()},
+                  'sumsq': None, 'min': None, 'max': None, 'values': None}
+        if part['values'] is not None:
+            merged['sumsq'] = {f: merge(a, float) for f, a in part['sumsq'].items()}
+            merged['min'] = {f: merge_extreme(a, np.minimum, np.inf) for f, a in part['min'].items()}
+            merged['max'] = {f: merge_extreme(a, np.maximum, -np.inf) for f, a in part['max'].items()}
+            g = mapping[part['values']['group']]
+            in_group = g >= 0
+            merged['values'] = {'group': g[in_group], 'time': part['values']['time'][in_group], 'sub': part['values']['sub'][in_group],
+                                'values': {f: v[in_group] for f, v in part['values']['values'].items()}}
+        blocks.append(merged)
+    return dict(partials, n_groups = n_groups, blocks = blocks)
+
+def f_calc_finalize(partials, mode = 'week'):
+    """
+    由中间状态计算某个模式的f_calc全部特征
+    参数:
+    - partials: 中间状态(计算时modes需要包含mode)
+    - mode: 计算模式(week/day/session)
+    返回:
+    - [(特征名, 每组的值, 每组对应的活动数是否为0)], 只有统计特征给出第三项, 计数特征为None
+    功能:
+    - 按计划中的时间段和子类对中间状态求和得到各个计数和均值
+    - 计算完整统计量的特征族由最小值、最大值、和与平方和得到min/max/mean/std, 由原始取值得到中位数
+    """
+    plan = compile_feature_plan(mode, partials['data'], partials['get_stats'])
+    n_groups = partials['n_groups']
+    features = []
+    for block, part in zip(plan['blocks'], partials['blocks']):
+        for cell in block['cells']:
+            tsel, sub = cell['tsel'], cell['sub']
+            axes = (1, 2) if sub is None else 1
+            select = (lambda a: a[:, tsel, :]) if sub is None else (lambda a: a[:, tsel, sub])
+            pick = lambda a: select(a).sum(axis = axes)
+            n = pick(part['cnt'])
+            empty = n == 0
+            features.append((cell['count'], n, None))
+            if block['get_stats'] and len(block['stats']) > 0:
+                values = part['values']
+                in_cell = np.isin(values['time'], tsel) & ((values['sub'] == sub) if sub is not None else True)
+                medians = pd.DataFrame({f: values['values'][f][in_cell] for f in block['stats']}).groupby(values['group'][in_cell]).median()
+                medians = medians.reindex(np.arange(n_groups)).fillna(0)
+                for f, names in zip(block['stats'], cell['stats']):
+                    mean = np.divide(pick(part['sums'][f]), n, out = np.zeros(n_groups), where = ~empty)
+                    var = np.divide(pick(part['sumsq'][f]), n, out = np.zeros(n_groups), where = ~empty) - mean**2
+                    stats = {'min': np.where(empty, 0, select(part['min'][f]).min(axis = axes)),
+                             'max': np.where(empty, 0, select(part['max'][f]).max(axis = axes)),
+                             'median': medians[f].values, 'mean': mean, 'std': np.sqrt(np.maximum(var, 0))}
+                    features += [(name, stats[stat], empty) for (stat, _), name in zip(block['stat_names'], names)]
+            else:
+                for f, names in zip(block['stats'], cell['stats']):
+                    features.append((names[0], np.divide(pick(part['sums'][f]), n, out=np.zeros(n_groups), where=~empty), empty))
+            for c, name in zip(block['counts'], cell['counts']):
+                features.append((name, pick(part['eqs'][c]), None))
+    return features
+
+def f_calc_grouped(w, group, n_groups, mode = 'week', data = 'r4.2', get_stats = False):
+    """
+    对一周的数值化数据按组(用户/用户-天/会话)一次性计算f_calc的全部特征
+    参数:
+    - w: NumDataByWeek数据
+    - group: 每行所属的组编号(0..n_groups-1), 不属于任何组的行为-1
+    - n_groups: 组数
+    - mode: 计算模式(week/day/session)
+    - data: 数据集名称
+    - get_stats: 计算完整统计量的特征族(见compile_feature_plan)
+    返回:
+    - [(特征名, 每组的值, 每组对应的活动数是否为0)], 只有统计特征给出第三项, 计数特征为None
+    """
+    return f_calc_finalize(f_calc_partials(w, group, n_groups, mode, data, get_stats), mode)
+
+def f_calc_frame(features):
+    """
+    把f_calc_grouped的结果转换为DataFrame(每组一行)
+    与原来逐行生成列表再构造DataFrame时的类型一致: 计数特征为整数, 均值特征在所有组都没有活动时为整数0
+    """
+    df = pd.DataFrame({name: values for name, values, _ in features})
+    for name, values, empty in features:
+        if empty is not None and empty.all():
+            df[name] = df[name].astype(int)
+    return df
+
+def f_calc_labels(w, group, n_groups):
+    """按组返回(活动数, 是否有周末工作时间活动, 内部威胁场景编号(只在组内有恶意活动时非0))"""
+    keep = group >= 0
+    g = group[keep]
+    n_acts = np.bincount(g, minlength = n_groups)
+    is_weekend = (np.bincount(g, weights = w['time'].values[keep] == 3, minlength = n_groups) > 0).astype(int)
+    n_mal = np.bincount(g, weights = w['mal_act'].values[keep], minlength = n_groups)
+    insider = np.zeros(n_groups, dtype = int)
+    np.maximum.at(insider, g, w['insider'].values[keep].astype(int))
+    return n_acts, is_weekend, np.where(n_mal > 0, insider, 0)
 
 def f_calc(ud, mode = 'week', data = 'r4.2'):
     """
@@ -1745,323 +1720,494 @@ def f_calc(ud, mode = 'week', data = 'r4.2'):
     功能:
     - 计算各类活动的统计特征
     - 区分工作时间/非工作时间特征
-    - 生成特征向量
-    """
-    n_weekendact = (ud['time']==3).sum()
-    if n_weekendact > 0: 
-        is_weekend = 1
-    else: 
-        is_weekend = 0
-    
-    all_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    [all_f, all_f_names] = f_calc_subfeatures(ud, 'allact', None, [], [], [], all_countonlyf)
-    if mode == 'day':
-        [workhourf, workhourf_names] = f_calc_subfeatures(ud[(ud['time'] == 1) | (ud['time'] == 3)], 'workhourallact', None, [], [], [], all_countonlyf)
-        [afterhourf, afterhourf_names] = f_calc_subfeatures(ud[(ud['time'] == 2) | (ud['time'] == 4) ], 'afterhourallact', None, [], [], [], all_countonlyf)
-    elif mode == 'week':
-        [workhourf, workhourf_names] = f_calc_subfeatures(ud[ud['time'] == 1], 'workhourallact', None, [], [], [], all_countonlyf)
-        [afterhourf, afterhourf_names] = f_calc_subfeatures(ud[ud['time'] == 2 ], 'afterhourallact', None, [], [], [], all_countonlyf)
-        [weekendf, weekendf_names] = f_calc_subfeatures(ud[ud['time'] >= 3 ], 'weekendallact', None, [], [], [], all_countonlyf)
-
-    logon_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    logon_statf = []
-        
-    [all_logonf, all_logonf_names] = f_calc_subfeatures(ud[ud['act']==1], 'logon', None, [], [], logon_statf, logon_countonlyf)
-    if mode == 'day':
-        [workhourlogonf, workhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & ((ud['time'] == 1) | (ud['time'] == 3) )], 'workhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [afterhourlogonf, afterhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & ((ud['time'] == 2) | (ud['time'] == 4) )], 'afterhourlogon', None, [], [], logon_statf, logon_countonlyf)
-    elif mode == 'week':
-        [workhourlogonf, workhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] == 1)], 'workhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [afterhourlogonf, afterhourlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] == 2) ], 'afterhourlogon', None, [], [], logon_statf, logon_countonlyf)
-        [weekendlogonf, weekendlogonf_names] = f_calc_subfeatures(ud[(ud['act']==1) & (ud['time'] >= 3) ], 'weekendlogon', None, [], [], logon_statf, logon_countonlyf)
-    
-    device_countonlyf = {'pc':[0,1,2,3]} if mode != 'session' else {}
-    device_statf = ['usb_dur','file_tree_len'] if data not in ['r4.1','r4.2'] else ['usb_dur']
-        
-    [all_devicef, all_devicef_names] = f_calc_subfeatures(ud[ud['act']==3], 'usb', None, [], [], device_statf, device_countonlyf)
-    if mode == 'day':
-        [workhourdevicef, workhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & ((ud['time'] == 1) | (ud['time'] == 3) )], 'workhourusb', None, [], [], device_statf, device_countonlyf)
-        [afterhourdevicef, afterhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & ((ud['time'] == 2) | (ud['time'] == 4) )], 'afterhourusb', None, [], [], device_statf, device_countonlyf)
-    elif mode == 'week':
-        [workhourdevicef, workhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] == 1)], 'workhourusb', None, [], [], device_statf, device_countonlyf)
-        [afterhourdevicef, afterhourdevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] == 2) ], 'afterhourusb', None, [], [], device_statf, device_countonlyf)
-        [weekenddevicef, weekenddevicef_names] = f_calc_subfeatures(ud[(ud['act']==3) & (ud['time'] >= 3) ], 'weekendusb', None, [], [], device_statf, device_countonlyf)
-          
-    if mode != 'session': file_countonlyf = {'to_usb':[1],'from_usb':[1], 'file_act':[1,2,3,4], 'disk':[0,1], 'pc':[0,1,2,3]}
-    else: file_countonlyf = {'to_usb':[1],'from_usb':[1], 'file_act':[1,2,3,4], 'disk':[0,1,2]}
-    if data in ['r4.1','r4.2']: 
-        [file_countonlyf.pop(k) for k in ['to_usb','from_usb', 'file_act']]
-    
-    (all_filef, all_filef_names) = f_calc_subfeatures(ud[ud['act']==7], 'file', 'file_type', [1,2,3,4,5,6], \
-            ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-    
-    if mode == 'day':
-        (workhourfilef, workhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (afterhourfilef, afterhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-    elif mode == 'week':
-        (workhourfilef, workhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] ==1)], 'workhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (afterhourfilef, afterhourfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] ==2)], 'afterhourfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        (weekendfilef, weekendfilef_names) = f_calc_subfeatures(ud[(ud['act']==7) & (ud['time'] >= 3)], 'weekendfile', 'file_type', [1,2,3,4,5,6], ['otherf','compf','phof','docf','txtf','exef'], ['file_len', 'file_depth', 'file_nwords'], file_countonlyf)
-        
-    email_stats_f = ['n_des', 'n_atts', 'n_exdes', 'n_bccdes', 'email_size', 'email_text_slen', 'email_text_nwords']
-    if data not in ['r4.1','r4.2']:
-        email_stats_f += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
-        email_stats_f += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe'] 
-        mail_filter = 'send_mail'
-        mail_filter_vals = [0,1]
-        mail_filter_names = ['recvmail','send_mail']
-    else:
-        mail_filter, mail_filter_vals, mail_filter_names = None, [], []    
-    
-    if mode != 'session': mail_countonlyf = {'Xemail':[1],'exbccmail':[1], 'pc':[0,1,2,3]}
-    else: mail_countonlyf = {'Xemail':[1],'exbccmail':[1]}
-    
-    (all_emailf, all_emailf_names) = f_calc_subfeatures(ud[ud['act']==6], 'email', mail_filter, mail_filter_vals, mail_filter_names , email_stats_f, mail_countonlyf)
-    if mode == 'week':
-        (workhouremailf, workhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] == 1)], 'workhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (afterhouremailf, afterhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] == 2)], 'afterhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (weekendemailf, weekendemailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & (ud['time'] >= 3)], 'weekendemail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-    elif mode == 'day':
-        (workhouremailf, workhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)
-        (afterhouremailf, afterhouremailf_names) = f_calc_subfeatures(ud[(ud['act']==6) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhouremail', mail_filter, mail_filter_vals, mail_filter_names, email_stats_f, mail_countonlyf)    
-    
-    if data in ['r5.2','r5.1'] or data in ['r4.1','r4.2']:
-        http_count_subf =  {'pc':[0,1,2,3]}
-    elif data in ['r6.2','r6.1']:
-        http_count_subf = {'pc':[0,1,2,3], 'http_act':[1,2,3]}
-    
-    if mode == 'session': http_count_subf.pop('pc',None)
-
-    (all_httpf, all_httpf_names) = f_calc_subfeatures(ud[ud['act']==5], 'http', 'http_type', [1,2,3,4,5,6], \
-            ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-    
-    if mode == 'week':
-        (workhourhttpf, workhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] ==1)], 'workhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (afterhourhttpf, afterhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] ==2)], 'afterhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (weekendhttpf, weekendhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & (ud['time'] >=3)], 'weekendhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-    elif mode == 'day':
-        (workhourhttpf, workhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & ((ud['time'] ==1) | (ud['time'] ==3))], 'workhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        (afterhourhttpf, afterhourhttpf_names) = f_calc_subfeatures(ud[(ud['act']==5) & ((ud['time'] ==2) | (ud['time'] ==4))], 'afterhourhttp', 'http_type', [1,2,3,4,5,6], \
-                ['otherf','socnetf','cloudf','jobf','leakf','hackf'], ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], http_count_subf)
-        
-    numActs = all_f[0]
-    mal_u = 0
-    if (ud['mal_act']).sum() > 0:
-        tmp = list(set(ud['insider']))
-        if len(tmp) > 1:
-            tmp.remove(0.0)
-        mal_u = tmp[0]
-        
-    if mode == 'week':        
-        features_tmp =  all_f + workhourf + afterhourf + weekendf +\
-                        all_logonf + workhourlogonf + afterhourlogonf + weekendlogonf +\
-                        all_devicef + workhourdevicef + afterhourdevicef + weekenddevicef +\
-                        all_filef + workhourfilef + afterhourfilef + weekendfilef + \
-                        all_emailf + workhouremailf + afterhouremailf + weekendemailf + all_httpf + workhourhttpf + afterhourhttpf + weekendhttpf
-        fnames_tmp = all_f_names + workhourf_names + afterhourf_names + weekendf_names +\
-                      all_logonf_names + workhourlogonf_names + afterhourlogonf_names + weekendlogonf_names +\
-                      all_devicef_names + workhourdevicef_names + afterhourdevicef_names + weekenddevicef_names +\
-                      all_filef_names + workhourfilef_names + afterhourfilef_names + weekendfilef_names + \
-                      all_emailf_names + workhouremailf_names + afterhouremailf_names + weekendemailf_names + all_httpf_names + workhourhttpf_names + afterhourhttpf_names + weekendhttpf_names
-    elif mode == 'day':
-        features_tmp = all_f + workhourf + afterhourf +\
-                        all_logonf + workhourlogonf + afterhourlogonf +\
-                        all_devicef + workhourdevicef + afterhourdevicef + \
-                        all_filef + workhourfilef + afterhourfilef + \
-                        all_emailf + workhouremailf + afterhouremailf + all_httpf + workhourhttpf + afterhourhttpf
-        fnames_tmp = all_f_names + workhourf_names + afterhourf_names +\
-                      all_logonf_names + workhourlogonf_names + afterhourlogonf_names +\
-                      all_devicef_names + workhourdevicef_names + afterhourdevicef_names +\
-                      all_filef_names + workhourfilef_names + afterhourfilef_names + \
-                      all_emailf_names + workhouremailf_names + afterhouremailf_names + all_httpf_names + workhourhttpf_names + afterhourhttpf_names
-    elif mode == 'session':
-        features_tmp = all_f + all_logonf + all_devicef + all_filef + all_emailf + all_httpf
-        fnames_tmp = all_f_names + all_logonf_names + all_devicef_names + all_filef_names + all_emailf_names + all_httpf_names
-    
+    - 生成特征向量(ud作为一个组交给f_calc_grouped计算)
+    """
+    group = np.zeros(len(ud), dtype = int)
+    features = f_calc_grouped(ud, group, 1, mode, data)
+    features_tmp = [0 if empty is not None and empty[0] else values[0] for _, values, empty in features]
+    fnames_tmp = [name for name, _, _ in features]
+    numActs, is_weekend, mal_u = [x[0] for x in f_calc_labels(ud, group, 1)]
     return [numActs, is_weekend, features_tmp, fnames_tmp, mal_u]
 
-def session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf):
+def lexsort_groups(keys):
     """
-    计算会话实例的特征
+    按多个键对行做一次稳定排序, 键值相同的行在排序后成为连续的一段
     参数:
-    - ud: 用户数据
-    - sinfo: 会话信息
+    - keys: 等长整数数组的列表, 第一个为主键
+    返回:
+    - (order, starts, group): 排序后的行号, 每组在order中的起始位置, 每行所属的组编号
+    功能:
+    - 组按键的字典序编号, 与np.unique一致; 排序稳定, 因此order[starts]为每组在原顺序中的第一行
+    - 组边界由相邻行键值的变化得到, 不需要把多个键拼成一个数或对行做np.unique(axis=0)
+    """
+    n = len(keys[0])
+    order = np.lexsort(keys[::-1])
+    change = np.ones(n, dtype = bool)
+    for k in keys:
+        k = k[order]
+        change[1:] = change[1:] & (k[1:] == k[:-1])
+    change = ~change
+    if n > 0:
+        change[0] = True
+    group = np.empty(n, dtype = int)
+    group[order] = np.cumsum(change) - 1
+    return order, np.flatnonzero(change), group
+
+def session_pieces(w, row_session, sessions, subsession_mode = {}):
+    """
+    按所有子会话划分方式把会话切成最细的片段
+    参数:
+    - w: 一周的数值化数据
+    - row_session, sessions: get_sessions的结果
+    - subsession_mode: 子会话模式配置
+    返回:
+    - 片段字典: pieces为每个片段的(会话, 各划分方式中的子会话序号), row_piece为每行所属片段(不属于会话的行为-1),
+      splits为每种划分方式的(划分方式, 参数, 每个会话的子会话数)
+    功能:
+    - 按时间(time)划分时, 第i个子会话为会话开始后[i*分钟数, (i+1)*分钟数)内的活动;
+      按活动数量(nact)划分时, 每ss_nact个活动为一个子会话
+    """
+    n_sessions = len(sessions['sid'])
+    ts = w['time_stamp'].values.astype('int64')
+    rows = np.flatnonzero(row_session >= 0)
+    s = row_session[rows]
+    n_acts = np.bincount(s, minlength = n_sessions)
+    start_ns = np.full(n_sessions, np.iinfo(np.int64).max)
+    np.minimum.at(start_ns, s, ts[rows])
+    end_ns = np.full(n_sessions, np.iinfo(np.int64).min)
+    np.maximum.at(end_ns, s, ts[rows])
+    s_dur = np.array([(pd.Timestamp(b) - pd.Timestamp(a)).total_seconds() / 60 for a, b in zip(start_ns, end_ns)]) # in minute
+    
+    # 每行在各种子会话划分中的序号及每个会话的子会话数
+    order = np.argsort(s, kind = 'stable')
+    rank = np.empty(len(rows), dtype = int)
+    rank[order] = np.arange(len(rows)) - np.append(0, np.cumsum(n_acts))[s[order]]
+    splits, chunks = [], []
+    for k1 in subsession_mode:
+        for k2 in subsession_mode[k1]:
+            if k1 == 'time':
+                chunks.append((ts[rows] - start_ns[s]) // (k2*60*10**9))
+                splits.append((k1, k2, np.ceil(s_dur / k2).astype(int)))
+            else:
+                chunks.append(rank // k2)
+                splits.append((k1, k2, np.ceil(n_acts / k2).astype(int)))
+    
+    order, starts, piece_of_row = lexsort_groups([s] + chunks)
+    pieces = np.column_stack([s[order[starts]]] + [chunk[order[starts]] for chunk in chunks])
+    row_piece = np.full(len(w), -1)
+    row_piece[rows] = piece_of_row
+    return {'pieces': pieces, 'row_piece': row_piece, 'splits': splits}
+
+def session_instances(w, sessions, pieces, partials, week, u_attrs, cols):
+    """
+    计算会话及子会话实例的特征
+    参数:
+    - w: 一周的数值化数据
+    - sessions: get_sessions的结果
+    - pieces: session_pieces的结果
+    - partials: 每个片段的f_calc中间状态
     - week: 周数
-    - mode: 模式(week/day/session)
-    - data: 数据集名称
-    - uw: 用户周数据
-    - v: 用户ID
-    - list_uf: 用户特征列表
+    - u_attrs: 用户属性矩阵(见get_u_features_dicts)
+    - cols: 实例中用户属性之前的列名
     返回:
-    - 会话特征向量和特征名称
+    - (会话DataFrame, {划分方式: {参数: 子会话DataFrame}})
     功能:
-    - 计算会话的时间特征(工作时间比例,持续时间等)
-    - 计算会话的活动特征
-    - 合并用户特征和会话特征
-    """
-    d = ud.iloc[0]['day']
-    perworkhour = sum(ud['time']==1)/len(ud)
-    perafterhour = sum(ud['time']==2)/len(ud)
-    perweekend = sum(ud['time']==3)/len(ud)
-    perweekendafterhour = sum(ud['time']==4)/len(ud)
-    st_timestamp = min(ud['time_stamp'])
-    end_timestamp = max(ud['time_stamp'])
-    s_dur = (end_timestamp - st_timestamp).total_seconds() / 60 # in minute
-    s_start = st_timestamp.hour + st_timestamp.minute/60
-    s_end = end_timestamp.hour + end_timestamp.minute/60
-    starttime = st_timestamp.timestamp()
-    endtime = end_timestamp.timestamp()
-    n_days = len(set(ud['day']))        
-    
-    tmp = f_calc(ud, mode, data)
-    session_instance = [starttime, endtime, v, sinfo[0], d, week, ud.iloc[0]['pc'], perworkhour, perafterhour, perweekend,
-                        perweekendafterhour, n_days, s_dur, sinfo[6], sinfo[2], sinfo[3], s_start, s_end] + \
-        (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [tmp[4]]
-    return (session_instance, tmp[3])
-
-def to_csv(week, mode, data, ul, uf_dict, list_uf, subsession_mode = {}, config_id = None):
+    - 会话和各种子会话都由片段的中间状态合并得到, 不再对每个子会话重新计算特征
+    - 只有一个子会话时直接使用会话本身, 除最后一个子会话外结束方式记为0
+    - 计算会话的时间特征(工作时间比例,持续时间等), 合并用户特征和会话特征
+    """
+    ts = w['time_stamp'].values.astype('int64')
+    row_piece = pieces['row_piece']
+    splits = pieces['splits']
+    pieces = pieces['pieces']
+    
+    def instance_frame(piece_chunk, n_chunks = None):
+        """由片段合并出实例(按会话和子会话序号排列)并生成DataFrame, n_chunks为每个会话的子会话数(None表示会话实例)"""
+        base = piece_chunk.max() + 1 if len(pieces) > 0 else 1
+        keys, mapping = np.unique(np.where(piece_chunk >= 0, pieces[:, 0] * base + piece_chunk, -1), return_inverse = True)
+        if len(keys) > 0 and keys[0] == -1:
+            keys, mapping = keys[1:], mapping - 1
+        n_groups = len(keys)
+        g_session, g_chunk = keys // base, keys % base
+        end_with = sessions['end_with'][g_session]
+        if n_chunks is not None:
+            end_with = np.where(g_chunk < n_chunks[g_session] - 1, 0, end_with)
+        
+        row_group = np.where(row_piece >= 0, mapping[row_piece], -1)
+        g_rows = np.flatnonzero(row_group >= 0)
+        g = row_group[g_rows]
+        features = f_calc_finalize(merge_partials(partials, mapping, n_groups), 'session')
+        n, _, mal_u = f_calc_labels(w, row_group, n_groups)
+        first = g_rows[np.unique(g, return_index = True)[1]]
+        time_share = [np.bincount(g, weights = w['time'].values[g_rows] == t, minlength = n_groups) / n for t in [1,2,3,4]]
+        st = np.full(n_groups, np.iinfo(np.int64).max)
+        np.minimum.at(st, g, ts[g_rows])
+        et = np.full(n_groups, np.iinfo(np.int64).min)
+        np.maximum.at(et, g, ts[g_rows])
+        n_days = np.bincount(np.unique(g * 10**6 + w['day'].values[g_rows]) // 10**6, minlength = n_groups)
+        users = sessions['user'][g_session]
+        
+        towrite_list = []
+        for i in range(n_groups):
+            st_timestamp, end_timestamp = pd.Timestamp(st[i]), pd.Timestamp(et[i])
+            j = g_session[i]
+            towrite_list.append(([] if n_chunks is None else [g_chunk[i]]) + 
+                                [st_timestamp.timestamp(), end_timestamp.timestamp(), users[i], sessions['sid'][j], w['day'].values[first[i]], week, 
+                                 w['pc'].values[first[i]], time_share[0][i], time_share[1][i], time_share[2][i], time_share[3][i], n_days[i],
+                                 (end_timestamp - st_timestamp).total_seconds() / 60, sessions['n_concurrent'][j], sessions['start_with'][j], end_with[i],
+                                 st_timestamp.hour + st_timestamp.minute/60, end_timestamp.hour + end_timestamp.minute/60])
+        return pd.concat([pd.DataFrame(columns = ([] if n_chunks is None else ['subs_ind']) + cols, data = towrite_list), 
+                          u_attrs.loc[users].reset_index(drop = True), f_calc_frame(features), pd.DataFrame({'insider': mal_u})], axis = 1)
+    
+    towrite = instance_frame(np.zeros(len(pieces), dtype = int))
+    towrite_subsession = {}
+    for i, (k1, k2, n_chunks) in enumerate(splits):
+        piece_n = n_chunks[pieces[:, 0]]
+        piece_chunk = np.where(piece_n == 1, 0, np.where(pieces[:, i+1] < piece_n, pieces[:, i+1], -1))
+        towrite_subsession.setdefault(k1, {})[k2] = instance_frame(piece_chunk, n_chunks)
+    return towrite, towrite_subsession
+
+def to_csv(week, modes, data, u_attrs, subsession_mode = {}, config_id = None, storage = 'pickle', session_cross_week = False, user_codes = None):
     """
     将处理后的数据导出为CSV格式
     参数:
     - week: 周数
-    - mode: 模式(week/day/session)
+    - modes: 模式(week/day/session), 可以是列表, 一次生成多种模式
     - data: 数据集名称
-    - ul: 用户列表
-    - uf_dict: 用户特征字典
-    - list_uf: 用户特征列表
+    - u_attrs: 用户属性矩阵(见get_u_features_dicts), 用户属性列在最后按用户编号一次性拼接
     - subsession_mode: 子会话模式配置
     - config_id: 配置标识符，用于区分不同参数的运行
+    - storage: NumDataByWeek和tmp的存储格式(pickle/parquet/feather)
+    - session_cross_week: 会话模式下是否接上上一周结束时仍未结束的会话(需要先运行carry_open_sessions)
+    - user_codes: 只处理部分用户时这些用户在全体用户中的编号, 从全体用户的数值化数据中按用户行索引读取(见load_week_users)
     功能:
     - 根据不同模式(周/日/会话)提取特征
+    - 一周的数值化数据和用户特征只读取、计算一次, 各模式共用
+    - 按(用户-天, 会话片段)计算一次可合并的中间状态, 日、周、会话及子会话的特征都由其合并得到
     - 处理子会话(如果需要)
-    - 将特征数据保存为pickle文件,最终合并为CSV
+    - 将特征数据保存到tmp文件夹,最终合并为CSV
     - 支持按时间(time)或活动数量(nact)划分子会话
     """
-    user_dict = {i : idx for (i, idx) in enumerate(ul.index)} 
-    if mode == 'session': 
+    modes = [modes] if isinstance(modes, str) else list(modes)
+    cols2a = {}
+    for mode in modes:
+        if mode == 'session': 
+            cols2a[mode] = ['starttime', 'endtime','user', 'sessionid', 'day', 'week', 'pc', 'isworkhour', 'isafterhour','isweekend', 
+                            'isweekendafterhour', 'n_days', 'duration', 'n_concurrent_sessions', 'start_with', 'end_with', 'ses_start', 
+                            'ses_end']
+        elif mode == 'day': 
+            cols2a[mode] = ['starttime', 'endtime','user', 'day', 'week', 'isweekday','isweekend']
+        else: cols2a[mode] = ['starttime', 'endtime','user','week']
+
+    w = load_week_users("NumDataByWeek/"+str(week)+"_num_"+config_id, storage, ['pcid','time_stamp'] + get_num_columns(data), user_codes)
+    carried = None
+    n_carried = 0 # 接上的上一周会话的行放在最前面, 只属于会话模式
+    if 'session' in modes and session_cross_week:
+        carried_w, carried = load_carried_sessions(week, data, config_id, storage, user_codes)
+        if carried_w is not None:
+            n_carried = len(carried_w)
+            w = pd.concat([carried_w, w], ignore_index = True)
+
+    # 本周每行所属的用户-天(接上的上一周会话的行为-1): 按(用户, 天)排序一次, 每个用户-天为连续的一段
+    row_users = w['user'].values.astype(int)
+    day_order, day_starts, day_group = lexsort_groups([row_users[n_carried:], w['day'].values[n_carried:]])
+    day_first = day_order[day_starts] + n_carried
+    n_user_days = len(day_starts)
+    day_group = np.append(np.full(n_carried, -1), day_group)
+    if not any(m in modes for m in ['week', 'day']):
+        day_group = np.full(len(w), -1)
+    
+    # 每行所属的会话片段
+    row_piece = np.full(len(w), -1)
+    if 'session' in modes:
         first_sid = week*100000 # to get an unique index for each session, also, first 1 or 2 number in index would be week number
-        cols2a = ['starttime', 'endtime','user', 'sessionid', 'day', 'week', 'pc', 'isworkhour', 'isafterhour','isweekend', 
-                  'isweekendafterhour', 'n_days', 'duration', 'n_concurrent_sessions', 'start_with', 'end_with', 'ses_start', 
-                  'ses_end'] + list_uf + ['ITAdmin','O','C','E','A','N']
-    elif mode == 'day': 
-        cols2a = ['starttime', 'endtime','user', 'day', 'week', 'isweekday','isweekend'] + list_uf +\
-            ['ITAdmin','O','C','E','A','N']
-    else: cols2a = ['starttime', 'endtime','user','week'] + list_uf + ['ITAdmin','O','C','E','A','N']
-    cols2b = ['insider']        
-
-    w = pd.read_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
-
-    usnlist = list(set(w['user'].astype('int').values))
-    if True:
-        cols = ['week']+ list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N', 'insider'] 
-        uw = pd.DataFrame(columns = cols, index = user_dict.keys())
-        uwdict = {}
-        for v in user_dict:
-            if v in usnlist:
-                is_ITAdmin = 1 if ul.loc[user_dict[v], 'role'] == 'ITAdmin' else 0
-                row = [week] + proc_u_features(ul.loc[user_dict[v]], uf_dict, list_uf, data = data) + [is_ITAdmin] + \
-                    (ul.loc[user_dict[v],['O','C','E','A','N']]).tolist() + [0]
-                row[-1] = int(list(set(w[w['user']==v]['insider']))[0])
-                uwdict[v] = row
-        uw = pd.DataFrame.from_dict(uwdict, orient = 'index',columns = cols)    
-    
-    towrite = pd.DataFrame()
-    towrite_list = []
-    
-    if mode == 'session' and len(subsession_mode) > 0:
-        towrite_list_subsession = {} 
-        for k1 in subsession_mode:
-            towrite_list_subsession[k1] = {}
-            for k2 in subsession_mode[k1]:
-                towrite_list_subsession[k1][k2] = []
+        row_session, sessions = get_sessions(w, first_sid, carried)
+        pieces = session_pieces(w, row_session, sessions, subsession_mode)
+        row_piece = pieces['row_piece']
+    
+    # 最细的组为(用户-天, 会话片段), 只计算一次中间状态
+    fine_order, fine_starts, fine_group = lexsort_groups([day_group, row_piece])
+    fine_keys = np.column_stack([day_group[fine_order[fine_starts]], row_piece[fine_order[fine_starts]]])
+    if len(fine_keys) > 0 and (fine_keys[0] == -1).all():
+        fine_keys, fine_group = fine_keys[1:], fine_group - 1
+    partials = f_calc_partials(w, fine_group, len(fine_keys), modes, data)
+    
+    towrite = {}
+    if 'day' in modes or 'week' in modes:
+        # 日特征由用户-天的状态得到, 周特征由同一用户各天的状态合并得到
+        day_partials = merge_partials(partials, fine_keys[:, 0], n_user_days)
+    for mode in [m for m in modes if m in ['week', 'day']]:
+        if mode == 'day':
+            first_row, group, n_groups = day_first, day_group, n_user_days
+            features = f_calc_finalize(day_partials, 'day')
+        else:
+            _, week_starts, day_user = lexsort_groups([row_users[day_first]]) # 用户-天已按用户排列, 同一用户的各天相邻
+            first_row, n_groups = day_first[week_starts], len(week_starts)
+            group = np.where(day_group >= 0, day_user[day_group], -1)
+            features = f_calc_finalize(merge_partials(day_partials, day_user, n_groups), 'week')
+        _, _, mal_u = f_calc_labels(w, group, n_groups)
+        
+        users = row_users[first_row]
+        days = w['day'].values[first_row]
+        if mode == 'week':
+            sundays = days - (days + 1) % 7 # get the nearest Sunday (day 0 is a Monday)
+            towrite_list = [[day_timestamp(sundays[i]), day_timestamp(sundays[i] + 7), users[i], week] for i in range(n_groups)]
+        else:
+            isweekday = (np.bincount(group[group >= 0], weights = w['time'].values[group >= 0] >= 3, minlength = n_groups) == 0).astype(int)
+            towrite_list = [[day_timestamp(days[i]), day_timestamp(days[i] + 1), users[i], days[i], week, isweekday[i], 1 - isweekday[i]] 
+                            for i in range(n_groups)]
+        towrite[mode] = pd.concat([pd.DataFrame(columns = cols2a[mode], data = towrite_list), u_attrs.loc[users].reset_index(drop = True), 
+                                   f_calc_frame(features), pd.DataFrame({'insider': mal_u})], axis = 1)
     
-    days = list(set(w['day']))
-    for v in user_dict:
-        if v in usnlist:
-            uactw = w[w['user']==v]
-            
-            if mode == 'week':
-                a = uactw.iloc[0]['time_stamp']
-                a = a - timedelta(int(a.strftime("%w"))) # get the nearest Sunday
-                starttime = datetime(a.year, a.month, a.day).timestamp()
-                endtime = (datetime(a.year, a.month, a.day) + timedelta(days=7)).timestamp()
-                
-                if len(uactw) > 0:
-                    tmp = f_calc(uactw, mode, data)
-                    i_fnames = tmp[3]
-                    towrite_list.append([starttime, endtime, v, week] + (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [ tmp[4]])
-
-            if mode == 'session':
-                sessions = get_sessions(uactw, first_sid)
-                first_sid += len(sessions)
-                for s in sessions:
-                    sinfo = sessions[s]
-                    
-                    ud = uactw.loc[sessions[s][7]]
-                    if len(ud) > 0:                     
-                        session_instance, i_fnames = session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf)
-                        towrite_list.append(session_instance)
-                        
-                        ## do subsessions:
-                        if 'time' in subsession_mode: # divide a session into subsessions by consecutive time chunks
-                            for subsession_dur in subsession_mode['time']:
-                                n_subsession = int(np.ceil(session_instance[12] / subsession_dur))
-                                if n_subsession == 1:
-                                    towrite_list_subsession['time'][subsession_dur].append([0] + session_instance)
-                                else:
-                                    sinfo1 = sinfo.copy()
-                                    for subsession_ind in range(n_subsession):
-                                        sinfo1[3] = 0 if subsession_ind < n_subsession-1 else sinfo[3] 
-                                        
-                                        subsession_ud = ud[(ud['time_stamp'] >= sessions[s][4] + timedelta(minutes = subsession_ind*subsession_dur)) & \
-                                                            (ud['time_stamp'] < sessions[s][4] + timedelta(minutes = (subsession_ind+1)*subsession_dur))]
-                                        if len(subsession_ud) > 0:
-                                            ss_instance, _ = session_instance_calc(subsession_ud, sinfo1, week, mode, data, uw, v, list_uf)
-                                            towrite_list_subsession['time'][subsession_dur].append([subsession_ind] + ss_instance)
-                            
-                        if 'nact' in subsession_mode:
-                            for ss_nact in subsession_mode['nact']:
-                                n_subsession = int(np.ceil(len(ud) / ss_nact))
-                                if n_subsession == 1:
-                                    towrite_list_subsession['nact'][ss_nact].append([0] + session_instance)
-                                else:
-                                    sinfo1 = sinfo.copy()
-                                    for ss_ind in range(n_subsession):
-                                        sinfo1[3] = 0 if ss_ind < n_subsession-1 else sinfo[3] 
-                                        
-                                        ss_ud = ud.iloc[ss_ind*ss_nact : min(len(ud), (ss_ind+1)*ss_nact)] 
-                                        if len(ss_ud) > 0:
-                                            ss_instance,_ = session_instance_calc(ss_ud, sinfo1, week, mode, data, uw, v, list_uf)
-                                            towrite_list_subsession['nact'][ss_nact].append([ss_ind] + ss_instance)
-                        
-            if mode == 'day':
-                days = sorted(list(set(uactw['day']))) 
-                for d in days:
-                    ud = uactw[uactw['day'] == d]
-                    isweekday = 1 if sum(ud['time']>=3) == 0 else 0
-                    isweekend = 1-isweekday
-                    a = ud.iloc[0]['time_stamp']
-                    starttime = datetime(a.year, a.month, a.day).timestamp()
-                    endtime = (datetime(a.year, a.month, a.day) + timedelta(days=1)).timestamp()
-                    
-                    if len(ud) > 0:
-                        tmp = f_calc(ud, mode, data)
-                        i_fnames = tmp[3]
-                        towrite_list.append([starttime, endtime, v, d, week, isweekday, isweekend] + (uw.loc[v, list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N'] ]).tolist() + tmp[2] + [ tmp[4]])
-
-    towrite = pd.DataFrame(columns = cols2a + i_fnames + cols2b, data = towrite_list)
-    towrite.to_pickle("tmp/"+str(week) + mode+"_"+config_id+".pickle")
+    if 'session' in modes:
+        piece_partials = merge_partials(partials, fine_keys[:, 1], len(pieces['pieces']))
+        towrite['session'], towrite_subsession = session_instances(w, sessions, pieces, piece_partials, week, u_attrs, cols2a['session'])
     
-    if mode == 'session' and len(subsession_mode) > 0:
+    for mode in modes:
+        save_frame(towrite[mode], "tmp/"+str(week) + mode+"_"+config_id, storage)
+    
+    if 'session' in modes and len(subsession_mode) > 0:
         for k1 in subsession_mode:
             for k2 in subsession_mode[k1]:
-                df_tmp = pd.DataFrame(columns = ['subs_ind']+cols2a + i_fnames + cols2b, data = towrite_list_subsession[k1][k2])
-                df_tmp.to_pickle("tmp/"+str(week) + mode + k1 + str(k2) + "_"+config_id+".pickle")
+                save_frame(towrite_subsession[k1][k2], "tmp/"+str(week) + 'session' + k1 + str(k2) + "_"+config_id, storage)
     
+def open_csv_output(path, compression = 'none'):
+    """按压缩格式(none/gzip/zstd)打开最终CSV文件, 返回写入字节的文件对象"""
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel = 6)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+def open_columnar_output(path, columnar, schema):
+    """
+    打开逐周追加写入的列式输出文件(需要pyarrow)
+    参数:
+    - path: 输出路径(含扩展名)
+    - columnar: parquet或feather(feather即Arrow IPC文件格式)
+    - schema: 所有周共同的表结构
+    """
+    import pyarrow.ipc
+    import pyarrow.parquet
+    if columnar == 'parquet':
+        return pyarrow.parquet.ParquetWriter(path, schema, compression = 'zstd')
+    return pyarrow.ipc.new_file(path, schema, options = pyarrow.ipc.IpcWriteOptions(compression = 'lz4'))
+
+def week_csv_bytes(path, storage = 'pickle', header = False):
+    """读取一周的临时文件并格式化为CSV字节, 返回(字节, (行数, 列数), 列类型)"""
+    df = load_frame(path, storage)
+    return df.to_csv(header = header, index = False).encode(), df.shape, df.dtypes
+
+def write_columnar_weeks(week_files, out_path, storage = 'pickle', columnar = 'parquet', week_dtypes = ()):
+    """
+    把各周的临时文件逐周追加写入一个列式文件(parquet每周一个行组, feather每周一个记录批), 不在内存中拼接所有周
+    参数:
+    - week_files: 按周排列的临时文件路径(不含扩展名)
+    - out_path: 输出路径(不含扩展名)
+    - week_dtypes: 各周的列类型(week_csv_bytes返回), 各周统一转换为与pd.concat相同的共同类型
+    """
+    import pyarrow
+    common = pd.concat([pd.DataFrame({c: pd.Series(dtype = d) for c, d in dtypes.items()}) for dtypes in week_dtypes]).dtypes
+    schema = pyarrow.Schema.from_pandas(pd.DataFrame({c: pd.Series(dtype = d) for c, d in common.items()}), preserve_index = False)
+    with open_columnar_output(storage_path(out_path, columnar), columnar, schema) as out:
+        for f in week_files:
+            out.write_table(pyarrow.Table.from_pandas(load_frame(f, storage).astype(common), schema = schema, preserve_index = False))
+
+def merge_week_csv(week_files, out_path, storage = 'pickle', n_jobs = 1, compression = 'none', columnar = None):
+    """
+    把各周的临时文件按周的顺序合并为一个CSV文件
+    参数:
+    - week_files: 按周排列的临时文件路径(不含扩展名), 第一个文件提供表头
+    - out_path: 输出路径(不含扩展名), CSV文件扩展名由compression决定
+    - storage: 临时文件的存储格式
+    - n_jobs: 并行格式化的进程数
+    - compression: CSV的压缩格式(none/gzip/zstd)
+    - columnar: 另外输出列相同的列式文件(parquet/feather, 需要pyarrow), None表示不输出
+    返回:
+    - (样本数, 特征维度), 缺失的周打印警告后跳过
+    功能:
+    - 浮点数格式化为文本是合并的主要开销, 各周在并行进程中格式化为字节, 主进程按周的顺序写入
+    - 每批处理n_jobs*4周, 限制同时保存在内存中的数据量
+    - 列式文件在CSV之后逐周写入(见write_columnar_weeks), 同样不会同时读入所有周
+    """
+    if columnar is not None:
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception(f'{columnar} output requires the pyarrow package')
+    present = []
+    for f in week_files:
+        if os.path.exists(storage_path(f, storage)):
+            present.append(f)
+        else:
+            print(f"警告: 临时文件不存在: {f}")
+    n_samples, n_cols = 0, 0
+    week_dtypes = []
+    batch = max(n_jobs, 1) * 4
+    with open_csv_output(out_path + CSV_COMPRESSIONS[compression], compression) as out:
+        for i in range(0, len(present), batch):
+            for data, shape, dtypes in Parallel(n_jobs = n_jobs)(delayed(week_csv_bytes)(f, storage, i + j == 0) for j, f in enumerate(present[i:i+batch])):
+                out.write(data)
+                n_samples, n_cols = n_samples + shape[0], shape[1]
+                week_dtypes.append(dtypes)
+    if columnar is not None and present:
+        write_columnar_weeks(present, out_path, storage, columnar, week_dtypes)
+    return n_samples, n_cols
+
+# 中间结果缓存的代码版本: 修改生成某类中间结果的代码(process_week_num / to_csv)后提高对应的版本, 旧的缓存结果自动失效
+ARTIFACT_CODE_VERSION = {'num': 1, 'tmp': 1}
+
+def artifact_key(kind, **params):
+    """
+    计算中间结果的内容寻址键
+    参数:
+    - kind: 中间结果类型(num: NumDataByWeek的每周数据, tmp: Step 4的每周输出)
+    - params: 决定结果内容的参数(数据集, 周, 用户集合, 上游结果的键等), 需要可以JSON序列化
+    返回:
+    - 16位十六进制的键
+    功能:
+    - 键包含该类型的代码版本, tmp还包含特征规格(FEATURE_SPEC, F_CALC_PERIODS), 修改后旧结果自动失效
+    - 与配置标识符无关: 只是最大用户数或模式字符串不同的运行共享相同的结果
+    """
+    payload = {'kind': kind, 'code': ARTIFACT_CODE_VERSION[kind], 'params': params}
+    if kind == 'tmp':
+        payload['spec'] = [F_CALC_PERIODS, FEATURE_SPEC]
+    return hashlib.sha1(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()[:16]
+
+def file_fingerprint(path, memo = None):
+    """
+    计算输入文件内容的指纹, 用于缓存键
+    参数:
+    - path: 文件路径
+    - memo: 可选的{路径: [大小, 修改时间(纳秒), 指纹]}字典, 大小和修改时间都没有变化时直接使用记录的指纹, 原地更新
+    返回:
+    - 文件不存在时为None, 否则为文件内容sha1的前16位
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if memo is not None and memo.get(path, [None, None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return memo[path][2]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16*1024*1024), b''):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()[:16]
+    if memo is not None:
+        memo[path] = [stat.st_size, stat.st_mtime_ns, fingerprint]
+    return fingerprint
+
+def load_cache_index(data_dir):
+    """
+    读取data_dir/objects中缓存对象的索引: 每个对象的大小和最后使用时间, 累计的命中/未命中次数,
+    以及不支持符号链接时复制出的文件(copies: {文件路径: 对象名})
+    """
+    path = f"{data_dir}/objects/index.json"
+    index = {'entries': {}, 'hits': 0, 'misses': 0, 'copies': {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            index.update(json.load(f))
+    return index
+
+def save_cache_index(data_dir, index):
+    """保存缓存索引"""
+    os.makedirs(f"{data_dir}/objects", exist_ok = True)
+    with open(f"{data_dir}/objects/index.json", 'w') as f:
+        json.dump(index, f)
+
+def link_artifact(index, name, obj, target):
+    """
+    让target以符号链接引用缓存对象obj, 不支持符号链接时复制
+    参数:
+    - name: obj所属的索引条目(对象名), 用户行索引文件属于对应的数值化数据对象
+    功能:
+    - 复制的文件记录在索引的copies中, 淘汰该对象时一起删除
+    """
+    try:
+        os.symlink(os.path.relpath(obj, os.path.dirname(target) or '.'), target)
+        index['copies'].pop(target, None)
+    except OSError:
+        shutil.copyfile(obj, target)
+        index['copies'][target] = name
+
+def cache_fetch(index, data_dir, key, target, storage = 'pickle'):
+    """
+    在缓存中查找中间结果
+    参数:
+    - index: load_cache_index读取的索引, 原地更新
+    - data_dir: 缓存所在目录(NumDataByWeek/tmp)
+    - key: artifact_key计算的键
+    - target: 当前配置下的文件路径(不含扩展名)
+    返回:
+    - 是否命中; 命中时target链接到缓存对象, 并更新对象的最后使用时间
+    - 未命中时删除target(及其用户行索引): 它由不同的输入或设置生成, 需要重新生成
+    """
+    obj, tgt = storage_path(f"{data_dir}/objects/{key}", storage), storage_path(target, storage)
+    name = os.path.basename(obj)
+    if name in index['entries'] and os.path.exists(obj):
+        for o, t in [(obj, tgt), (f"{data_dir}/objects/{key}{USER_INDEX_SUFFIX}", target + USER_INDEX_SUFFIX)]:
+            if os.path.lexists(t):
+                os.remove(t)
+            if os.path.exists(o):
+                link_artifact(index, name, o, t)
+        index['entries'][name]['last_used'] = time.time()
+        index['hits'] += 1
+        return True
+    index['entries'].pop(name, None)
+    for t in [tgt, target + USER_INDEX_SUFFIX]:
+        if os.path.lexists(t):
+            os.remove(t)
+        index['copies'].pop(t, None)
+    index['misses'] += 1
+    return False
+
+def cache_store(index, data_dir, key, target, storage = 'pickle'):
+    """把新生成的target(及其用户行索引)移入缓存, 原位置改为指向缓存对象的链接"""
+    obj, tgt = storage_path(f"{data_dir}/objects/{key}", storage), storage_path(target, storage)
+    os.makedirs(f"{data_dir}/objects", exist_ok = True)
+    for o, t in [(obj, tgt), (f"{data_dir}/objects/{key}{USER_INDEX_SUFFIX}", target + USER_INDEX_SUFFIX)]:
+        if os.path.exists(t) and not os.path.islink(t):
+            os.replace(t, o)
+            link_artifact(index, os.path.basename(obj), o, t)
+    index['entries'][os.path.basename(obj)] = {'size': os.path.getsize(obj), 'last_used': time.time()}
+
+def cache_evict(index, data_dir, limit_bytes, keep = ()):
+    """
+    按最近最少使用(LRU)淘汰缓存对象, 直到缓存总大小不超过limit_bytes
+    参数:
+    - keep: 本次运行用到的对象名(键+扩展名), 不淘汰
+    返回:
+    - 淘汰后的缓存总大小(字节)
+    功能:
+    - 同时删除data_dir中指向已淘汰对象的链接和从已淘汰对象复制出的文件, 之后的运行会把这些结果当作缺失重新生成
+    """
+    entries = index['entries']
+    total = sum(e['size'] for e in entries.values())
+    evicted = set()
+    for name in sorted(entries, key = lambda n: entries[n]['last_used']):
+        if total <= limit_bytes:
+            break
+        if name in keep:
+            continue
+        for f in [name, os.path.splitext(name)[0] + USER_INDEX_SUFFIX]:
+            if os.path.exists(f"{data_dir}/objects/{f}"):
+                os.remove(f"{data_dir}/objects/{f}")
+        total -= entries.pop(name)['size']
+        evicted.add(name)
+    for path in [p for p, name in index['copies'].items() if name in evicted]:
+        if os.path.isfile(path) and not os.path.islink(path):
+            os.remove(path)
+        del index['copies'][path]
+    for f in os.listdir(data_dir):
+        path = os.path.join(data_dir, f)
+        if os.path.islink(path) and not os.path.exists(path):
+            os.remove(path)
+    return total
+
 if __name__ == "__main__":
     """
     CERT内部威胁数据集特征提取主程序
@@ -2075,7 +2221,7 @@ if __name__ == "__main__":
     最终输出多种格式的特征文件，支持周级别、日级别和会话级别的分析
     
     命令行参数：
-    python feature_extraction.py [numCores] [start_week] [end_week] [max_users] [modes] [enable_subsession]
+    python feature_extraction.py [numCores] [start_week] [end_week] [max_users] [modes] [enable_subsession] [storage] [usb_cross_week] [work_hours] [weekend_days] [session_cross_week] [compression] [columnar] [cache_limit_gb]
     
     参数说明：
     - numCores: CPU核心数，默认8
@@ -2084,6 +2230,14 @@ if __name__ == "__main__":
     - max_users: 最大用户数量限制，默认为所有用户
     - modes: 要处理的模式，用逗号分隔，如"week,day,session"，默认全部
     - enable_subsession: 是否启用子会话，0或1，默认1
+    - storage: 中间结果的存储格式，pickle、parquet或feather（后两者需要pyarrow），默认pickle
+    - usb_cross_week: 是否允许USB连接与下一周的断开活动配对，0或1，默认0
+    - work_hours: 工作时间，格式为"开始-结束"（H:M，含两端），默认7:30-17:30
+    - weekend_days: 周末包含的星期，用逗号分隔（0为周日，6为周六），默认0,6
+    - session_cross_week: 是否拼接跨越周末仍未结束的会话，0或1，默认0
+    - compression: 最终CSV的压缩格式，none、gzip（.csv.gz）或zstd（.csv.zst，需要zstandard），默认none
+    - columnar: 是否另外输出列式文件，none、parquet或feather（需要pyarrow），默认none
+    - cache_limit_gb: NumDataByWeek和tmp中间结果缓存各自的上限（GB），默认50
     
     示例：
     python feature_extraction.py 16 0 10 100 "session" 0  # 使用16核，处理0-10周，最多100用户，只处理session模式，不生成子会话
@@ -2107,7 +2261,7 @@ if __name__ == "__main__":
         raise Exception('Please put this script in and run it from a CERT data folder (e.g. r4.2)')
     
     # 创建数据处理流水线所需的临时目录
-    # tmp: 存储临时的pickle文件和中间处理结果
+    # tmp: 存储临时的中间处理结果
     # ExtractedData: 存储最终的CSV格式特征文件
     # DataByWeek: 存储按周合并的原始活动数据
     # NumDataByWeek: 存储数值化后的周活动特征
@@ -2166,6 +2320,58 @@ if __name__ == "__main__":
     # 如果不需要子会话分析，可以设置为空字典 {}
     subsession_mode = {'nact':[25, 50], 'time':[120, 240]} if enable_subsession else {}
     
+    # 中间结果存储格式：默认pickle，parquet/feather为列式压缩格式，读取时只加载需要的列
+    storage = 'pickle'
+    if arguments > 6:
+        storage = sys.argv[7].strip()
+        if storage not in STORAGE_FORMATS:
+            raise Exception(f'Unknown storage format {storage}, choose from {list(STORAGE_FORMATS)}')
+    
+    # USB跨周配对：默认禁用。启用时，一周内没有找到断开活动的连接会继续和下一周的断开活动配对
+    # （例如周六晚上连接、周日断开），否则这类连接的时长记为-1
+    usb_cross_week = False
+    if arguments > 7:
+        usb_cross_week = bool(int(sys.argv[8]))
+    
+    # 工作时间和周末：决定每个活动的时间类型（工作日/周末的工作时间/非工作时间），只对本次运行生效
+    work_hours = WORK_HOURS
+    if arguments > 8:
+        work_hours = tuple(t.strip() for t in sys.argv[9].split('-'))
+        if len(work_hours) != 2 or not all(re.fullmatch(r'\d{1,2}:\d{2}', t) for t in work_hours):
+            raise Exception(f'Invalid work hours {sys.argv[9]}, expected H:M-H:M (e.g. 7:30-17:30)')
+        work_hours = tuple(f"{int(t.split(':')[0])}:{t.split(':')[1]}" for t in work_hours) # 统一为H:MM, 08:00与8:00相同
+    weekend_days = WEEKEND_DAYS
+    if arguments > 9:
+        weekend_days = tuple(sorted(int(d) for d in sys.argv[10].split(',') if d.strip()))
+        if not all(0 <= d <= 6 for d in weekend_days):
+            raise Exception(f'Invalid weekend days {sys.argv[10]}, expected comma separated numbers from 0 (Sunday) to 6 (Saturday)')
+    
+    # 会话跨周拼接：默认禁用。启用时，周末仍未结束的会话（例如夜班跨越周六/周日）会接上下一周的活动，
+    # 在会话结束的那一周输出，否则这类会话在周末被截断并丢弃
+    session_cross_week = False
+    if arguments > 10:
+        session_cross_week = bool(int(sys.argv[11]))
+    
+    # 最终CSV的压缩格式：默认不压缩，gzip输出可被下游脚本直接读取(.csv.gz)
+    csv_compression = 'none'
+    if arguments > 11:
+        csv_compression = sys.argv[12].strip()
+        if csv_compression not in CSV_COMPRESSIONS:
+            raise Exception(f'Unknown compression {csv_compression}, choose from {list(CSV_COMPRESSIONS)}')
+    csv_ext = CSV_COMPRESSIONS[csv_compression]
+    
+    # 列式输出：除CSV外另外输出列相同的parquet/feather文件
+    columnar = None
+    if arguments > 12 and sys.argv[13].strip() != 'none':
+        columnar = sys.argv[13].strip()
+        if columnar not in ['parquet', 'feather']:
+            raise Exception(f'Unknown columnar format {columnar}, choose from none, parquet, feather')
+    
+    # 中间结果缓存上限（GB）：NumDataByWeek和tmp中的缓存对象各自超过该大小时，按最近最少使用淘汰不属于本次运行的对象
+    cache_limit_gb = 50
+    if arguments > 13:
+        cache_limit_gb = float(sys.argv[14])
+    
     # 打印配置信息
     print("="*60)
     print("CERT数据集特征提取配置:")
@@ -2177,16 +2383,31 @@ if __name__ == "__main__":
     print(f"- 子会话模式: {'启用' if enable_subsession else '禁用'}")
     if enable_subsession:
         print(f"- 子会话配置: {subsession_mode}")
+    print(f"- 存储格式: {storage}")
+    print(f"- 输出压缩: {csv_compression}, 列式输出: {columnar if columnar else '无'}")
+    print(f"- USB跨周配对: {'启用' if usb_cross_week else '禁用'}")
+    print(f"- 会话跨周拼接: {'启用' if session_cross_week else '禁用'}")
+    print(f"- 工作时间: {work_hours[0]}-{work_hours[1]}, 周末: {','.join(map(str, weekend_days))}")
+    print(f"- 缓存上限: {cache_limit_gb} GB")
     print("="*60)
     
     # 生成配置标识符，用于区分不同参数的运行
-    # 包含关键参数：用户数量、周数范围、模式、子会话配置
+    # 包含关键参数：用户数量、周数范围、模式、子会话配置（启用USB跨周配对时追加x1，启用会话跨周拼接时追加c1，
+    # 工作时间或周末不是默认值时追加h开始-结束和e周末星期）
     config_params = [
         f"u{max_users if max_users else 'all'}",
         f"w{start_week}-{end_week-1}",
         f"m{''.join(selected_modes)}",
         f"s{1 if enable_subsession else 0}"
     ]
+    if usb_cross_week:
+        config_params.append("x1")
+    if session_cross_week:
+        config_params.append("c1")
+    if work_hours != WORK_HOURS:
+        config_params.append(f"h{work_hours[0].replace(':', '')}-{work_hours[1].replace(':', '')}")
+    if weekend_days != WEEKEND_DAYS:
+        config_params.append(f"e{''.join(map(str, weekend_days))}")
     config_id = "_".join(config_params)
     print(f"配置标识符: {config_id}")
     print("="*60)
@@ -2203,6 +2424,7 @@ if __name__ == "__main__":
     - 根据时间戳将所有活动数据按周进行分组和合并
     - 处理不同数据集版本间的格式差异
     - 为每条活动记录添加统一的type标识符
+    - numCores大于1时，各活动文件（大文件按字节范围切分）由独立进程解析，写入分周临时文件后再按周合并
     
     输入文件：
     - http.csv: HTTP访问日志
@@ -2212,14 +2434,14 @@ if __name__ == "__main__":
     - device.csv: 设备连接日志
     
     输出：
-    - DataByWeek/0.pickle, DataByWeek/1.pickle, ...: 每周的合并活动数据
+    - DataByWeek/0.pickle, DataByWeek/1.pickle, ...: 每周的合并活动数据（扩展名随存储格式变化）
     - 每个文件包含该周所有类型的用户活动，按时间排序
     """
     
     # 检查是否需要执行Step 1
     step1_completed = True
     for week in range(start_week, end_week):
-        week_file = f"DataByWeek/{week}.pickle"
+        week_file = storage_path(f"DataByWeek/{week}", storage)
         if not os.path.exists(week_file):
             step1_completed = False
             break
@@ -2228,7 +2450,7 @@ if __name__ == "__main__":
         print("Step 1: 按周合并数据已完成，跳过此步骤。")
     else:
         print("Step 1: 开始按周合并原始数据...")
-        combine_by_timerange_pandas(dname, start_week, end_week)
+        combine_by_timerange_pandas(dname, start_week, end_week, n_jobs=numCores, storage=storage)
         print(f"Step 1 - 按周分离数据完成. 耗时 (分钟): {(time.time()-st)/60:.2f}")
     st = time.time()
     
@@ -2259,29 +2481,17 @@ if __name__ == "__main__":
     """
     
     print("Step 2: 开始获取用户列表和恶意用户信息...")
-    users = get_mal_userdata(dname)
-    
-    # 应用用户数量限制
-    if max_users and len(users) > max_users:
-        print(f"应用用户数量限制：从 {len(users)} 个用户中随机选择 {max_users} 个用户")
-        # 确保包含所有恶意用户
-        malicious_users = users[users['malscene'] > 0].index.tolist()
-        normal_users = users[users['malscene'] == 0].index.tolist()
-        
-        # 计算需要的正常用户数量
-        remaining_slots = max_users - len(malicious_users)
-        if remaining_slots > 0:
-            # 随机选择正常用户
-            np.random.seed(42)  # 设置随机种子以保证可重复性
-            selected_normal_users = np.random.choice(normal_users, 
-                                                   size=min(remaining_slots, len(normal_users)), 
-                                                   replace=False).tolist()
-        else:
-            selected_normal_users = []
-        
-        selected_users = malicious_users + selected_normal_users
-        users = users.loc[selected_users]
-        print(f"最终选择用户数: {len(users)} (恶意用户: {len(malicious_users)}, 正常用户: {len(selected_normal_users)})")
+    all_users = load_users_table(dname, storage=storage)
+    
+    # 应用用户数量限制（确保包含所有恶意用户，正常用户用固定随机种子选择）
+    users = select_users(all_users, max_users)
+    # 数值化数据总是按全体用户生成并缓存，只处理部分用户时按用户行索引读取这些用户（user_codes为其在全体用户中的编号）
+    user_codes = None
+    if len(users) < len(all_users):
+        print(f"应用用户数量限制：从 {len(all_users)} 个用户中随机选择 {max_users} 个用户")
+        n_mal = int((users['malscene'] > 0).sum())
+        print(f"最终选择用户数: {len(users)} (恶意用户: {n_mal}, 正常用户: {len(users) - n_mal})")
+        user_codes = all_users.index.get_indexer(users.index)
     
     print(f"Step 2 - 获取用户列表完成. 耗时 (分钟): {(time.time()-st)/60:.2f}")
     print(f"总用户数: {len(users)}, 恶意用户数: {len(users[users['malscene'] > 0])}")
@@ -2315,23 +2525,38 @@ if __name__ == "__main__":
     - 每行代表一个活动，包含用户ID、时间、活动类型、各类特征值、恶意标记等
     """
     
-    # 首先尝试从兼容配置中复制数据
-    compatible_config_id = find_compatible_config(config_id, "NumDataByWeek")
-    if compatible_config_id:
-        print(f"发现兼容配置 {compatible_config_id}，尝试复制数据...")
-        weeks_to_copy = list(range(start_week, end_week))
-        copied_weeks = copy_compatible_data(compatible_config_id, config_id, weeks_to_copy, "NumDataByWeek")
-        if copied_weeks:
-            print(f"成功从兼容配置复制了 {len(copied_weeks)} 周的数据: {copied_weeks}")
+    # 每周的数值化数据按全体用户生成，只由数据集、周、全体用户(及其顺序, 决定用户编号)、USB跨周配对以及工作时间和周末决定,
+    # 以及输入的内容：本周（USB跨周配对时还有下一周）的DataByWeek文件、用户表(PC、主管、恶意标记)和域名分类文件。
+    # 按这些内容计算缓存键, 其他配置（如模式、最大用户数）生成过的相同结果直接链接复用
+    # DataByWeek文件的指纹按大小和修改时间记录在DataByWeek/fingerprints.json中, 文件没有变化时不再重新读取
+    fingerprint_file = "DataByWeek/fingerprints.json"
+    fingerprints = {}
+    if os.path.exists(fingerprint_file):
+        with open(fingerprint_file) as f:
+            fingerprints = json.load(f)
+    num_inputs = {'users_table': users_table_key(dname, storage), 'domain_categories': file_fingerprint('domain_categories.json')}
+    num_keys = {}
+    for week in range(start_week, end_week):
+        week_data = [file_fingerprint(storage_path(f"DataByWeek/{i}", storage), fingerprints) 
+                     for i in ([week, week + 1] if usb_cross_week else [week])]
+        num_keys[week] = artifact_key('num', data=dname, week=week, users=list(all_users.index), usb_cross_week=usb_cross_week,
+                                      work_hours=work_hours, weekend_days=weekend_days, inputs=num_inputs, week_data=week_data)
+    with open(fingerprint_file, 'w') as f:
+        json.dump(fingerprints, f)
+    num_index = load_cache_index("NumDataByWeek")
+    run_hits = 0
     
     # 检查是否需要执行Step 3
     step3_completed = True
     missing_weeks = []
     for week in range(start_week, end_week):
-        week_file = f"NumDataByWeek/{week}_num_{config_id}.pickle"
-        if not os.path.exists(week_file):
+        week_file = f"NumDataByWeek/{week}_num_{config_id}"
+        if cache_fetch(num_index, "NumDataByWeek", num_keys[week], week_file, storage):
+            run_hits += 1
+        else:
             step3_completed = False
             missing_weeks.append(week)
+    print(f"NumDataByWeek缓存: 命中 {run_hits} 周, 未命中 {len(missing_weeks)} 周")
     
     if step3_completed:
         print("Step 3: 活动数值化特征提取已完成，跳过此步骤。")
@@ -2343,12 +2568,27 @@ if __name__ == "__main__":
         # 使用joblib.Parallel进行并行处理，显著提升大数据集的处理速度
         # delayed()将函数调用包装为延迟执行的任务
         # n_jobs指定并行进程数，-1表示使用所有可用CPU核心
-        Parallel(n_jobs=numCores)(delayed(process_week_num)(i, users, userlist=list(users.index), data=dname, config_id=config_id) 
-                                   for i in missing_weeks)
+        # 用户查找表只保存一次，各个并行进程以只读内存映射方式加载，不再为每一周重复序列化users
+        user_lookup_file = f"tmp/users_{config_id}.joblib"
+        joblib.dump(build_user_lookup(all_users), user_lookup_file)
+        
+        unknown_file_acts = Counter()
+        for week_unknown in Parallel(n_jobs=numCores)(delayed(process_week_num)(i, user_lookup_file, data=dname, config_id=config_id, storage=storage, 
+                                                                             usb_cross_week=usb_cross_week, work_hours=work_hours, weekend_days=weekend_days) 
+                                   for i in missing_weeks):
+            unknown_file_acts.update(week_unknown)
+        if unknown_file_acts:
+            print(f"未知的文件操作类型(已记为0): {dict(unknown_file_acts)}")
+        for week in missing_weeks:
+            cache_store(num_index, "NumDataByWeek", num_keys[week], f"NumDataByWeek/{week}_num_{config_id}", storage)
         
         print(f"Step 3 - 活动数值化转换完成. 耗时 (分钟): {(time.time()-st)/60:.2f}")
     else:
-        print("Step 3: 所有数据已通过兼容配置获得，无需重新计算。")
+        print("Step 3: 所有数据已通过缓存获得，无需重新计算。")
+    cache_size = cache_evict(num_index, "NumDataByWeek", cache_limit_gb * 1024**3, 
+                             {os.path.basename(storage_path(k, storage)) for k in num_keys.values()})
+    save_cache_index("NumDataByWeek", num_index)
+    print(f"NumDataByWeek缓存大小: {cache_size/1024**3:.2f} GB, 累计命中 {num_index['hits']} 次, 未命中 {num_index['misses']} 次")
     
     st = time.time()
     
@@ -2378,12 +2618,23 @@ if __name__ == "__main__":
     """
     print("Step 4: 开始多粒度特征提取和CSV导出...")
     
-    # 处理选定的时间粒度
+    # 获取用户特征的字典映射和列表（各模式共用，只计算一次）
+    # ul: 处理后的用户DataFrame，uf_dict: 特征值到数值的映射字典，list_uf: 特征列名列表，u_attrs: 编码后的用户属性矩阵
+    (ul, uf_dict, list_uf, u_attrs) = get_u_features_dicts(users, data=dname)
+    print(f"用户特征维度: {len(list_uf)}, 包含特征: {list_uf}")
+    
+    # 先确定每种模式需要生成的周，再按周一次性生成所有模式，每周的数值化数据只读取一次
+    mode_weeks = {}   # 每种模式需要合并的周范围
+    week_modes = {}   # 每周需要生成临时文件的模式
+    tmp_keys = {}     # 本次运行用到的临时文件及其缓存键
+    regen_files = {}  # 需要重新生成的临时文件及其缓存键
+    tmp_index = load_cache_index("tmp")
+    run_hits = 0
     for mode in selected_modes:
-        print(f"正在处理 {mode} 级别的特征...")
+        print(f"正在检查 {mode} 级别的特征...")
         
         # 检查最终CSV文件是否已存在
-        final_csv_file = f'ExtractedData/{mode}{dname}_{config_id}.csv'
+        final_csv_file = f'ExtractedData/{mode}{dname}_{config_id}{csv_ext}'
         if os.path.exists(final_csv_file):
             print(f"{mode} 模式的最终CSV文件已存在: {final_csv_file}")
             
@@ -2392,7 +2643,7 @@ if __name__ == "__main__":
                 all_subsession_exist = True
                 for k1 in subsession_mode:
                     for k2 in subsession_mode[k1]:
-                        subsession_file = f'ExtractedData/{mode}{k1}{k2}{dname}_{config_id}.csv'
+                        subsession_file = f'ExtractedData/{mode}{k1}{k2}{dname}_{config_id}{csv_ext}'
                         if not os.path.exists(subsession_file):
                             all_subsession_exist = False
                             print(f"子会话文件不存在: {subsession_file}")
@@ -2415,97 +2666,80 @@ if __name__ == "__main__":
             weekRange = list(range(max(start_week, 0), end_week))
         else:  # week mode
             weekRange = list(range(max(start_week, 1), end_week))
+        mode_weeks[mode] = weekRange
         
         print(f"{mode} 模式处理周范围: {weekRange[0]} 到 {weekRange[-1]} (共 {len(weekRange)} 周)")
         
-        # 获取用户特征的字典映射和列表
-        # ul: 处理后的用户DataFrame，uf_dict: 特征值到数值的映射字典，list_uf: 特征列名列表
-        (ul, uf_dict, list_uf) = get_u_features_dicts(users, data=dname)
-        print(f"用户特征维度: {len(list_uf)}, 包含特征: {list_uf}")
-        
-        # 检查临时pickle文件是否已存在
+        # 每周的输出（会话模式还包括各子会话文件）由所用周的数值化数据和模式决定，数值化数据的缓存键已包含全部输入文件和设置：
+        # 会话跨周拼接时还取决于本周之前（从周范围开始）的各周数据
         missing_weeks = []
         for week in weekRange:
-            temp_file = f"tmp/{week}{mode}_{config_id}.pickle"
-            if not os.path.exists(temp_file):
+            num_used = [num_keys[i] for i in (range(weekRange[0], week + 1) if mode == 'session' and session_cross_week else [week])]
+            artifacts = [mode] + ([f"{mode}{k1}{k2}" for k1 in subsession_mode for k2 in subsession_mode[k1]] if mode == 'session' else [])
+            week_artifacts = {}
+            for name in artifacts:
+                week_artifacts[f"tmp/{week}{name}_{config_id}"] = artifact_key('tmp', data=dname, output=name, num=num_used, users=list(users.index),
+                                                                               session_cross_week=session_cross_week and mode == 'session')
+            tmp_keys.update(week_artifacts)
+            found = True
+            for temp_file, key in week_artifacts.items():
+                if cache_fetch(tmp_index, "tmp", key, temp_file, storage):
+                    run_hits += 1
+                else:
+                    found = False
+            if not found:
                 missing_weeks.append(week)
+                # 该周该模式的所有文件都会重新生成，先去掉已命中的链接，避免写入时覆盖共享的缓存对象
+                for temp_file in week_artifacts:
+                    if os.path.islink(storage_path(temp_file, storage)):
+                        os.remove(storage_path(temp_file, storage))
+                regen_files.update(week_artifacts)
         
-        # 如果有缺失的周，尝试从兼容配置复制临时文件
         if missing_weeks:
-            compatible_config_id = find_compatible_config(config_id, "tmp")
-            if compatible_config_id:
-                print(f"发现兼容的临时文件配置 {compatible_config_id}，尝试复制临时文件...")
-                copied_temp_weeks = []
-                for week in missing_weeks[:]:
-                    source_temp_file = f"tmp/{week}{mode}_{compatible_config_id}.pickle"
-                    target_temp_file = f"tmp/{week}{mode}_{config_id}.pickle"
-                    
-                    if os.path.exists(source_temp_file):
-                        try:
-                            df = pd.read_pickle(source_temp_file)
-                            target_config = parse_config_id(config_id)
-                            if (target_config['max_users'] != 'all' and isinstance(target_config['max_users'], int)):
-                                if 'user' in df.columns:
-                                    unique_users = sorted(df['user'].unique())
-                                    if len(unique_users) > target_config['max_users']:
-                                        np.random.seed(42)
-                                        selected_users = np.random.choice(unique_users, size=target_config['max_users'], replace=False)
-                                        df = df[df['user'].isin(selected_users)]
-                            
-                            df.to_pickle(target_temp_file)
-                            copied_temp_weeks.append(week)
-                            missing_weeks.remove(week)
-                        except Exception as e:
-                            print(f"复制临时文件周 {week} 时出错: {e}")
-                
-                if copied_temp_weeks:
-                    print(f"成功复制了 {len(copied_temp_weeks)} 周的临时文件: {copied_temp_weeks}")
-        
-        if missing_weeks:
-            print(f"需要生成 {len(missing_weeks)} 个周的临时文件...")
-            # 并行处理缺失的周数据，计算该周的特征并保存为临时pickle文件
-            Parallel(n_jobs=numCores)(delayed(to_csv)(i, mode, dname, ul, uf_dict, list_uf, subsession_mode, config_id) 
-                                       for i in missing_weeks)
+            print(f"{mode} 模式需要生成 {len(missing_weeks)} 个周的临时文件...")
         else:
-            print("所有临时文件都已存在，直接合并为CSV文件...")
+            print(f"{mode} 模式所有临时文件都已存在，直接合并为CSV文件...")
+        for week in missing_weeks:
+            week_modes.setdefault(week, []).append(mode)
+    
+    if week_modes:
+        print(f"需要生成 {len(week_modes)} 个周的临时文件...")
+        # 会话跨周拼接：先串行地找出每周结束时仍未结束的会话（只划分会话，不计算特征），各周再并行处理
+        session_missing = [week for week in week_modes if 'session' in week_modes[week]]
+        if session_missing and session_cross_week:
+            carry_open_sessions([i for i in mode_weeks['session'] if i < max(session_missing)], config_id, storage, user_codes)
+        # 并行处理缺失的周数据，每周只读取一次数值化数据，计算该周所有需要的模式的特征并保存为临时文件
+        Parallel(n_jobs=numCores)(delayed(to_csv)(i, week_modes[i], dname, u_attrs, subsession_mode, config_id, storage, session_cross_week, user_codes) 
+                                   for i in sorted(week_modes))
+        # 新生成的临时文件移入缓存
+        for temp_file, key in regen_files.items():
+            if os.path.exists(storage_path(temp_file, storage)):
+                cache_store(tmp_index, "tmp", key, temp_file, storage)
+    cache_size = cache_evict(tmp_index, "tmp", cache_limit_gb * 1024**3, {os.path.basename(storage_path(k, storage)) for k in tmp_keys.values()})
+    save_cache_index("tmp", tmp_index)
+    print(f"tmp缓存: 本次命中 {run_hits} 个文件, 缓存大小 {cache_size/1024**3:.2f} GB, 累计命中 {tmp_index['hits']} 次, 未命中 {tmp_index['misses']} 次")
+    
+    # 处理选定的时间粒度
+    for mode in mode_weeks:
+        weekRange = mode_weeks[mode]
         
         # ==================== 合并所有周的数据为单一CSV文件 ====================
         print(f"开始合并 {mode} 模式的所有周数据为CSV文件...")
         
-        # 创建输出CSV文件，文件名格式：mode + 数据集版本.csv (如weekr4.2.csv)
-        csv_filename = f'ExtractedData/{mode}{dname}_{config_id}.csv'
-        
-        # 如果文件已存在，先删除
-        if os.path.exists(csv_filename):
-            os.remove(csv_filename)
-        
-        all_csv = open(csv_filename, 'a')
+        # 输出CSV文件，文件名格式：mode + 数据集版本.csv (如weekr4.2.csv)，压缩时扩展名为.csv.gz或.csv.zst
+        csv_filename = f'ExtractedData/{mode}{dname}_{config_id}'
         
-        # 读取第一周的数据并写入CSV文件头
-        first_week_file = f"tmp/{weekRange[0]}{mode}_{config_id}.pickle"
-        if os.path.exists(first_week_file):
-            towrite = pd.read_pickle(first_week_file)
-            towrite.to_csv(all_csv, header=True, index=False)
-            print(f"第一周数据写入完成，特征维度: {towrite.shape[1]}, 样本数: {towrite.shape[0]}")
-            
-            # 逐一读取剩余周的数据并追加到CSV文件（不包含文件头）
-            total_samples = towrite.shape[0]
-            for w in weekRange[1:]:
-                week_file = f"tmp/{w}{mode}_{config_id}.pickle"
-                if os.path.exists(week_file):
-                    towrite = pd.read_pickle(week_file)        
-                    towrite.to_csv(all_csv, header=False, index=False)
-                    total_samples += towrite.shape[0]
-                else:
-                    print(f"警告: 周 {w} 的临时文件不存在: {week_file}")
-                
-            all_csv.close()
-            print(f"{mode} 模式主文件完成: {csv_filename}, 总样本数: {total_samples}")
-        else:
-            all_csv.close()
+        # 第一周的临时文件提供CSV文件头
+        first_week_file = f"tmp/{weekRange[0]}{mode}_{config_id}"
+        if not os.path.exists(storage_path(first_week_file, storage)):
             print(f"错误: 第一周的临时文件不存在: {first_week_file}")
             continue
         
+        # 各周并行格式化为CSV，按周的顺序写入
+        total_samples, n_features = merge_week_csv([f"tmp/{w}{mode}_{config_id}" for w in weekRange], csv_filename, storage, 
+                                                   numCores, csv_compression, columnar)
+        print(f"{mode} 模式主文件完成: {csv_filename}{csv_ext}, 特征维度: {n_features}, 总样本数: {total_samples}")
+        
         # ==================== 处理子会话数据（仅限会话模式） ====================
         if mode == 'session' and enable_subsession and len(subsession_mode) > 0:
             print("开始处理子会话数据...")
@@ -2515,39 +2749,23 @@ if __name__ == "__main__":
                 for k2 in subsession_mode[k1]:  # k2: 具体的数值（如25, 50, 120, 240）
                     print(f"处理子会话类型: {k1}, 参数: {k2}")
                     
-                    # 创建子会话CSV文件，文件名格式：session + 类型 + 参数 + 数据集.csv
+                    # 子会话CSV文件，文件名格式：session + 类型 + 参数 + 数据集.csv
                     # 例如：sessionnact25r4.2.csv, sessiontime120r4.2.csv
-                    subsession_csv_filename = f'ExtractedData/{mode}{k1}{k2}{dname}_{config_id}.csv'
+                    subsession_csv_filename = f'ExtractedData/{mode}{k1}{k2}{dname}_{config_id}'
                     
                     # 检查文件是否已存在
-                    if os.path.exists(subsession_csv_filename):
-                        print(f"子会话文件已存在，跳过: {subsession_csv_filename}")
+                    if os.path.exists(subsession_csv_filename + csv_ext):
+                        print(f"子会话文件已存在，跳过: {subsession_csv_filename}{csv_ext}")
                         continue
                     
-                    all_csv = open(subsession_csv_filename, 'a')
-                    
-                    # 读取第一周的子会话数据
-                    first_subsession_file = f'tmp/{weekRange[0]}{mode}{k1}{k2}_{config_id}.pickle'
-                    if os.path.exists(first_subsession_file):
-                        towrite = pd.read_pickle(first_subsession_file)
-                        towrite.to_csv(all_csv, header=True, index=False)
-                        
-                        # 追加剩余周的子会话数据
-                        subsession_samples = towrite.shape[0]
-                        for w in weekRange[1:]:
-                            subsession_file = f'tmp/{w}{mode}{k1}{k2}_{config_id}.pickle'
-                            if os.path.exists(subsession_file):
-                                towrite = pd.read_pickle(subsession_file)        
-                                towrite.to_csv(all_csv, header=False, index=False)
-                                subsession_samples += towrite.shape[0]
-                            else:
-                                print(f"警告: 周 {w} 的子会话文件不存在: {subsession_file}")
-                                
-                        all_csv.close()
-                        print(f"子会话文件完成: {subsession_csv_filename}, 样本数: {subsession_samples}")
-                    else:
-                        all_csv.close()
+                    first_subsession_file = f'tmp/{weekRange[0]}{mode}{k1}{k2}_{config_id}'
+                    if not os.path.exists(storage_path(first_subsession_file, storage)):
                         print(f"错误: 第一周的子会话文件不存在: {first_subsession_file}")
+                        continue
+                    
+                    subsession_samples, _ = merge_week_csv([f'tmp/{w}{mode}{k1}{k2}_{config_id}' for w in weekRange], subsession_csv_filename, 
+                                                           storage, numCores, csv_compression, columnar)
+                    print(f"子会话文件完成: {subsession_csv_filename}{csv_ext}, 样本数: {subsession_samples}")
         
         # 打印当前模式完成信息和耗时
         print(f'{mode} 模式数据提取完成. 耗时 (分钟): {(time.time()-st)/60:.2f}')
@@ -2561,7 +2779,7 @@ if __name__ == "__main__":
     - 释放磁盘空间，保持工作目录整洁
     
     被删除的目录：
-    - tmp/: 临时pickle文件
+    - tmp/: 临时中间结果文件
     - DataByWeek/: 按周合并的原始数据  
     - NumDataByWeek/: 数值化的周特征数据
     
@@ -2587,7 +2805,7 @@ if __name__ == "__main__":
     
     # 检查并报告生成的文件
     for mode in selected_modes:
-        csv_file = f"ExtractedData/{mode}{dname}_{config_id}.csv"
+        csv_file = f"ExtractedData/{mode}{dname}_{config_id}{csv_ext}"
         if os.path.exists(csv_file):
             file_size = os.path.getsize(csv_file) / (1024*1024)  # MB
             print(f"✓ {mode}级别特征: {csv_file} ({file_size:.1f} MB)")
@@ -2598,12 +2816,12 @@ if __name__ == "__main__":
         print("- 子会话特征文件:")
         for k1 in subsession_mode:
             for k2 in subsession_mode[k1]:
-                subsession_file = f"ExtractedData/session{k1}{k2}{dname}_{config_id}.csv"
+                subsession_file = f"ExtractedData/session{k1}{k2}{dname}_{config_id}{csv_ext}"
                 if os.path.exists(subsession_file):
                     file_size = os.path.getsize(subsession_file) / (1024*1024)  # MB
-                    print(f"  ✓ ExtractedData/session{k1}{k2}{dname}_{config_id}.csv ({file_size:.1f} MB)")
+                    print(f"  ✓ {subsession_file} ({file_size:.1f} MB)")
                 else:
-                    print(f"  ✗ ExtractedData/session{k1}{k2}{dname}_{config_id}.csv (未生成)")
+                    print(f"  ✗ {subsession_file} (未生成)")
     
     print(f"\n总处理时间: {(time.time()-st)/60:.2f} 分钟")
     print("="*60)
@@ -0,0 +1,482 @@
+"""
+向量化之前逐行实现的原始版本(process_user_pc, process_week_num及其逐行辅助函数), 原样保留,
+只作为测试中的对照, 不被feature_extraction.py使用
+"""
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from feature_extraction import time_convert
+
+def process_user_pc(upd, roles): #figure out  which PC belongs to which user
+    """
+    处理用户-PC对应关系
+    参数:
+    - upd: 用户-PC数据
+    - roles: 用户角色信息
+    功能:
+    - 确定每个用户的主要PC
+    - 识别共享PC
+    - 处理IT管理员特殊情况
+    """
+
+    upd['sharedpc'] = None
+    upd['npc'] = upd['pcs'].apply(lambda x: len(x))
+    upd.at[upd['npc']==1,'pc'] = upd[upd['npc']==1]['pcs'].apply(lambda x: x[0])
+    multiuser_pcs = np.concatenate(upd[upd['npc']>1]['pcs'].values).tolist()
+    set_multiuser_pc = list(set(multiuser_pcs))
+    count = {}
+    for pc in set_multiuser_pc:
+        count[pc] = multiuser_pcs.count(pc)
+    for u in upd[upd['npc']>1].index:
+        sharedpc = upd.loc[u]['pcs']
+        count_u_pc = [count[pc] for pc in upd.loc[u]['pcs']]
+        the_pc = count_u_pc.index(min(count_u_pc))
+        upd.at[u,'pc'] = sharedpc[the_pc]
+        if roles.loc[u] != 'ITAdmin':
+            sharedpc.remove(sharedpc[the_pc])
+            upd.at[u,'sharedpc']= sharedpc
+    return upd
+
+def is_after_whour(dt): #Workhours assumed 7:30-17:30
+    """判断是否在工作时间之后"""
+    wday_start = datetime.strptime("7:30", "%H:%M").time()
+    wday_end = datetime.strptime("17:30", "%H:%M").time()
+    dt = dt.time()
+    if dt < wday_start or dt > wday_end:
+        return True
+    return False
+      
+def is_weekend(dt):
+    """判断是否是周末"""
+    if dt.strftime("%w") in ['0', '6']:
+        return True
+    return False   
+    
+def email_process(act, data = 'r4.2', separate_send_receive = True):
+    """处理邮件活动特征"""
+    receivers = act['to'].split(';')
+    if type(act['cc']) == str:
+        receivers = receivers + act['cc'].split(";")
+    if type(act['bcc']) == str:
+        bccreceivers = act['bcc'].split(";")   
+    else:
+        bccreceivers = []
+    exemail = False
+    n_exdes = 0
+    for i in receivers + bccreceivers:
+        if 'dtaa.com' not in i:
+            exemail = True
+            n_exdes += 1
+
+    n_des = len(receivers) + len(bccreceivers)
+    Xemail = 1 if exemail else 0
+    n_bccdes = len(bccreceivers)
+    exbccmail = 0
+    email_text_len = len(act['content'])
+    email_text_nwords = act['content'].count(' ') + 1
+    for i in bccreceivers:
+        if 'dtaa.com' not in i:
+            exbccmail = 1
+            break
+
+    if data in ['r5.1','r5.2','r6.1','r6.2']:
+        send_mail = 1 if act['activity'] == 'Send' else 0
+        receive_mail = 1 if act['activity'] in ['Receive','View'] else 0
+        
+        atts = act['att'].split(';')
+        n_atts = len(atts)
+        size_atts = 0
+        att_types = [0,0,0,0,0,0]
+        att_sizes = [0,0,0,0,0,0]
+        for att in atts:
+            if '.' in att:
+                tmp = file_process(att, filetype='att')
+                att_types = [sum(x) for x in zip(att_types,tmp[0])]
+                att_sizes = [sum(x) for x in zip(att_sizes,tmp[1])]
+                size_atts +=sum(tmp[1])
+        return [send_mail, receive_mail, n_des, n_atts, Xemail, n_exdes, 
+                n_bccdes, exbccmail, int(act['size']), email_text_len, 
+                email_text_nwords] + att_types + att_sizes
+    elif data in ['r4.1','r4.2']:
+        return [n_des, int(act['#att']), Xemail, n_exdes, n_bccdes, exbccmail, 
+                int(act['size']), email_text_len, email_text_nwords]
+        
+def http_process(act, data = 'r4.2'): 
+    """处理HTTP活动特征"""
+    # basic features:
+    url_len = len(act['url/fname'])
+    url_depth = act['url/fname'].count('/')-2
+    content_len = len(act['content'])
+    content_nwords = act['content'].count(' ')+1
+    
+    domainname = re.findall("//(.*?)/", act['url/fname'])[0]
+    domainname.replace("www.","")
+    dn = domainname.split(".")
+    if len(dn) > 2 and not any([x in domainname for x in ["google.com", '.co.uk', '.co.nz', 'live.com']]):
+        domainname = ".".join(dn[-2:])
+
+    # other 1, socnet 2, cloud 3, job 4, leak 5, hack 6
+    if domainname in ['dropbox.com', 'drive.google.com', 'mega.co.nz', 'account.live.com']:
+        r = 3
+    elif domainname in ['wikileaks.org','freedom.press','theintercept.com']:
+        r = 5
+    elif domainname in ['facebook.com','twitter.com','plus.google.com','instagr.am','instagram.com',
+                        'flickr.com','linkedin.com','reddit.com','about.com','youtube.com','pinterest.com',
+                        'tumblr.com','quora.com','vine.co','match.com','t.co']:
+        r = 2
+    elif domainname in ['indeed.com','monster.com', 'careerbuilder.com','simplyhired.com']:
+        r = 4
+    
+    elif ('job' in domainname and ('hunt' in domainname or 'search' in domainname)) \
+    or ('aol.com' in domainname and ("recruit" in act['url/fname'] or "job" in act['url/fname'])):
+        r = 4
+    elif (domainname in ['webwatchernow.com','actionalert.com', 'relytec.com','refog.com','wellresearchedreviews.com',
+                         'softactivity.com', 'spectorsoft.com','best-spy-soft.com']):
+        r = 6
+    elif ('keylog' in domainname):
+        r = 6
+    else:
+        r = 1
+    if data in ['r6.1','r6.2']:
+        http_act_dict = {'www visit': 1, 'www download': 2, 'www upload': 3}
+        http_act = http_act_dict.get(act['activity'].lower(), 0)
+        return [r, url_len, url_depth, content_len, content_nwords, http_act]
+    else:
+        return [r, url_len, url_depth, content_len, content_nwords]
+        
+def file_process(act, complete_ul = None, data = 'r4.2', filetype = 'act'):
+    """处理文件活动特征"""
+    if filetype == 'act':
+        ftype = act['url/fname'].split(".")[1]
+        disk = 1 if act['url/fname'][0] == 'C' else 0
+        if act['url/fname'][0] == 'R': disk = 2
+        file_depth = act['url/fname'].count('\\')
+    elif filetype == 'att': #attachments
+        tmp = act.split('.')[1]
+        ftype = tmp[:tmp.find('(')]
+        attsize = int(tmp[tmp.find("(")+1:tmp.find(")")])
+        r = [[0,0,0,0,0,0], [0,0,0,0,0,0]]
+        if ftype in ['zip','rar','7z']:
+            ind = 1
+        elif ftype in ['jpg', 'png', 'bmp']:
+            ind = 2
+        elif ftype in ['doc','docx', 'pdf']:
+            ind = 3
+        elif ftype in ['txt','cfg', 'rtf']:
+            ind = 4
+        elif ftype in ['exe', 'sh']:
+            ind = 5
+        else:
+            ind = 0
+        r[0][ind] = 1
+        r[1][ind] = attsize
+        return r
+
+    fsize = len(act['content'])
+    f_nwords = act['content'].count(' ')+1
+    if ftype in ['zip','rar','7z']:
+        r = 2
+    elif ftype in ['jpg', 'png', 'bmp']:
+        r = 3
+    elif ftype in ['doc','docx', 'pdf']:
+        r = 4
+    elif ftype in ['txt','cfg','rtf']:
+        r = 5
+    elif ftype in ['exe', 'sh']:
+        r = 6
+    else:
+        r = 1
+    if data in ['r5.2','r5.1', 'r6.2','r6.1']:
+        to_usb = 1 if act['to'] == 'True' else 0
+        from_usb = 1 if act['from'] == 'True' else 0
+        file_depth = act['url/fname'].count('\\')
+        file_act_dict = {'file open': 1, 'file copy': 2, 'file write': 3, 'file delete': 4}
+        if act['activity'].lower() not in file_act_dict: print(act['activity'].lower())
+        file_act = file_act_dict.get(act['activity'].lower(), 0)
+        return [r, fsize, f_nwords, disk, file_depth, file_act, to_usb, from_usb]
+    elif data in ['r4.1','r4.2']:
+        return [r, fsize, f_nwords, disk, file_depth]
+
+def from_pc(act, ul):
+    """
+    判断用户活动发生在什么类型的电脑上
+    参数:
+    - act: 用户活动数据
+    - ul: 用户列表数据
+    返回:
+    - 电脑类型代码(0-3)和电脑ID
+    - 0: 用户自己的电脑
+    - 1: 共享电脑
+    - 2: 他人的电脑
+    - 3: 主管的电脑
+    """
+    user_pc = ul.loc[act['user']]['pc']
+    act_pc = act['pc']
+    if act_pc == user_pc:
+        return (0, act_pc) #using normal PC
+    elif ul.loc[act['user']]['sharedpc'] is not None and act_pc in ul.loc[act['user']]['sharedpc']:
+        return (1, act_pc)
+    elif ul.loc[act['user']]['sup'] is not None and act_pc == ul.loc[ul.loc[act['user']]['sup']]['pc']:
+        return (3, act_pc)
+    else:
+        return (2, act_pc)
+
+def process_week_num(week, users, userlist = 'all', data = 'r4.2', config_id = None):
+    """
+    处理一周内的用户活动数据,转换为数值特征
+    
+    这个函数是特征提取的核心部分，它将原始的用户活动数据（登录、文件操作、邮件、HTTP访问等）
+    转换为机器学习可以使用的数值特征向量。
+    
+    参数:
+    - week: 周数索引，用于读取对应周的数据文件
+    - users: 用户信息数据框，包含用户属性和恶意用户标记
+    - userlist: 要处理的用户列表，默认'all'表示处理所有用户
+    - data: 数据集名称(r4.2, r5.2等)，不同数据集的特征维度不同
+    - config_id: 配置标识符，用于区分不同参数的运行
+    
+    功能:
+    - 读取一周的活动数据（从DataByWeek文件夹）
+    - 将每种活动类型转换为对应的数值特征
+    - 标记恶意活动和内部威胁用户
+    - 保存处理后的数值数据到NumDataByWeek文件夹
+    
+    输出:
+    - 生成包含数值特征的pickle文件，用于后续的统计特征计算
+    """
+    
+    # ========== 1. 初始化和数据准备 ==========
+    # 创建用户ID到索引的映射字典，用于后续快速查找
+    user_dict = {idx: i for (i, idx) in enumerate(users.index)}
+    
+    # 读取指定周的活动数据（之前由combine_by_timerange_pandas生成）
+    acts_week = pd.read_pickle("DataByWeek/"+str(week)+".pickle")
+    
+    # 获取该周的时间范围，用于判断恶意活动时间窗口
+    start_week, end_week = min(acts_week.date), max(acts_week.date)
+    
+    # 按时间排序，确保活动按时间顺序处理（对于connect/disconnect配对很重要）
+    acts_week.sort_values('date', ascending = True, inplace = True)
+    
+    # ========== 2. 确定特征维度 ==========
+    # 根据不同数据集版本设置特征向量的维度
+    # r5.x版本有45列，r6.x版本有46列（多了HTTP活动类型），r4.x版本只有27列
+    n_cols = 45 if data in ['r5.2','r5.1'] else 46
+    if data in ['r4.2','r4.1']: n_cols = 27
+    
+    # 初始化存储所有用户该周活动特征的矩阵
+    u_week = np.zeros((len(acts_week), n_cols))
+    
+    # 存储每个活动的元信息：[活动ID, PC ID, 时间戳]
+    pc_time = []
+    
+    # 如果没有指定用户列表，则处理该周所有活跃用户
+    if userlist == 'all':
+        userlist = set(acts_week.user)
+    
+    # 确保只处理在用户信息表中存在的用户，避免KeyError
+    userlist = [u for u in userlist if u in users.index]
+    
+    if not userlist:
+        print(f"警告: 周 {week} 没有有效的用户数据")
+        # 创建空的DataFrame保存
+        empty_df = pd.DataFrame(columns=['actid','pcid','time_stamp'] + ['user','day','act','pc','time'] + 
+                               ['usb_dur'] + (['file_tree_len'] if data not in ['r4.2','r4.1'] else []) +
+                               ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth'] + 
+                               (['file_act', 'to_usb', 'from_usb'] if data not in ['r4.2','r4.1'] else []) +
+                               ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords'] + 
+                               (['http_act'] if data in ['r6.2','r6.1'] else []) +
+                               (['send_mail', 'receive_mail'] if data not in ['r4.2','r4.1'] else []) +
+                               ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords'] +
+                               (['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe',
+                                 'e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe'] if data not in ['r4.2','r4.1'] else []) +
+                               ['mal_act','insider'])
+        empty_df.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
+        return
+    
+    # ========== 3. 按用户循环处理活动数据 ==========
+    current_ind = 0  # 当前在总矩阵中的行索引
+    
+    for u in userlist:
+        # 提取当前用户在该周的所有活动
+        df_acts_u = acts_week[acts_week.user == u]
+        
+        # ========== 3.1 判断用户是否为恶意用户 ==========
+        mal_u = 0  # 初始化为正常用户
+        # 如果用户在恶意用户列表中（malscene > 0表示参与了某个恶意场景）
+        if users.loc[u].malscene > 0:
+            # 检查当前周是否在该用户的恶意活动时间窗口内
+            if start_week <= users.loc[u].mend and users.loc[u].mstart <= end_week:
+                mal_u = users.loc[u].malscene  # 记录恶意场景编号
+        
+        # ========== 3.2 活动类型标准化和映射 ==========
+        # 获取所有活动类型（来自type列）
+        list_uacts = df_acts_u.type.tolist()
+        
+        # 获取活动的具体操作（来自activity列，主要用于设备连接操作）
+        list_activity = df_acts_u.activity.tolist()
+        
+        # 对于设备相关活动，将activity列的值转换为小写并标准化
+        # 这里处理Logon/Logoff/Connect/Disconnect等设备操作
+        list_uacts = [list_activity[i].strip().lower() if (type(list_activity[i])==str and list_activity[i].strip() in ['Logon', 'Logoff', 'Connect', 'Disconnect']) \
+                        else list_uacts[i] for i in range(len(list_uacts))]
+        
+        # 将活动类型映射为数值编码
+        # 1:登录, 2:登出, 3:设备连接, 4:设备断开, 5:HTTP访问, 6:邮件, 7:文件操作
+        uacts_mapping = {'logon':1, 'logoff':2, 'connect':3, 'disconnect':4, 'http':5,'email':6,'file':7}
+        list_uacts_num = [uacts_mapping[x] for x in list_uacts]
+
+        # 初始化当前用户的特征矩阵
+        oneu_week = np.zeros((len(df_acts_u), n_cols))
+        oneu_pc_time = []  # 存储当前用户的活动元信息
+        
+        # ========== 3.3 逐个活动处理 ==========
+        for i in range(len(df_acts_u)):
+            # ========== 3.3.1 确定活动发生的PC类型 ==========
+            # 调用from_pc函数判断活动发生在什么类型的电脑上
+            # 返回值：0=自己的PC, 1=共享PC, 2=他人的PC, 3=主管的PC
+            pc, _ = from_pc(df_acts_u.iloc[i], users)
+            
+            # ========== 3.3.2 确定活动发生的时间类型 ==========
+            # 根据是否为周末和是否为工作时间，将时间分为4类
+            if is_weekend(df_acts_u.iloc[i]['date']):
+                if is_after_whour(df_acts_u.iloc[i]['date']):
+                    act_time = 4  # 周末非工作时间
+                else:
+                    act_time = 3  # 周末工作时间
+            elif is_after_whour(df_acts_u.iloc[i]['date']):
+                act_time = 2  # 工作日非工作时间
+            else:
+                act_time = 1  # 工作日工作时间
+            
+            # ========== 3.3.3 初始化各类活动的特征向量 ==========
+            # 根据数据集版本初始化不同维度的特征向量
+            if data in ['r4.2','r4.1']:
+                device_f = [0]              # 设备特征：USB连接时长
+                file_f = [0, 0, 0, 0, 0]    # 文件特征：类型、大小、词数、磁盘、深度
+                http_f = [0,0,0,0,0]        # HTTP特征：类型、URL长度、深度、内容长度、词数
+                email_f = [0]*9             # 邮件特征：9维
+            elif data in ['r5.2','r5.1','r6.2','r6.1']:
+                device_f = [0,0]            # 设备特征：USB连接时长、文件树长度
+                file_f = [0]*8              # 文件特征：8维（增加了USB传输标记）
+                http_f = [0,0,0,0,0]        # HTTP特征：5维基础特征
+                if data in ['r6.2','r6.1']:
+                    http_f = [0,0,0,0,0,0]  # r6版本增加了HTTP活动类型
+                email_f = [0]*23            # 邮件特征：23维（增加了附件相关特征）
+            
+            # ========== 3.3.4 根据活动类型提取具体特征 ==========
+            if list_uacts[i] == 'file':
+                # 文件操作：提取文件类型、大小、深度等特征
+                file_f = file_process(df_acts_u.iloc[i], data = data)
+                
+            elif list_uacts[i] == 'email':
+                # 邮件活动：提取收件人数量、附件、外部邮件等特征
+                email_f = email_process(df_acts_u.iloc[i], data = data)
+                
+            elif list_uacts[i] == 'http':
+                # HTTP访问：提取URL类型、长度、内容等特征
+                http_f = http_process(df_acts_u.iloc[i], data=data)
+                
+            elif list_uacts[i] == 'connect':
+                # ========== 设备连接：需要特殊处理，计算连接持续时间 ==========
+                # 从当前活动开始，向后查找对应的断开连接活动
+                tmp = df_acts_u.iloc[i:]
+                
+                # 查找同一用户在同一PC上的断开连接活动
+                disconnect_acts = tmp[(tmp['activity'] == 'Disconnect\n') & \
+                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
+                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
+                
+                # 查找同一用户在同一PC上的后续连接活动（用于处理异常情况）
+                connect_acts = tmp[(tmp['activity'] == 'Connect\n') & \
+                 (tmp['user'] == df_acts_u.iloc[i]['user']) & \
+                 (tmp['pc'] == df_acts_u.iloc[i]['pc'])]
+                
+                # 计算连接持续时间
+                if len(disconnect_acts) > 0:
+                    distime = disconnect_acts.iloc[0]['date']
+                    # 如果在断开之前又有连接，说明数据异常
+                    if len(connect_acts) > 0 and connect_acts.iloc[0]['date'] < distime:
+                        connect_dur = -1  # 标记为异常
+                    else:
+                        # 计算正常的连接持续时间（以秒为单位）
+                        tmp_td = distime - df_acts_u.iloc[i]['date']
+                        connect_dur = tmp_td.days*24*3600 + tmp_td.seconds
+                else:
+                    connect_dur = -1  # 没有找到断开连接活动，标记为异常
+                    
+                # 根据数据集版本设置设备特征
+                if data in ['r5.2','r5.1','r6.2','r6.1']:
+                    # 新版本增加了文件树长度特征
+                    file_tree_len = len(df_acts_u.iloc[i]['content'].split(';'))
+                    device_f = [connect_dur, file_tree_len]
+                else:
+                    device_f = [connect_dur]
+                
+            # ========== 3.3.5 检查是否为恶意活动 ==========
+            is_mal_act = 0
+            # 如果用户是恶意用户，且当前活动ID在恶意活动列表中
+            if mal_u > 0 and df_acts_u.index[i] in users.loc[u]['malacts']:
+                is_mal_act = 1
+
+            # ========== 3.3.6 组装完整的特征向量 ==========
+            # 特征向量组成：[用户ID, 天数, 活动类型, PC类型, 时间类型] + 各类活动特征 + [恶意活动标记, 内部威胁场景]
+            oneu_week[i,:] = [ user_dict[u], time_convert(df_acts_u.iloc[i]['date'], 'dt2dn'), list_uacts_num[i], pc, act_time] \
+            + device_f + file_f + http_f + email_f + [is_mal_act, mal_u]
+
+            # 保存活动的元信息：[活动索引, PC ID, 时间戳]
+            oneu_pc_time.append([df_acts_u.index[i], df_acts_u.iloc[i]['pc'], df_acts_u.iloc[i]['date']])
+            
+        # ========== 3.4 将当前用户的数据添加到总矩阵中 ==========
+        u_week[current_ind:current_ind+len(oneu_week),:] = oneu_week
+        pc_time += oneu_pc_time
+        current_ind += len(oneu_week)
+    
+    # ========== 4. 数据后处理和保存 ==========
+    # 截取实际使用的行数（去除初始化时的多余行）
+    u_week = u_week[0:current_ind, :]
+    
+    # ========== 4.1 定义列名 ==========
+    # 基础列：用户、天数、活动类型、PC类型、时间类型
+    col_names = ['user','day','act','pc','time']
+    
+    # 根据数据集版本定义各类特征的列名
+    if data in ['r4.1','r4.2']:
+        device_feature_names = ['usb_dur']  # 设备特征：USB持续时间
+        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth']
+        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
+        email_feature_names = ['n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
+    elif data in ['r5.2','r5.1', 'r6.2','r6.1']:
+        device_feature_names = ['usb_dur', 'file_tree_len']  # 增加文件树长度
+        file_feature_names = ['file_type', 'file_len', 'file_nwords', 'disk', 'file_depth', 'file_act', 'to_usb', 'from_usb']  # 增加USB传输特征
+        http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords']
+        if data in ['r6.2','r6.1']:
+            http_feature_names = ['http_type', 'url_len','url_depth', 'http_c_len', 'http_c_nwords', 'http_act']  # r6版本增加HTTP活动类型
+        # 邮件特征大幅增加，包含发送/接收标记和各种附件特征
+        email_feature_names = ['send_mail', 'receive_mail','n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords']
+        # 附件类型特征：压缩包、图片、文档、文本、可执行文件
+        email_feature_names += ['e_att_other', 'e_att_comp', 'e_att_pho', 'e_att_doc', 'e_att_txt', 'e_att_exe']
+        # 附件大小特征：对应各种类型附件的总大小
+        email_feature_names += ['e_att_sother', 'e_att_scomp', 'e_att_spho', 'e_att_sdoc', 'e_att_stxt', 'e_att_sexe']     
+        
+    # 组合所有列名
+    col_names = col_names + device_feature_names + file_feature_names+ http_feature_names + email_feature_names + ['mal_act','insider']
+    
+    # ========== 4.2 创建最终的DataFrame ==========
+    # 包含元信息列和特征列
+    df_u_week = pd.DataFrame(columns=['actid','pcid','time_stamp'] + col_names, index = np.arange(0,len(pc_time)))
+    
+    # 填充元信息
+    df_u_week[['actid','pcid','time_stamp']] = np.array(pc_time)
+    
+    # 填充特征数据并转换为整数类型（除了时间戳）
+    df_u_week[col_names] = u_week
+    df_u_week[col_names] = df_u_week[col_names].astype(int)
+    
+    # ========== 4.3 保存处理结果 ==========
+    # 将处理后的数值特征保存到NumDataByWeek文件夹
+    # 这些文件将被后续的统计特征计算函数使用
+    df_u_week.to_pickle("NumDataByWeek/"+str(week)+"_num_"+config_id+".pickle")
@@ -0,0 +1,57 @@
+"""
+中间结果缓存: 命中时链接到缓存对象, 淘汰时同时删除链接和不支持符号链接时复制出的文件
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import feature_extraction as fe
+
+@pytest.fixture(params = ['symlink', 'copy'])
+def cache_dir(request, tmp_path, monkeypatch):
+    """在临时目录中准备tmp缓存目录; copy时模拟不支持符号链接的文件系统"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('tmp')
+    if request.param == 'copy':
+        def no_symlink(*args):
+            raise OSError('symlinks not supported')
+        monkeypatch.setattr(os, 'symlink', no_symlink)
+    return request.param
+
+def store(index, name, key, value):
+    """生成一个临时文件并移入缓存"""
+    fe.save_frame(pd.DataFrame({'x': [value]}), f"tmp/{name}")
+    fe.cache_store(index, "tmp", key, f"tmp/{name}")
+
+def test_fetch_and_evict(cache_dir):
+    index = fe.load_cache_index("tmp")
+    store(index, '0week_a', 'k0', 0)
+    store(index, '1week_a', 'k1', 1)
+    assert os.path.islink('tmp/0week_a.pickle') == (cache_dir == 'symlink')
+    assert sorted(index['copies']) == ([] if cache_dir == 'symlink' else ['tmp/0week_a.pickle', 'tmp/1week_a.pickle'])
+
+    # 另一个配置命中同一个对象
+    assert fe.cache_fetch(index, "tmp", 'k0', "tmp/0week_b")
+    assert fe.load_frame("tmp/0week_b")['x'].tolist() == [0]
+    assert not fe.cache_fetch(index, "tmp", 'k2', "tmp/2week_b")
+
+    # 上限为0时淘汰k0以外的对象: 1week_a的链接或副本一起删除, 之后的运行会重新生成
+    fe.cache_evict(index, "tmp", 0, keep = {'k0.pickle'})
+    assert list(index['entries']) == ['k0.pickle']
+    assert not os.path.lexists('tmp/1week_a.pickle')
+    assert os.path.exists('tmp/0week_a.pickle') and os.path.exists('tmp/0week_b.pickle')
+    assert all(name == 'k0.pickle' for name in index['copies'].values())
+
+    fe.save_cache_index("tmp", index)
+    assert not fe.cache_fetch(fe.load_cache_index("tmp"), "tmp", 'k1', "tmp/1week_a")
+
+def test_miss_replaces_copy(cache_dir):
+    # 不同输入生成的同名文件在未命中时删除, 重新生成后属于新的对象, 淘汰旧对象时不会删除它
+    index = fe.load_cache_index("tmp")
+    store(index, '0week_a', 'old', 0)
+    assert not fe.cache_fetch(index, "tmp", 'new', "tmp/0week_a")
+    assert not os.path.lexists('tmp/0week_a.pickle')
+    store(index, '0week_a', 'new', 1)
+    fe.cache_evict(index, "tmp", 0, keep = {'new.pickle'})
+    assert fe.load_frame("tmp/0week_a")['x'].tolist() == [1]
@@ -0,0 +1,45 @@
+"""
+load_week_users按用户行索引读取部分用户: 各种存储格式、有无索引的结果都与按user过滤后重新编号的结果相同
+feather和parquet需要pyarrow, 没有安装时跳过
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_extraction as fe
+
+N_USERS = 6
+
+@pytest.fixture(params = ['pickle', 'feather', 'parquet'])
+def week_file(request, tmp_path, monkeypatch):
+    """在临时目录中保存按用户编号排列的一周数值化数据(用户3没有活动)及其用户行索引, 返回(存储格式, 数据)"""
+    storage = request.param
+    if storage != 'pickle':
+        pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    users = np.repeat([0, 1, 2, 4, 5], [3, 1, 4, 2, 5])
+    df = pd.DataFrame({'user': users, 'act': np.arange(len(users)) % 7 + 1, 'time_stamp': np.arange(len(users)) * 60.0})
+    fe.save_frame(df, 'week', storage)
+    fe.save_user_index('week', df['user'].values, N_USERS)
+    return storage, df
+
+def expected(df, user_codes, columns):
+    """按user过滤, 按子集中的新编号排列(每个用户内保持原顺序)并重新编号"""
+    parts = [df[df['user'] == u].assign(user = i) for i, u in enumerate(user_codes)]
+    return pd.concat(parts, ignore_index = True)[columns]
+
+@pytest.mark.parametrize('user_codes', [[4, 0, 2], [3, 5], [1]])
+@pytest.mark.parametrize('indexed', [True, False])
+def test_subset(week_file, user_codes, indexed):
+    storage, df = week_file
+    if not indexed:
+        os.remove('week' + fe.USER_INDEX_SUFFIX)
+    columns = ['user', 'time_stamp']
+    new = fe.load_week_users('week', storage, columns, user_codes)
+    pd.testing.assert_frame_equal(new, expected(df, user_codes, columns), check_dtype = False)
+
+def test_all_users(week_file):
+    storage, df = week_file
+    pd.testing.assert_frame_equal(fe.load_week_users('week', storage), df)
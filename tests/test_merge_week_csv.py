@@ -0,0 +1,65 @@
+"""
+merge_week_csv按周的顺序合并临时文件: 各种压缩格式的CSV内容相同, 列式文件与所有周拼接的结果相同
+zstd和列式输出分别需要zstandard和pyarrow, 没有安装时跳过
+"""
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_extraction as fe
+
+def week_frame(week, n):
+    """与to_csv输出类似的一周临时数据: 整数的标识列和浮点数的特征列"""
+    rng = np.random.default_rng(week)
+    return pd.DataFrame({'starttime': week * 7.0 + np.arange(n), 'user': np.arange(n) % 3, 'week': week,
+                         'n_act': rng.integers(0, 50, n), 'mean_dur': rng.random(n) * 100})
+
+@pytest.fixture
+def week_files(tmp_path, monkeypatch):
+    """在临时目录中保存3周的临时文件(第1周为空), 返回(临时文件路径, 所有周拼接的结果)"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('tmp')
+    frames = [week_frame(0, 5), week_frame(1, 0), week_frame(2, 4)]
+    files = []
+    for week, df in enumerate(frames):
+        fe.save_frame(df, f"tmp/{week}week_test")
+        files.append(f"tmp/{week}week_test")
+    return files, pd.concat(frames, ignore_index = True)
+
+def test_plain_csv(week_files):
+    files, expected = week_files
+    assert fe.merge_week_csv(files + ["tmp/3week_test"], 'out', n_jobs = 2) == expected.shape
+    pd.testing.assert_frame_equal(pd.read_csv('out.csv'), expected)
+
+def test_gzip(week_files):
+    files, expected = week_files
+    fe.merge_week_csv(files, 'out')
+    fe.merge_week_csv(files, 'out', compression = 'gzip')
+    with gzip.open('out.csv.gz', 'rb') as f, open('out.csv', 'rb') as plain:
+        assert f.read() == plain.read()
+
+def test_zstd(week_files):
+    zstandard = pytest.importorskip('zstandard')
+    files, expected = week_files
+    fe.merge_week_csv(files, 'out')
+    fe.merge_week_csv(files, 'out', compression = 'zstd')
+    with open('out.csv.zst', 'rb') as f, open('out.csv', 'rb') as plain:
+        assert zstandard.ZstdDecompressor().stream_reader(f).read() == plain.read()
+
+@pytest.mark.parametrize('columnar', ['parquet', 'feather'])
+def test_columnar(week_files, columnar):
+    pytest.importorskip('pyarrow')
+    files, expected = week_files
+    assert fe.merge_week_csv(files, 'out', columnar = columnar) == expected.shape
+    pd.testing.assert_frame_equal(fe.load_frame('out', columnar), expected)
+    pd.testing.assert_frame_equal(pd.read_csv('out.csv'), expected)
+
+def test_parquet_written_per_week(week_files):
+    pq = pytest.importorskip('pyarrow.parquet')
+    files, expected = week_files
+    fe.merge_week_csv(files, 'out', columnar = 'parquet')
+    # 每周写入一个行组, 不先拼接所有周
+    assert pq.ParquetFile('out.parquet').num_row_groups == len(files)
@@ -0,0 +1,89 @@
+"""
+process_user_pc与逐个用户循环的原始版本(tests/reference.py)对照, 并检查各种情况下的主要PC和共享PC;
+getuserlist从LDAP夹具(tests/data/{数据集}/LDAP)和Step 1生成的DataByWeek端到端推断用户的PC
+"""
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import feature_extraction as fe
+import reference
+import test_process_week_num
+
+# 使用多台PC的用户: PC-9被U2/U3/U4使用, PC-3被U3/U4使用; U4为IT管理员; U0没有PC
+MULTI_PC = {'U0': [], 'U1': ['PC-1'], 'U2': ['PC-2', 'PC-9'], 'U3': ['PC-9', 'PC-3'], 'U4': ['PC-4', 'PC-9', 'PC-3']}
+# 使用者数量相同时取列表中靠前的PC
+TIES = {'U5': ['PC-5', 'PC-6'], 'U6': ['PC-6', 'PC-5'], 'U7': ['PC-7', 'PC-8']}
+# 没有使用多台PC的用户
+SINGLE_PC = {'U0': [], 'U1': ['PC-1'], 'U2': ['PC-2']}
+
+def user_pcs(pcs):
+    """生成process_user_pc的输入(每次生成新的列表, 原始版本会原地修改)和角色"""
+    upd = pd.DataFrame(index = pd.Index(list(pcs), name = 'user_id'))
+    upd['pcs'] = [list(l) for l in pcs.values()]
+    roles = pd.Series(['ITAdmin' if u == 'U4' else 'Engineer' for u in pcs], index = upd.index)
+    return upd, roles
+
+def result(upd):
+    """主要PC(没有则为None)和共享PC列表"""
+    return upd['pc'].where(upd['pc'].notna(), None).tolist(), upd['sharedpc'].tolist()
+
+@pytest.mark.parametrize('pcs, expected', [
+    (MULTI_PC, (['PC-1', 'PC-2', 'PC-3', 'PC-4'], [None, ['PC-9'], ['PC-9'], None])),
+    (TIES, (['PC-5', 'PC-6', 'PC-7'], [['PC-6'], ['PC-5'], ['PC-8']])),
+])
+def test_matches_loop_reference(pcs, expected):
+    new = fe.process_user_pc(*user_pcs(pcs))
+    ref = reference.process_user_pc(*user_pcs(pcs))
+    assert result(new) == result(ref)
+    assert new['npc'].tolist() == ref['npc'].tolist()
+    pc, sharedpc = result(new)
+    has_pc = [len(l) > 0 for l in pcs.values()]
+    assert [p for p, h in zip(pc, has_pc) if h] == expected[0]
+    assert [s for s, h in zip(sharedpc, has_pc) if h] == expected[1]
+    assert [p for p, h in zip(pc, has_pc) if not h] == [None] * has_pc.count(False)
+
+def test_no_multi_pc_users():
+    # 原始版本在没有使用多台PC的用户时拼接空列表出错, 直接检查结果
+    with pytest.raises(ValueError):
+        reference.process_user_pc(*user_pcs(SINGLE_PC))
+    upd = fe.process_user_pc(*user_pcs(SINGLE_PC))
+    assert result(upd) == ([None, 'PC-1', 'PC-2'], [None, None, None])
+    assert upd['npc'].tolist() == [0, 1, 1]
+
+# getuserlist端到端: 第1、2周(2010-01-10到2010-01-23)的登录活动, (用户, PC, 使用的周)
+# PC-9被U1/U2/U3使用; U3只在第1周使用PC-8; U4为IT管理员; U5和U6的PC使用者数量相同; U7没有活动(2月离职)
+WEEK_LOGONS = [('U1', 'PC-1', [1, 2]), ('U1', 'PC-9', [1, 2]), ('U2', 'PC-9', [1, 2]), ('U2', 'PC-2', [1, 2]),
+               ('U3', 'PC-9', [1, 2]), ('U3', 'PC-3', [1, 2]), ('U3', 'PC-8', [1]),
+               ('U4', 'PC-4', [1, 2]), ('U4', 'PC-3', [1, 2]), ('U4', 'PC-9', [1, 2]),
+               ('U5', 'PC-6', [1, 2]), ('U5', 'PC-5', [1, 2]), ('U6', 'PC-5', [1, 2]), ('U6', 'PC-6', [1, 2])]
+
+def user_activities(data):
+    """第0周使用test_process_week_num的活动(Step 1按http.csv的第一个活动确定第0周), 再加上第1、2周的登录"""
+    activities = test_process_week_num.activity_lines(data)
+    for i, (user, pc, weeks) in enumerate(WEEK_LOGONS):
+        for week in weeks:
+            date = pd.Timestamp('2010-01-11') + pd.Timedelta(days = 7 * (week - 1)) + pd.Timedelta(minutes = 10 * i)
+            activities['logon'].append(f"{{W{week}{i:02d}}},{date:%m/%d/%Y %H:%M:%S},{user},{pc},Logon")
+    return activities
+
+@pytest.mark.parametrize('data', ['r4.2', 'r5.2'])
+def test_getuserlist(data, tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), 'data', data, 'LDAP'), tmp_path / 'LDAP')
+    monkeypatch.chdir(tmp_path)
+    test_process_week_num.write_week(data, user_activities(data))
+    df = fe.getuserlist(data)
+    
+    # 同样的输入(两周都使用过的PC, 按PC名排序)交给逐个用户循环的原始版本
+    pcs = {u: sorted({pc for user, pc, weeks in WEEK_LOGONS if user == u and weeks == [1, 2]}) for u in df.index}
+    upd, _ = user_pcs(pcs)
+    ref = reference.process_user_pc(upd, df['role'])
+    assert result(df) == result(ref)
+    assert df.loc['U1':'U4', 'pc'].tolist() == ['PC-1', 'PC-2', 'PC-3', 'PC-4']
+    assert df.loc['U4', 'sharedpc'] is None and df.loc['U3', 'sharedpc'] == ['PC-9']
+    # 使用者数量相同时取PC名靠前的PC, 与集合的哈希顺序无关
+    assert df.loc[['U5', 'U6'], 'pc'].tolist() == ['PC-5', 'PC-5']
+    assert pd.isna(df.loc['U7', 'pc']) and df.loc['U7', 'wend'] == 'LDAP/2010-02'
+    assert df.loc['U1', 'sup'] == 'U3'
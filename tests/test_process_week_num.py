@@ -0,0 +1,116 @@
+"""
+process_week_num与向量化之前逐行实现的原始版本(tests/reference.py)对照
+两者读取同一个由小型CSV夹具生成的DataByWeek周文件, 除usb_dur外输出应完全相同:
+原始版本向后查找时把连接活动自身当作"下一个连接", 几乎所有usb_dur都是-1, 新版本改为严格在连接之后查找
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import feature_extraction as fe
+import reference
+
+DATASETS = ['r4.2', 'r5.2', 'r6.2']
+
+# 第0周为2010-01-03(周日)到2010-01-09(周六)
+# U1: 自己的PC-1, 共享PC-9, 主管U3; U2: 恶意用户(场景2, 时间窗口覆盖本周); U3: 主管; U4: 恶意用户(场景1, 时间窗口不在本周)
+USERS = pd.DataFrame({
+    'pc': ['PC-1', 'PC-2', 'PC-3', 'PC-4'],
+    'sharedpc': [['PC-9'], None, None, None],
+    'sup': ['U3', 'U3', None, 'U3'],
+    'malscene': [0, 2, 0, 1],
+    'mstart': pd.to_datetime([None, '2010-01-01', None, '2010-03-01']),
+    'mend': pd.to_datetime([None, '2010-01-20', None, '2010-03-10']),
+    'malacts': [None, ['{H02}', '{F02}'], None, ['{H04}']],
+}, index = pd.Index(['U1', 'U2', 'U3', 'U4'], name = 'user_id'))
+
+def activity_lines(data):
+    """每类活动的CSV行(不含表头), 覆盖各种PC类型、工作时间边界、周末以及各类活动的特征分支"""
+    r4, r6 = data in ['r4.1', 'r4.2'], data in ['r6.1', 'r6.2']
+    logon = ['{L01},01/04/2010 07:30:00,U1,PC-1,Logon', '{L02},01/04/2010 17:30:00,U1,PC-9,Logoff',
+             '{L03},01/04/2010 17:30:30,U2,PC-9,Logon', '{L04},01/05/2010 07:29:59,U1,PC-3,Logon',
+             '{L05},01/05/2010 12:00:00,U1,PC-77,Logon', '{L06},01/09/2010 10:00:00,U3,PC-3,Logon',
+             '{L07},01/09/2010 22:00:00,U4,PC-4,Logoff', '{L08},01/06/2010 08:00:00,U2,PC-2,Logon']
+    # U1在PC-1上: 正常的连接/断开, 连接后又连接, 没有断开的连接; U2在PC-2上: 连接/断开
+    device = [('{D01}', '01/04/2010 09:00:00', 'U1', 'PC-1', 'Connect'), ('{D02}', '01/04/2010 09:10:00', 'U1', 'PC-1', 'Disconnect'),
+              ('{D03}', '01/04/2010 10:00:00', 'U1', 'PC-1', 'Connect'), ('{D04}', '01/04/2010 10:05:00', 'U1', 'PC-1', 'Connect'),
+              ('{D05}', '01/04/2010 10:10:00', 'U1', 'PC-1', 'Disconnect'), ('{D06}', '01/05/2010 11:00:00', 'U1', 'PC-1', 'Connect'),
+              ('{D07}', '01/06/2010 09:00:00', 'U2', 'PC-2', 'Connect'), ('{D08}', '01/06/2010 09:30:00', 'U2', 'PC-2', 'Disconnect')]
+    device = [','.join(d[:4] + ((d[4],) if r4 else ('R:\\a;R:\\b\\c', d[4]))) for d in device]
+    urls = [('{H01}', '01/04/2010 11:00:00', 'U1', 'PC-1', 'http://www.facebook.com/a/b'),
+            ('{H02}', '01/06/2010 18:00:00', 'U2', 'PC-2', 'http://wikileaks.org/y/z'),
+            ('{H03}', '01/07/2010 09:00:00', 'U2', 'PC-2', 'http://aol.com/recruit/a'),
+            ('{H04}', '01/08/2010 09:00:00', 'U4', 'PC-4', 'http://news.bbc.co.uk/a/b/c'),
+            ('{H05}', '01/08/2010 09:30:00', 'U3', 'PC-3', 'http://a.b.example.com/p'),
+            ('{H06}', '01/08/2010 10:00:00', 'U3', 'PC-3', 'http://www.keylogpro.com/a'),
+            ('{H07}', '01/08/2010 10:30:00', 'U1', 'PC-1', 'http://dropbox.com/x')]
+    http_acts = ['WWW Visit', 'WWW Download', 'WWW Upload', 'WWW Visit', 'www visit', 'WWW Download', 'WWW Visit']
+    contents = ['w1 w2 w3', '"w4, w5 w6"' if r6 else 'w4 w5 w6', 'w7', 'w8 w9', 'w10', 'w11 w12', 'w13']
+    http = [','.join(u + ((a,) if r6 else ()) + (c,)) for u, a, c in zip(urls, http_acts, contents)]
+    emails = [('{E01}', '01/04/2010 12:00:00', 'U1', 'PC-1', 'a@dtaa.com;b@gmail.com', 'c@dtaa.com', '', 'u1@dtaa.com', 'Send', '2000',
+               'C:\\d\\f1.doc(120);C:\\d\\f2.zip(3000)', '2', 'hi there'),
+              ('{E02}', '01/06/2010 13:00:00', 'U2', 'PC-2', 'a@dtaa.com', '', 'x@yahoo.com;y@dtaa.com', 'u2@dtaa.com', 'View', '500',
+               '', '0', 'one two three'),
+              ('{E03}', '01/09/2010 20:00:00', 'U3', 'PC-3', 'd@x.com', 'e@dtaa.com;f@y.com', 'i@dtaa.com', 'u3@dtaa.com', 'Receive', '90',
+               'C:\\x\\f.xyz(5);C:\\x\\g.exe(7)', '1', '"a, b"' if r6 else 'a b')]
+    email = [','.join(e[:8] + ((e[9], e[11]) if r4 else (e[8], e[9], e[10])) + (e[12],)) for e in emails]
+    files = [('{F01}', '01/04/2010 14:00:00', 'U1', 'PC-1', 'C:\\d1\\f.doc', 'File Open', 'False', 'True', 'w1 w2'),
+             ('{F02}', '01/06/2010 15:00:00', 'U2', 'PC-2', 'R:\\f.exe', 'File Copy', 'True', 'False', 'w3'),
+             ('{F03}', '01/07/2010 16:00:00', 'U2', 'PC-9', 'D:\\d\\d2\\f.xyz', 'file write', 'False', 'False', 'w4 w5 w6'),
+             ('{F04}', '01/08/2010 19:00:00', 'U4', 'PC-3', 'C:\\f.zip', 'File Delete', 'True', 'True', '"w7, w8"' if r6 else 'w7')]
+    file = [','.join(f[:5] + (() if r4 else f[5:8]) + (f[8],)) for f in files]
+    return {'logon': logon, 'device': device, 'http': http, 'email': email, 'file': file}
+
+def write_week(data, activities = None):
+    """把活动(默认为activity_lines)写成CSV文件(按时间排序), 再用Step 1生成DataByWeek"""
+    for act, lines in (activities or activity_lines(data)).items():
+        lines = sorted(lines, key = lambda l: pd.to_datetime(l.split(',')[1]))
+        with open(act + '.csv', 'w') as f:
+            f.write(','.join(fe.get_activity_columns(act, data)) + '\n' + '\n'.join(lines) + '\n')
+    for folder in ['DataByWeek', 'NumDataByWeek']:
+        os.makedirs(folder, exist_ok = True)
+    fe.combine_by_timerange_pandas(data)
+
+@pytest.fixture(params = DATASETS)
+def week_outputs(request, tmp_path, monkeypatch):
+    """在临时目录中分别运行原始版本和新版本的process_week_num, 返回(数据集, 原始输出, 新输出)"""
+    data = request.param
+    monkeypatch.chdir(tmp_path)
+    write_week(data)
+    userlist = list(USERS.index)
+    reference.process_week_num(0, USERS, userlist = userlist, data = data, config_id = 'ref')
+    fe.process_week_num(0, USERS, userlist = userlist, data = data, config_id = 'new')
+    return data, pd.read_pickle('NumDataByWeek/0_num_ref.pickle'), pd.read_pickle('NumDataByWeek/0_num_new.pickle')
+
+def test_matches_row_reference(week_outputs):
+    data, ref, new = week_outputs
+    cols = [c for c in fe.get_num_columns(data) if c != 'usb_dur']
+    assert list(new.columns) == list(ref.columns)
+    assert len(new) == sum(len(l) for l in activity_lines(data).values())
+    assert new['actid'].tolist() == ref['actid'].tolist()
+    assert new['pcid'].tolist() == ref['pcid'].tolist()
+    pd.testing.assert_series_equal(pd.to_datetime(new['time_stamp']), pd.to_datetime(ref['time_stamp']))
+    pd.testing.assert_frame_equal(new[cols], ref[cols])
+
+def test_labels_and_categories(week_outputs):
+    data, ref, new = week_outputs
+    by_id = new.set_index('actid')
+    # 自己的PC / 共享PC / 他人的PC / 主管的PC / 不在查找表中的PC
+    assert by_id.loc[['{L01}', '{L02}', '{L03}', '{L04}', '{L05}'], 'pc'].tolist() == [0, 1, 2, 3, 2]
+    # 7:30和17:30(含)为工作时间, 周六为周末
+    assert by_id.loc[['{L01}', '{L02}', '{L03}', '{L04}', '{L06}', '{L07}'], 'time'].tolist() == [1, 1, 2, 2, 3, 4]
+    # 只有时间窗口覆盖本周的恶意用户被标记
+    assert set(by_id.loc[by_id['insider'] > 0].index) == set(new.loc[new['user'] == 1, 'actid'])
+    assert (by_id.loc[new.loc[new['user'] == 1, 'actid'], 'insider'] == 2).all()
+    assert set(by_id.index[by_id['mal_act'] == 1]) == {'{H02}', '{F02}'}
+
+def test_usb_duration(week_outputs):
+    data, ref, new = week_outputs
+    usb_dur = new.set_index('actid')['usb_dur']
+    # 连接后10分钟断开; 断开之前又有连接的连接和没有断开的连接为-1; 其他活动为0
+    expected = {'{D01}': 600, '{D03}': -1, '{D04}': 300, '{D06}': -1, '{D07}': 1800}
+    assert usb_dur[list(expected)].tolist() == list(expected.values())
+    assert (usb_dur.drop(list(expected)) == 0).all()
+    # 原始版本把连接自身当作下一个连接: 有断开活动的连接也都是-1
+    assert (ref.loc[ref['act'] == 3, 'usb_dur'] == -1).all()